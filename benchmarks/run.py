@@ -0,0 +1,342 @@
+"""Benchmarks the plugin against synthetic multi-repo sites built from local git repos.
+
+For every scale (number of imported repos) a site is generated whose nav imports that many
+`file://` repositories, each holding a number of markdown files nested a few directories
+deep. The plugin's hooks are then run end to end (on_config -> on_files -> on_nav ->
+on_post_build) followed by the hot functions on their own.
+
+    $ python benchmarks/run.py --scales 10 100 --output benchmarks/results.json
+    $ python benchmarks/run.py --scales 10 100 --baseline benchmarks/results.json
+
+Timings depend on the machine, so every run also times a fixed calibration workload and
+timings are compared to a baseline relative to it. That only evens out differences in
+speed, so for a reliable comparison record the baseline on the same machine first.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager, redirect_stdout
+from copy import deepcopy
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import yaml
+from mkdocs.config import load_config
+from mkdocs.structure.files import get_files as get_site_files
+from mkdocs.structure.nav import get_navigation
+
+from mkdocs_multirepo_plugin import structure
+from mkdocs_multirepo_plugin.plugin import MultirepoPlugin
+
+# a result slower than its baseline by more than this ratio is reported as a regression
+REGRESSION_THRESHOLD = 1.2
+
+
+def git(*args, cwd: Path) -> None:
+    subprocess.run(
+        [
+            "git",
+            "-c",
+            "user.name=benchmark",
+            "-c",
+            "user.email=benchmark@example.com",
+            *args,
+        ],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+    )
+
+
+def page_path(index: int, depth: int) -> str:
+    """spreads pages over directories up to depth levels below the docs directory"""
+    parts = [f"section{level}" for level in range(index % (depth + 1))]
+    return "/".join(parts + [f"page{index}.md"])
+
+
+def make_repo(path: Path, files: int, depth: int) -> str:
+    """creates a git repo holding a docs directory with files pages and returns its url"""
+    pages = [page_path(i, depth) for i in range(files)]
+    for page in pages:
+        (path / "docs" / page).parent.mkdir(parents=True, exist_ok=True)
+        (path / "docs" / page).write_text(f"# {Path(page).stem}\n\nSome text.\n")
+    (path / "docs" / "index.md").write_text("# Home\n")
+    nav = [{"Home": "index.md"}] + [{Path(page).stem: page} for page in pages]
+    (path / "docs" / "mkdocs.yml").write_text(yaml.safe_dump({"nav": nav}))
+    git("init", "-q", cwd=path)
+    git("checkout", "-q", "-b", "main", cwd=path)
+    git("add", "-A", cwd=path)
+    git("commit", "-q", "-m", "docs", cwd=path)
+    return path.as_uri()
+
+
+def make_nav(urls: List[str], depth: int) -> List[Dict]:
+    """nests the repo imports in sections depth levels deep"""
+    imports = [
+        {f"Repo {i}": f"!import {url}?branch=main"} for i, url in enumerate(urls)
+    ]
+    for level in range(depth):
+        group_size = max(1, len(imports) // 2)
+        imports = [
+            {f"Group {level}-{i}": imports[i : i + group_size]}
+            for i in range(0, len(imports), group_size)
+        ]
+    return [{"Home": "index.md"}] + imports
+
+
+def make_site(location: Path, repos: int, files: int, depth: int) -> Path:
+    """creates the repos and a site importing them, returning the site's mkdocs.yml"""
+    urls = [
+        make_repo(location / "repos" / f"repo{i}", files, depth) for i in range(repos)
+    ]
+    site = location / "site"
+    (site / "docs").mkdir(parents=True)
+    (site / "docs" / "index.md").write_text("# Site\n")
+    config = {
+        "site_name": "benchmark",
+        "repo_url": "https://github.com/org/site",
+        "plugins": ["multirepo"],
+        "nav": make_nav(urls, depth),
+    }
+    (site / "mkdocs.yml").write_text(yaml.safe_dump(config, sort_keys=False))
+    return site / "mkdocs.yml"
+
+
+@contextmanager
+def measure(results: Dict[str, float], name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    yield
+    results[name] = round(time.perf_counter() - start, 4)
+
+
+def best_of(repeat: int, func: Callable[[], None]) -> float:
+    """returns the fastest of repeat runs of func, which is the least noisy estimate"""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return round(min(durations), 4)
+
+
+def calibrate(repeat: int) -> float:
+    """times a fixed workload of the kinds of work the plugin does (git processes, small
+    file writes and reads, and Python code), which timings are compared relative to. Each
+    kind is timed on its own, as often as the timings need to be stable."""
+    repeat = max(repeat, 5)
+    nav = [{f"Page {i}": f"section/page{i}.md"} for i in range(200)]
+
+    def git_processes():
+        for _ in range(10):
+            subprocess.run(["git", "--version"], capture_output=True, check=True)
+
+    def python_code():
+        for _ in range(5):
+            yaml.safe_load(yaml.safe_dump({"nav": nav}))
+
+    with tempfile.TemporaryDirectory(prefix="multirepo_calibration_") as location:
+
+        def files():
+            for i in range(200):
+                path = Path(location) / f"section{i % 4}" / f"page{i}.md"
+                path.parent.mkdir(exist_ok=True)
+                path.write_text(f"# Page {i}\n")
+                path.read_text()
+
+        return round(
+            best_of(repeat, git_processes)
+            + best_of(repeat, files)
+            + best_of(repeat, python_code),
+            4,
+        )
+
+
+def run_hooks(config_file: Path) -> Tuple[Dict[str, float], MultirepoPlugin]:
+    """runs the plugin's hooks like `mkdocs build` does, timing each of them"""
+    results: Dict[str, float] = {}
+    config = load_config(str(config_file))
+    plugin = config["plugins"]["multirepo"]
+    # keep imported docs so the hot functions can run on them afterwards
+    plugin.config["cleanup"] = False
+    plugin.on_startup(command="build", dirty=False)
+    with measure(results, "on_config"):
+        config = plugin.on_config(config)
+    files = get_site_files(config)
+    with measure(results, "on_files"):
+        files = plugin.on_files(files, config)
+    nav = get_navigation(files, config)
+    with measure(results, "on_nav"):
+        plugin.on_nav(nav, config, files)
+    with measure(results, "on_post_build"):
+        plugin.on_post_build(config)
+    results["end_to_end"] = round(sum(results.values()), 4)
+    results["files"] = len(files)
+    return results, plugin
+
+
+def run_hot_functions(
+    plugin: MultirepoPlugin, config_file: Path, repeat: int
+) -> Dict[str, float]:
+    """times the functions that scale with the number of repos and files"""
+    results: Dict[str, float] = {}
+    config = load_config(str(config_file))
+    nav = config["nav"]
+    repos = list(plugin.repos.values())
+    results["get_import_stmts"] = best_of(
+        repeat,
+        lambda: structure.get_import_stmts(deepcopy(nav), plugin.temp_dir, "master"),
+    )
+    repo_navs = [repo.load_config()["nav"] for repo in repos]
+    results["resolve_nav_paths"] = best_of(
+        repeat,
+        lambda: [
+            structure.resolve_nav_paths(deepcopy(repo_nav), "section")
+            for repo_nav in repo_navs
+        ],
+    )
+    repo_files = {}
+
+    def get_files():
+        for repo in repos:
+            repo_files[repo.name] = structure.get_files(config, repo)
+
+    results["get_files"] = best_of(repeat, get_files)
+    results["get_edit_url"] = best_of(
+        repeat,
+        lambda: [
+            repo.get_edit_url(f.src_path)
+            for repo in repos
+            for f in repo_files[repo.name]
+        ],
+    )
+
+    def transform_docs_dir():
+        # transform_docs_dir changes the tree in place so every run needs a fresh copy
+        for repo in repos:
+            copy = structure.DocsRepo(
+                repo.name, repo.url, plugin.temp_dir / ".transform", multi_docs=True
+            )
+            shutil.copytree(
+                str(repo.location), str(copy.location / "docs"), dirs_exist_ok=True
+            )
+            copy.transform_docs_dir()
+        shutil.rmtree(str(plugin.temp_dir / ".transform"))
+
+    results["transform_docs_dir"] = best_of(repeat, transform_docs_dir)
+    return results
+
+
+def run_scale(repos: int, files: int, depth: int, repeat: int) -> Dict:
+    # calibrated right before the scale's timings, as the machine's speed can drift
+    calibration = calibrate(repeat)
+    with tempfile.TemporaryDirectory(prefix="multirepo_benchmark_") as location:
+        config_file = make_site(Path(location), repos, files, depth)
+        cwd = os.getcwd()
+        # relative paths in the config (e.g., temp_dir) are relative to the site
+        os.chdir(config_file.parent)
+        try:
+            # keep the import progress out of the results printed to stdout
+            with redirect_stdout(sys.stderr):
+                end_to_end = [run_hooks(config_file) for _ in range(repeat)]
+            plugin = end_to_end[-1][1]
+            hooks = {
+                key: min(results[key] for results, _ in end_to_end)
+                for key in end_to_end[0][0]
+            }
+            hot_functions = run_hot_functions(plugin, config_file, repeat)
+            shutil.rmtree(str(plugin.temp_dir))
+        finally:
+            os.chdir(cwd)
+    return {
+        "repos": repos,
+        "files_per_repo": files,
+        "depth": depth,
+        "calibration": calibration,
+        "hooks": hooks,
+        "hot_functions": hot_functions,
+        "repos_per_sec": round(repos / hooks["end_to_end"], 2),
+    }
+
+
+def compare(results: Dict, baseline: Dict) -> List[str]:
+    """returns a line for every timing that's slower than the baseline's, relative to the
+    calibration timings of both runs"""
+    regressions = []
+    baseline_scales = {scale["repos"]: scale for scale in baseline["scales"]}
+    for scale in results["scales"]:
+        base = baseline_scales.get(scale["repos"])
+        if base is None:
+            continue
+        # baselines recorded before calibration are compared as they are
+        speedup = (
+            base["calibration"] / scale["calibration"]
+            if base.get("calibration")
+            else 1.0
+        )
+        for group in ("hooks", "hot_functions"):
+            for name, duration in scale[group].items():
+                base_duration = base[group].get(name)
+                if not base_duration or name == "files":
+                    continue
+                ratio = duration * speedup / base_duration
+                if ratio > REGRESSION_THRESHOLD:
+                    regressions.append(
+                        f"{scale['repos']} repos {name}: {base_duration:.4f}s -> "
+                        f"{duration:.4f}s ({ratio:.2f}x, calibrated)"
+                    )
+    return regressions
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scales", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--files", type=int, default=20, help="pages per repo")
+    parser.add_argument("--depth", type=int, default=2, help="nav and docs depth")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", type=Path, help="write the results to this file")
+    parser.add_argument("--baseline", type=Path, help="compare against these results")
+    args = parser.parse_args(argv)
+    results = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "git": subprocess.run(
+            ["git", "--version"], capture_output=True, text=True
+        ).stdout.strip(),
+        "scales": [],
+    }
+    for repos in args.scales:
+        print(f"benchmarking {repos} repos...", file=sys.stderr)
+        scale = run_scale(repos, args.files, args.depth, args.repeat)
+        results["scales"].append(scale)
+        print(json.dumps(scale, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for key in ("platform", "python", "git"):
+            if baseline.get(key) != results[key]:
+                print(
+                    f"warning: the baseline was recorded with {key} "
+                    f"{baseline.get(key)}, not {results[key]}. Timings are only "
+                    "calibrated for speed, so record a baseline on this machine to "
+                    "compare reliably.",
+                    file=sys.stderr,
+                )
+        regressions = compare(results, baseline)
+        for regression in regressions:
+            print(f"regression: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,690 @@
+import asyncio
+import os
+import re
+import shutil
+import subprocess
+import tarfile
+from abc import ABC, abstractmethod
+from fnmatch import fnmatch
+from pathlib import Path, PurePosixPath
+from typing import IO, Dict, List, Optional, Set, Tuple, Type
+from urllib.error import URLError
+from urllib.parse import unquote, urlparse
+from urllib.request import Request, urlopen
+
+from .cache import cache_key, link_or_copy
+from .changes import ImportChanges
+from .lazy import LazyTree, parse_ls_tree
+from .util import (
+    GitException,
+    ImportDocsException,
+    execute_bash_script,
+    execute_git,
+    git_auth_config,
+    git_capabilities,
+    git_config_args,
+    kill_process,
+    log,
+    move_docs_up,
+    select_fetch_strategy,
+)
+
+DEFAULT_BACKEND = "git"
+DEFAULT_CLONE_FILTER = "blob:none"
+# the filters benchmark_clone_filters compares, where none is a plain shallow fetch
+CLONE_FILTERS = ("blob:none", "tree:0", "none")
+
+
+def clone_filter_args(clone_filter: Optional[str]) -> List[str]:
+    """returns git's --filter argument for a repo's clone filter, which is dropped when it's
+    none or git can't make partial clones"""
+    clone_filter = clone_filter or DEFAULT_CLONE_FILTER
+    if clone_filter == "none" or not git_capabilities().partial_clone:
+        return []
+    return [f"--filter={clone_filter}"]
+
+
+def matches_sparse_patterns(path: str, patterns: List[str]) -> bool:
+    """Returns True if a repo relative path is selected by non-cone sparse-checkout patterns.
+    Patterns containing a slash are anchored to the repo root, other patterns match a file or
+    directory name at any depth, and a match on a directory selects everything below it."""
+    parts = path.split("/")
+    prefixes = ["/".join(parts[: i + 1]) for i in range(len(parts))]
+    for pattern in patterns:
+        if not pattern or pattern.startswith("!"):
+            continue
+        anchored = "/" in pattern.rstrip("/")
+        pattern = pattern.strip("/")
+        candidates = prefixes if anchored else parts
+        if any(fnmatch(candidate, pattern) for candidate in candidates):
+            return True
+    return False
+
+
+class FetchBackend(ABC):
+    """Fetches paths of a remote repo into a directory.
+
+    Attributes:
+        name (str): The name used to select the backend (e.g., `?backend=git`).
+        supports_incremental (bool): If True, `fetch` can keep what it needs to update dest
+                                     incrementally when keep_git is set (see GitStore).
+        moves_docs_up (bool): If True, `fetch` accepts move_up, the docs directory whose
+                              contents are written to dest instead (see move_docs_up).
+        supports_lazy (bool): If True, `fetch_tree` lists the files of paths without
+                              checking them out (see LazyTree).
+        supports_cache (bool): If True, fetched trees can be cached by the commit they were
+                               fetched from (see ImportCache).
+    """
+
+    name = ""
+    supports_incremental = False
+    moves_docs_up = False
+    supports_lazy = False
+    supports_cache = True
+
+    @abstractmethod
+    async def fetch(
+        self, repo, paths: List[str], dest: Path, keep_git: bool = False
+    ) -> None:
+        """Fetches the repo's paths (sparse-checkout patterns) at repo.fetch_ref into dest"""
+
+    async def fetch_tree(
+        self, repo, paths: List[str], checkout: List[str], dest: Path
+    ) -> LazyTree:
+        """Fetches the repo at repo.fetch_ref into dest, only checking out the checkout
+        paths, and returns a LazyTree of the files selected by paths. Only backends that
+        set supports_lazy implement it."""
+        raise ImportDocsException(
+            f"the {self.name} backend can't import {repo.name} lazily"
+        )
+
+
+class GitBackend(FetchBackend):
+    """Runs git directly, without a shell. A fetch is a shallow, sparse fetch of the branch
+    into an empty repository followed by a checkout, so it works with every git version and
+    costs three git processes (and only two when dest is kept and updated)."""
+
+    name = "git"
+    supports_incremental = True
+    supports_lazy = True
+
+    def remote_config(self, repo) -> Dict[str, str]:
+        capabilities = git_capabilities()
+        # the url is only passed on the command line so credentials are never written to .git
+        config = {
+            "remote.origin.url": repo.url,
+            "remote.origin.fetch": "+refs/heads/*:refs/remotes/origin/*",
+            "core.sparseCheckout": "true",
+            **git_auth_config(repo.url),
+        }
+        if capabilities.protocol_v2 and not capabilities.protocol_v2_default:
+            config["protocol.version"] = "2"
+        return config
+
+    async def fetch(
+        self, repo, paths: List[str], dest: Path, keep_git: bool = False
+    ) -> None:
+        if not (dest / ".git").is_dir():
+            dest.mkdir(parents=True, exist_ok=True)
+            await execute_git(["init", "-q"], dest)
+        # .git/info might not exist after git init, depending on git version
+        info_dir = dest / ".git" / "info"
+        info_dir.mkdir(exist_ok=True)
+        # checkout reapplies the sparse patterns, so changed paths are updated in place
+        with open(info_dir / "sparse-checkout", "w") as f:
+            f.writelines(f"{path}\n" for path in paths)
+        config = self.remote_config(repo)
+        fetch_filter = clone_filter_args(repo.clone_filter)
+        with repo.timings.measure("fetch"):
+            await execute_git(
+                ["fetch", "-q", "--depth", "1", "--no-tags"]
+                + fetch_filter
+                + ["origin", repo.fetch_ref],
+                dest,
+                config,
+            )
+        with repo.timings.measure("checkout"):
+            await execute_git(
+                ["checkout", "-q", "--force", "--detach", "FETCH_HEAD"], dest, config
+            )
+        if not keep_git:
+            shutil.rmtree(str(dest / ".git"))
+
+    async def fetch_tree(
+        self, repo, paths: List[str], checkout: List[str], dest: Path
+    ) -> LazyTree:
+        # without blobs, when the server allows it, which are then fetched as they're read
+        await self.fetch(repo, checkout, dest, keep_git=True)
+        with repo.timings.measure("list_tree"):
+            listing = await execute_git(["ls-tree", "-r", "-z", "HEAD"], dest)
+            promisor = await execute_git(
+                ["config", "--default", "false", "--get", "remote.origin.promisor"],
+                dest,
+            )
+        files = {
+            path: oid
+            for path, oid in parse_ls_tree(listing)
+            if matches_sparse_patterns(path, paths)
+        }
+        return LazyTree(
+            dest, files, self.remote_config(repo), promisor.strip() == "true"
+        )
+
+
+class SharedObjectStore:
+    """A bare, partial repository that every import of one remote is materialised from, so
+    the remote is fetched once however many times it's imported. Each import gets its own
+    sparse checkout through a temporary `git worktree`, which only fetches the blobs that
+    aren't in the store yet.
+
+    Attributes:
+        url (str): The remote's url.
+        location (Path): The bare repository.
+        branches (set): The branches imports need. The first import fetches all of them.
+        fetched (set): The branches that have been fetched.
+    """
+
+    def __init__(self, url: str, location: Path):
+        self.url = url
+        self.location = location
+        self.branches: Set[str] = set()
+        self.fetched: Set[str] = set()
+        self._fetching: Optional[asyncio.Future] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._lock_loop = None
+
+    def __str__(self):
+        return f"SharedObjectStore({self.url}, {self.location})"
+
+    def __repr__(self):
+        return self.__str__()
+
+    @staticmethod
+    def ref(branch: str) -> str:
+        return f"refs/multirepo/heads/{branch}"
+
+    def worktree_lock(self) -> asyncio.Lock:
+        # batches can run in different event loops and a lock is bound to the loop it's used in
+        loop = asyncio.get_running_loop()
+        if self._lock_loop is not loop:
+            self._lock, self._lock_loop = asyncio.Lock(), loop
+        return self._lock
+
+    async def _fetch(self, repo, branches: List[str]) -> None:
+        if not self.location.is_dir():
+            self.location.mkdir(parents=True)
+            await execute_git(["init", "-q", "--bare"], self.location)
+        # the store is fetched once for every import of its url, with the first one's filter
+        fetch_filter = clone_filter_args(repo.clone_filter)
+        refspecs = [f"+{branch}:{self.ref(branch)}" for branch in branches]
+        await execute_git(
+            ["fetch", "-q", "--depth", "1", "--no-tags"]
+            + fetch_filter
+            + ["origin"]
+            + refspecs,
+            self.location,
+            GitBackend().remote_config(repo),
+        )
+        self.fetched.update(branches)
+
+    async def ensure_fetched(self, repo, branch: str) -> None:
+        """fetches every branch that isn't in the store yet, once for all imports waiting"""
+        while branch not in self.fetched:
+            if self._fetching is None or self._fetching.done():
+                missing = sorted((self.branches | {branch}) - self.fetched)
+                self._fetching = asyncio.ensure_future(self._fetch(repo, missing))
+            # a cancelled import mustn't cancel the fetch the other imports are waiting on
+            await asyncio.shield(self._fetching)
+
+    async def materialise(self, repo, paths: List[str], dest: Path) -> None:
+        """checks out the repo's paths at its fetch_ref into dest"""
+        branch = repo.fetch_ref
+        with repo.timings.measure("fetch"):
+            await self.ensure_fetched(repo, branch)
+        with repo.timings.measure("checkout"):
+            await self.checkout(repo, branch, paths, dest)
+
+    async def checkout(self, repo, branch: str, paths: List[str], dest: Path) -> None:
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            async with self.worktree_lock():
+                # adding worktrees concurrently could race on the worktree's name, and
+                # --force reuses the name of a worktree whose directory was removed
+                await execute_git(
+                    ["worktree", "add", "-q", "--force", "--no-checkout", "--detach"]
+                    + [str(dest)]
+                    + [self.ref(branch)],
+                    self.location,
+                )
+            # dest/.git is a file pointing at the worktree's private git directory
+            git_dir = Path((dest / ".git").read_text().split(":", 1)[1].strip())
+            (git_dir / "info").mkdir(exist_ok=True)
+            with open(git_dir / "info" / "sparse-checkout", "w") as f:
+                f.writelines(f"{path}\n" for path in paths)
+            await execute_git(
+                ["checkout", "-q", "--force", "--detach", "HEAD"],
+                dest,
+                GitBackend().remote_config(repo),
+            )
+        finally:
+            # `git worktree remove` would delete the checked out docs too, so dest is
+            # detached from the worktree, which prune then removes from the store. This
+            # also runs when the checkout fails, so a kept store doesn't collect worktrees.
+            if (dest / ".git").is_file():
+                (dest / ".git").unlink()
+            async with self.worktree_lock():
+                await execute_git(["worktree", "prune"], self.location)
+
+
+class SharedObjectStores:
+    """Creates one SharedObjectStore per remote url under a root directory"""
+
+    def __init__(self, location: Path):
+        self.location = Path(location)
+        self.stores: Dict[str, SharedObjectStore] = {}
+
+    def get(self, url: str) -> SharedObjectStore:
+        if url not in self.stores:
+            self.stores[url] = SharedObjectStore(
+                url, self.location / (cache_key(url=url) + ".git")
+            )
+        return self.stores[url]
+
+    def assign(self, repos: List, shared_urls: Set[str]) -> None:
+        """Gives each git repo whose url is in shared_urls the store for its url"""
+        for repo in repos:
+            if repo.url in shared_urls and (repo.backend or DEFAULT_BACKEND) == "git":
+                repo.object_store = self.get(repo.url)
+                repo.object_store.branches.add(repo.fetch_ref)
+
+
+class ScriptBackend(FetchBackend):
+    """Fetches with the bash scripts in scripts/, as the plugin did before it ran git directly"""
+
+    name = "script"
+    supports_incremental = True
+
+    async def fetch(
+        self, repo, paths: List[str], dest: Path, keep_git: bool = False
+    ) -> None:
+        with repo.timings.measure("fetch"):
+            await self.run_script(repo, paths, dest, keep_git)
+
+    async def run_script(
+        self, repo, paths: List[str], dest: Path, keep_git: bool
+    ) -> None:
+        strategy = select_fetch_strategy()
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        branch = repo.fetch_ref
+        fetch_filter = " ".join(clone_filter_args(repo.clone_filter))
+        # the clone scripts clone a branch with the default filter, but a commit or another
+        # filter can only be fetched
+        if (
+            keep_git
+            or strategy.script == "sparse_fetch.sh"
+            or repo.sha
+            or fetch_filter != strategy.filter
+        ):
+            args = [repo.url, str(dest), branch, fetch_filter] + paths
+            await execute_bash_script(
+                "sparse_fetch.sh", args, dest.parent, strategy.env
+            )
+            if not keep_git:
+                shutil.rmtree(str(dest / ".git"))
+        else:
+            args = [repo.url, str(dest), branch] + paths
+            await execute_bash_script(strategy.script, args, dest.parent, strategy.env)
+
+
+def is_local_path(url: str) -> bool:
+    """Returns True if an import url is the path of a local directory (e.g., a sibling
+    checkout) rather than a remote"""
+    return url.startswith(("/", "./", "../", "~")) or bool(
+        re.match(r"[A-Za-z]:[\\/]", url)
+    )
+
+
+def select_backend(
+    url: str, backend: Optional[str], fallback: Optional[str]
+) -> Optional[str]:
+    """returns the backend an import uses: the one chosen for it, the local backend when it
+    imports a local directory, or else fallback (e.g., the fetch_backend option)"""
+    if backend:
+        return backend
+    if is_local_path(url):
+        return LocalPathBackend.name
+    return fallback
+
+
+def local_layout(
+    source: Path, paths: List[str], move_up: Optional[str] = None
+) -> Dict[str, str]:
+    """Returns the source file of every file a local import links, by its path in dest.
+    Files in the move_up directory are moved up, where they win over files with the same
+    path, just like move_docs_up."""
+    layout: Dict[str, str] = {}
+    moved: Set[str] = set()
+    # os.walk is top down, so a directory's files come before the files of move_up below it
+    for root, dirnames, filenames in os.walk(source):
+        if ".git" in dirnames:
+            dirnames.remove(".git")
+        relative_dir = Path(root).relative_to(source).as_posix()
+        for filename in filenames:
+            path = filename if relative_dir == "." else f"{relative_dir}/{filename}"
+            if not matches_sparse_patterns(path, paths):
+                continue
+            if move_up and path.startswith(f"{move_up}/"):
+                path = path[len(move_up) + 1 :]
+                moved.add(path)
+            elif path in moved:
+                continue
+            layout[path] = os.path.join(root, filename)
+    return layout
+
+
+class LocalImport:
+    """The files a local import linked from its source directory, so the import can be
+    brought up to date with the source by relinking only the files that changed.
+
+    Attributes:
+        source (Path): The directory the files are linked from.
+        paths (list): The sparse-checkout patterns that select the files.
+        move_up (str): The directory whose files are moved up, if any.
+        files (dict): The (source file, mtime in ns, size) of each linked file, by its path
+                      in dest.
+    """
+
+    def __init__(self, source: Path, paths: List[str], move_up: Optional[str] = None):
+        self.source = source
+        self.paths = paths
+        self.move_up = move_up
+        self.files: Dict[str, Tuple[str, int, int]] = {}
+
+    def scan(self) -> Dict[str, Tuple[str, int, int]]:
+        files = {}
+        for path, source_file in local_layout(
+            self.source, self.paths, self.move_up
+        ).items():
+            stat = os.stat(source_file)
+            files[path] = (source_file, stat.st_mtime_ns, stat.st_size)
+        return files
+
+    def link(self, dest: Path) -> None:
+        """links every file of the source into dest"""
+        self.files = self.scan()
+        for path, (source_file, _, _) in self.files.items():
+            (dest / path).parent.mkdir(parents=True, exist_ok=True)
+            link_or_copy(source_file, str(dest / path))
+
+    def sync(self, dest: Path) -> ImportChanges:
+        """Relinks the files of the source that were added or changed since they were
+        linked into dest and removes the ones that were removed, returning their paths"""
+        files = self.scan()
+        added, changed = [], []
+        for path, (source_file, mtime, size) in files.items():
+            target = dest / path
+            if path not in self.files:
+                added.append(path)
+            elif self.files[path] != files[path] or not target.is_file():
+                changed.append(path)
+            else:
+                continue
+            if target.is_file():
+                if os.path.samefile(source_file, target):
+                    # it was written to through the hard link
+                    continue
+                # e.g., an editor that saves by replacing the file breaks the hard link
+                target.unlink()
+            target.parent.mkdir(parents=True, exist_ok=True)
+            link_or_copy(source_file, str(target))
+        removed = sorted(set(self.files) - set(files))
+        for path in removed:
+            if (dest / path).is_file():
+                (dest / path).unlink()
+        self.files = files
+        return ImportChanges(sorted(added), sorted(changed), removed)
+
+
+class LocalPathBackend(FetchBackend):
+    """Links the selected paths of a local directory (e.g., a sibling checkout) into dest,
+    falling back to copies across filesystems. The branch is ignored since the working tree
+    is used as is. What's linked into a repo's location is kept as its local_import, so the
+    plugin can sync it with the source while serving."""
+
+    name = "local"
+    moves_docs_up = True
+    supports_cache = False
+
+    @staticmethod
+    def source_dir(url: str) -> Path:
+        if url.startswith("file://"):
+            return Path(unquote(urlparse(url).path))
+        return Path(url).expanduser()
+
+    async def fetch(
+        self,
+        repo,
+        paths: List[str],
+        dest: Path,
+        keep_git: bool = False,
+        move_up: Optional[str] = None,
+    ) -> None:
+        source = self.source_dir(repo.url)
+        if not source.is_dir():
+            raise ImportDocsException(
+                f"{repo.name}'s source {source} isn't a directory"
+            )
+        local_import = LocalImport(source, paths, move_up)
+        with repo.timings.measure("checkout"):
+            local_import.link(dest)
+        # config files fetched on their own (see fetch_config) aren't the repo's import
+        if dest == repo.location:
+            repo.local_import = local_import
+
+
+def extract_archive(
+    stream: IO[bytes],
+    dest: Path,
+    paths: List[str],
+    move_up: Optional[str] = None,
+    strip_components: int = 0,
+) -> None:
+    """Extracts the files of a tar stream that match the sparse-checkout patterns into dest,
+    as they're read. Files in the move_up directory are written to dest itself, where they
+    win over files with the same path, just like move_docs_up."""
+    moved: Set[str] = set()
+    with tarfile.open(fileobj=stream, mode="r|*") as archive:
+        for member in archive:
+            parts = PurePosixPath(member.name).parts[strip_components:]
+            # only regular files inside dest are extracted
+            if not member.isfile() or not parts or ".." in parts or parts[0] == "/":
+                continue
+            path = "/".join(parts)
+            if not matches_sparse_patterns(path, paths):
+                continue
+            if move_up and path.startswith(f"{move_up}/"):
+                path = path[len(move_up) + 1 :]
+                moved.add(path)
+            elif path in moved:
+                continue
+            target = dest / path
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with archive.extractfile(member) as src, open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+
+
+class ArchiveBackend(FetchBackend):
+    """Streams a tar archive of the branch and extracts the selected paths as they arrive,
+    straight into the layout import_docs produces. There's no repository and no checkout,
+    so it's the cheapest way to import a docs directory. The archive comes from `git archive
+    --remote`, which works with file://, ssh and `git daemon` remotes that allow
+    upload-archive, or, for GitHub, from its tarball endpoint."""
+
+    name = "archive"
+    moves_docs_up = True
+
+    @staticmethod
+    def pathspecs(paths: List[str]) -> List[str]:
+        """limits the archive to the sparse-checkout patterns. Patterns without a slash
+        match at any depth, the rest are anchored to the root like pathspecs."""
+        pathspecs = []
+        for path in paths:
+            if not path.strip("/") or path.startswith("!"):
+                continue
+            anchored = "/" in path.rstrip("/")
+            path = path.strip("/")
+            pathspecs.append(path if anchored else f":(glob)**/{path}")
+        return pathspecs
+
+    @staticmethod
+    def github_tarball_url(url: str, ref: str) -> Optional[str]:
+        match = re.match(r"https://github\.com/([^/]+)/([^/]+?)(\.git)?/?$", url)
+        if match is None:
+            return None
+        owner, name = match.group(1), match.group(2)
+        return f"https://codeload.github.com/{owner}/{name}/tar.gz/{ref}"
+
+    @staticmethod
+    def open_tarball(url: str, repo):
+        request = Request(url)
+        auth = git_auth_config(repo.url).get("http.extraheader")
+        if auth:
+            header, value = auth.split(": ", 1)
+            request.add_header(header, value)
+        return urlopen(request)
+
+    async def stream_tarball(
+        self, url: str, repo, paths: List[str], dest: Path, move_up: Optional[str]
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(None, self.open_tarball, url, repo)
+        try:
+            # the tarball's entries are in a {repo}-{ref} directory
+            await loop.run_in_executor(
+                None, extract_archive, response, dest, paths, move_up, 1
+            )
+        finally:
+            # if the import was cancelled, this ends the extraction still reading it
+            response.close()
+
+    @staticmethod
+    def git_archive_process(repo, ref: str, pathspecs: List[str]) -> subprocess.Popen:
+        args, env = git_config_args(git_auth_config(repo.url))
+        return subprocess.Popen(
+            ["git", *args, "archive", f"--remote={repo.url}", "--format=tar", ref, "--"]
+            + pathspecs,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env={**os.environ, **env} if env else None,
+            start_new_session=True,
+        )
+
+    @staticmethod
+    def extract_git_archive(
+        process: subprocess.Popen, paths: List[str], dest: Path, move_up: Optional[str]
+    ) -> None:
+        try:
+            extract_archive(process.stdout, dest, paths, move_up)
+        except tarfile.ReadError:
+            # git failed before sending an archive, which is reported below
+            pass
+        finally:
+            process.stdout.close()
+            stderr = process.stderr.read().decode()
+            process.wait()
+        if process.returncode != 0:
+            raise GitException(f"\ngit archive failed:\n{stderr}\n")
+
+    async def stream_git_archive(
+        self,
+        repo,
+        ref: str,
+        pathspecs: List[str],
+        paths: List[str],
+        dest: Path,
+        move_up: Optional[str],
+    ) -> None:
+        process = self.git_archive_process(repo, ref, pathspecs)
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.extract_git_archive, process, paths, dest, move_up
+            )
+        except asyncio.CancelledError:
+            # killing git closes the pipe, which ends the extraction still reading it
+            kill_process(process)
+            raise
+
+    async def stream_paths(
+        self, repo, paths: List[str], dest: Path, move_up: Optional[str]
+    ) -> None:
+        pathspecs = self.pathspecs(paths)
+        while pathspecs:
+            try:
+                await self.stream_git_archive(
+                    repo, repo.fetch_ref, pathspecs, paths, dest, move_up
+                )
+                return
+            except GitException as e:
+                # git archive fails if any pathspec matches nothing (e.g., an optional
+                # config file), so retry without it
+                match = re.search(r"pathspec '(.+?)' did not match", str(e))
+                if match is None or match.group(1) not in pathspecs:
+                    raise
+                pathspecs.remove(match.group(1))
+
+    async def fetch(
+        self,
+        repo,
+        paths: List[str],
+        dest: Path,
+        keep_git: bool = False,
+        move_up: Optional[str] = None,
+    ) -> None:
+        dest.mkdir(parents=True, exist_ok=True)
+        tarball_url = self.github_tarball_url(repo.url, repo.fetch_ref)
+        with repo.timings.measure("fetch"):
+            try:
+                if tarball_url is not None:
+                    await self.stream_tarball(tarball_url, repo, paths, dest, move_up)
+                else:
+                    await self.stream_paths(repo, paths, dest, move_up)
+                return
+            except URLError as e:
+                # e.g., a private repo, a token the tarball endpoint doesn't accept or
+                # rate limiting, none of which stop git from fetching the repo
+                log.warning(
+                    f"Multirepo plugin couldn't download the tarball of {repo.name} "
+                    f"({e}). Fetching it with git instead"
+                )
+                # the tarball might have been partially extracted
+                shutil.rmtree(str(dest))
+                dest.mkdir(parents=True)
+            except GitException as e:
+                # upload-archive only serves refs, unless the remote sets
+                # uploadArchive.allowUnreachable, so a pinned commit is fetched instead
+                if repo.sha is None or "no such ref" not in str(e):
+                    raise
+        await GitBackend().fetch(repo, paths, dest)
+        if move_up:
+            move_docs_up(dest, move_up)
+
+
+BACKENDS: Dict[str, Type[FetchBackend]] = {
+    backend.name: backend
+    for backend in (GitBackend, ScriptBackend, LocalPathBackend, ArchiveBackend)
+}
+
+
+def register_backend(backend: Type[FetchBackend]) -> Type[FetchBackend]:
+    """Makes a FetchBackend selectable by its name. Can be used as a class decorator."""
+    BACKENDS[backend.name] = backend
+    return backend
+
+
+def get_backend(name: str) -> FetchBackend:
+    if name not in BACKENDS:
+        available = ", ".join(sorted(BACKENDS))
+        raise ImportDocsException(
+            f"Unknown fetch backend '{name}'. Available backends are {available}"
+        )
+    return BACKENDS[name]()
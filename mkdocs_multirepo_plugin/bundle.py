@@ -0,0 +1,172 @@
+import hashlib
+import io
+import json
+import os
+import tarfile
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+from .cache import link_or_copy
+from .changes import file_hash, iter_imported_files
+from .util import ImportDocsException, log
+
+# bump when the manifest's format changes
+BUNDLE_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+OBJECTS_DIR = "objects"
+
+
+def bundle_file(directory: Path, shard: int, shards: int) -> Path:
+    return directory / f"multirepo-{shard}-of-{shards}.tar"
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """parses a shard given as i/n, e.g., 2/4"""
+    try:
+        shard, shards = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise ValueError(f"{value} isn't a shard like 1/4")
+    if not 1 <= shard <= shards:
+        raise ValueError(f"shard {shard} isn't between 1 and {shards}")
+    return shard, shards
+
+
+def repo_files(temp_dir: Path, names: Iterable[str]) -> Dict[str, Dict[str, str]]:
+    """Returns the imported files of each repo, by their path in the repo's location. A
+    nested import is imported into the location of the repo importing it, so a file belongs
+    to the repo with the longest name its path starts with."""
+    longest_first = sorted(names, key=len, reverse=True)
+    files: Dict[str, Dict[str, str]] = {name: {} for name in longest_first}
+    for src_path, path in iter_imported_files(temp_dir):
+        for name in longest_first:
+            if src_path.startswith(f"{name}/"):
+                files[name][src_path[len(name) + 1 :]] = path
+                break
+    return files
+
+
+def add_bytes(archive: tarfile.TarFile, name: str, data: bytes) -> None:
+    # the entries don't depend on who wrote the bundle or when, so bundles are reproducible
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = 0o644
+    archive.addfile(info, io.BytesIO(data))
+
+
+def write_bundle(
+    path: Path, temp_dir: Path, repos: List, keep_docs_dir: bool = False
+) -> int:
+    """Writes the docs repos imported into temp_dir to a bundle at path, returning how many
+    files were written. A bundle is a tar of a manifest, listing each repo's files with the
+    hashes of their content and the parts of its config file the plugin uses, followed by
+    the content of every file, once, named after its hash."""
+    files = repo_files(temp_dir, [repo.name for repo in repos]) if repos else {}
+    manifest: Dict = {"version": BUNDLE_VERSION, "repos": {}}
+    objects: Dict[str, str] = {}
+    for repo in repos:
+        hashes = {}
+        for repo_path, file_path in sorted(files[repo.name].items()):
+            hashes[repo_path] = file_hash(file_path)
+            objects.setdefault(hashes[repo_path], file_path)
+        manifest["repos"][repo.name] = {
+            "key": repo.cache_key(keep_docs_dir),
+            "nav_config": repo.nav_config,
+            "src_path_map": repo.src_path_map,
+            "files": hashes,
+        }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tarfile.open(tmp_path, "w") as archive:
+        # the manifest comes first so a bundle can be read as a stream
+        data = json.dumps(manifest, indent=2, sort_keys=True, default=str)
+        add_bytes(archive, MANIFEST_FILE, data.encode())
+        for digest, file_path in sorted(objects.items()):
+            with open(file_path, "rb") as f:
+                add_bytes(archive, f"{OBJECTS_DIR}/{digest}", f.read())
+    os.replace(tmp_path, path)
+    return len(objects)
+
+
+class BundleSet:
+    """The bundles written by the shards of an import (see write_bundle), which a build
+    imports docs from instead of fetching them, without any network access.
+
+    Attributes:
+        location (Path): The directory of the bundles.
+        objects_dir (Path): Where the content of the bundles' files is unpacked, by hash.
+        keep_docs_dir (bool): The global keep_docs_dir setting, which is part of each
+                              repo's key.
+        entries (dict): The manifest entry of every bundled repo, by the repo's name.
+    """
+
+    def __init__(self, location: Path, objects_dir: Path, keep_docs_dir: bool = False):
+        self.location = location
+        self.objects_dir = objects_dir
+        self.keep_docs_dir = keep_docs_dir
+        self.entries: Dict[str, Dict] = {}
+
+    def __str__(self):
+        return f"BundleSet({self.location}, {len(self.entries)} repos)"
+
+    def __repr__(self):
+        return self.__str__()
+
+    def load(self) -> None:
+        """reads the manifests of the bundles and unpacks their files' content"""
+        bundles = sorted(self.location.glob("*.tar"))
+        if not bundles:
+            raise ImportDocsException(f"there are no bundles in {self.location}")
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.entries = {}
+        for bundle in bundles:
+            self.load_bundle(bundle)
+        log.info(
+            f"Multirepo plugin loaded {len(self.entries)} imports from "
+            f"{len(bundles)} bundles"
+        )
+
+    def load_bundle(self, bundle: Path) -> None:
+        with tarfile.open(bundle, "r|") as archive:
+            for member in archive:
+                f = archive.extractfile(member)
+                if f is None:
+                    continue
+                if member.name == MANIFEST_FILE:
+                    manifest = json.load(f)
+                    if manifest.get("version") != BUNDLE_VERSION:
+                        raise ImportDocsException(
+                            f"{bundle} was written by another version of the plugin"
+                        )
+                    self.entries.update(manifest["repos"])
+                    continue
+                digest = member.name[len(OBJECTS_DIR) + 1 :]
+                target = self.objects_dir / digest
+                if not member.name.startswith(f"{OBJECTS_DIR}/") or target.is_file():
+                    continue
+                data = f.read()
+                if hashlib.sha256(data).hexdigest() != digest:
+                    raise ImportDocsException(f"{bundle} is corrupt: {member.name}")
+                target.write_bytes(data)
+
+    async def restore(self, repo):
+        """imports the repo's docs from its bundled files, with the nav of its config file"""
+        entry = self.entries.get(repo.name)
+        if entry is None:
+            raise ImportDocsException(
+                f"{repo.name} isn't in the bundles in {self.location}"
+            )
+        if entry["key"] != repo.cache_key(self.keep_docs_dir):
+            raise ImportDocsException(
+                f"{repo.name} was bundled from a different import than it's configured with"
+            )
+        repo.timings.reset()
+        if repo.cloned:
+            repo.delete_repo()
+        with repo.timings.measure("restore"):
+            for repo_path, digest in entry["files"].items():
+                target = repo.location / repo_path
+                target.parent.mkdir(parents=True, exist_ok=True)
+                link_or_copy(str(self.objects_dir / digest), str(target))
+        repo.nav_config = entry["nav_config"]
+        repo.src_path_map = entry["src_path_map"]
+        return repo
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from .util import log
+
+
+def link_or_copy(src: str, dst: str) -> str:
+    """hardlinks src to dst, falling back to a copy across filesystems"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
+
+
+def cache_key(**parts: Any) -> str:
+    """returns a stable hash for the parts that define a prepared tree"""
+    data = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()[:32]
+
+
+class ImportCache:
+    """A persistent directory of prepared repo trees, reused across builds.
+
+    Each entry is keyed by everything that affects the prepared tree (url, branch, imported paths,
+    ...) and records the commit SHA it was prepared from, so an entry is only reused while the
+    remote ref still points at that commit.
+
+    Attributes:
+        location (Path): The root directory of the cache. It should live outside temp_dir.
+    """
+
+    META_FILE = "meta.json"
+    TREE_DIR = "tree"
+
+    def __init__(self, location: Path):
+        self.location = Path(location)
+        self.location.mkdir(parents=True, exist_ok=True)
+
+    def __str__(self):
+        return f"ImportCache({self.location})"
+
+    def __repr__(self):
+        return self.__str__()
+
+    def entry(self, key: str) -> Path:
+        return self.location / key
+
+    def get_meta(self, key: str) -> Optional[Dict]:
+        """returns the metadata stored for key, or None if there's no complete entry"""
+        meta_file = self.entry(key) / self.META_FILE
+        if not meta_file.is_file():
+            return None
+        try:
+            with open(meta_file) as f:
+                return json.load(f)
+        except ValueError:
+            log.warning(f"Multirepo plugin ignoring corrupt cache entry {meta_file}")
+            return None
+
+    def restore(self, key: str, sha: str, dest: Path) -> Optional[Dict]:
+        """Copies the cached tree for key to dest if it was prepared from sha, returning the
+        entry's metadata. Returns None on a cache miss."""
+        meta = self.get_meta(key)
+        if meta is None or meta.get("sha") != sha:
+            return None
+        if dest.exists():
+            shutil.rmtree(str(dest))
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copytree(
+            str(self.entry(key) / self.TREE_DIR), str(dest), copy_function=link_or_copy
+        )
+        return meta
+
+    def store(self, key: str, sha: str, src: Path, **extra: Any) -> None:
+        """Stores the prepared tree at src under key, along with the sha it was prepared from"""
+        entry = self.entry(key)
+        if entry.exists():
+            shutil.rmtree(str(entry))
+        entry.mkdir(parents=True)
+        shutil.copytree(
+            str(src), str(entry / self.TREE_DIR), copy_function=link_or_copy
+        )
+        # the metadata is written last so a partially written entry is never used
+        tmp_meta = entry / (self.META_FILE + ".tmp")
+        with open(tmp_meta, "w") as f:
+            json.dump({"sha": sha, **extra}, f)
+        os.replace(tmp_meta, entry / self.META_FILE)
+
+
+class GitStore:
+    """A directory of sparse git repositories kept between builds, so a repo is updated with an
+    incremental fetch (see scripts/sparse_fetch.sh) instead of being cloned again.
+
+    Attributes:
+        location (Path): The root directory of the store.
+    """
+
+    def __init__(self, location: Path):
+        self.location = Path(location)
+        self.location.mkdir(parents=True, exist_ok=True)
+
+    def __str__(self):
+        return f"GitStore({self.location})"
+
+    def __repr__(self):
+        return self.__str__()
+
+    def repo_dir(self, url: str, name: str) -> Path:
+        """returns where the sparse repository for an import is kept. The imported paths aren't
+        part of the key so changing them updates the sparse checkout in place."""
+        return self.location / cache_key(url=url, name=name)
+
+
+class ConfigCache:
+    """A directory of the parts of imported config files the plugin uses (the nav, with its
+    paths resolved, and edit_uri), so a config file that hasn't changed isn't parsed again.
+
+    Entries are keyed by the hash of the config file's content and the name of the repo,
+    since the nav's paths are resolved relative to the repo's section.
+
+    Attributes:
+        location (Path): The root directory of the cache.
+    """
+
+    def __init__(self, location: Path):
+        self.location = Path(location)
+        self.location.mkdir(parents=True, exist_ok=True)
+
+    def __str__(self):
+        return f"ConfigCache({self.location})"
+
+    def __repr__(self):
+        return self.__str__()
+
+    @staticmethod
+    def key(content: bytes, name: str) -> str:
+        return cache_key(content=hashlib.sha256(content).hexdigest(), name=name)
+
+    def get(self, key: str) -> Optional[Dict]:
+        entry = self.location / f"{key}.json"
+        if not entry.is_file():
+            return None
+        try:
+            with open(entry) as f:
+                return json.load(f)
+        except ValueError:
+            log.warning(f"Multirepo plugin ignoring corrupt cache entry {entry}")
+            return None
+
+    def store(self, key: str, value: Dict) -> None:
+        try:
+            data = json.dumps(value)
+        except (TypeError, ValueError):
+            # e.g., values constructed by yaml tags; the config is just parsed every time
+            return
+        tmp_entry = self.location / f"{key}.json.tmp"
+        tmp_entry.write_text(data)
+        os.replace(tmp_entry, self.location / f"{key}.json")
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Tuple
+
+from .util import log
+
+
+class ImportChanges(NamedTuple):
+    """The src paths (relative to temp_dir, like the imported Files') of the files an import
+    added, changed and removed"""
+
+    added: List[str]
+    changed: List[str]
+    removed: List[str]
+
+    def __bool__(self):
+        return bool(self.added or self.changed or self.removed)
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def iter_imported_files(location: Path) -> Iterator[Tuple[str, str]]:
+    """yields the (src path, absolute path) of every imported file below location. Entries
+    starting with a dot at the top (e.g., the plugin's own state) aren't imported files."""
+    for entry in os.scandir(location):
+        if entry.name.startswith("."):
+            continue
+        if not entry.is_dir():
+            yield entry.name, entry.path
+            continue
+        for root, _, filenames in os.walk(entry.path):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                yield Path(os.path.relpath(path, location)).as_posix(), path
+
+
+class ContentIndex:
+    """The content hash of every file imported into temp_dir, kept between imports so a
+    re-import only touches the files whose content changed.
+
+    Before a re-import, the imported files are set aside. Once the docs are imported, every
+    file whose content didn't change is moved back over its new copy, so it keeps its mtime
+    (e.g., for `mkdocs serve --dirtyreload`), and the files that were added, changed and
+    removed are reported.
+
+    Attributes:
+        temp_dir (Path): Where docs are imported.
+        index_file (Path): The JSON file the hashes are kept in.
+        hashes (dict): The content hash of each imported file, by its src path.
+    """
+
+    def __init__(self, temp_dir: Path, index_file: Path):
+        self.temp_dir = temp_dir
+        self.index_file = index_file
+        self.hashes: Dict[str, str] = self.load()
+
+    @property
+    def previous_dir(self) -> Path:
+        """where the files of the previous import are set aside, which is in temp_dir so
+        they're moved rather than copied"""
+        return self.temp_dir / ".multirepo" / "previous_import"
+
+    def load(self) -> Dict[str, str]:
+        if not self.index_file.is_file():
+            return {}
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except ValueError:
+            log.warning(f"Multirepo plugin ignoring corrupt {self.index_file}")
+            return {}
+
+    def save(self) -> None:
+        self.index_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.index_file, "w") as f:
+            json.dump(self.hashes, f, indent=2, sort_keys=True)
+
+    def set_aside(self) -> None:
+        """moves the files of the previous import out of the way of the next one"""
+        if self.previous_dir.is_dir():
+            shutil.rmtree(str(self.previous_dir))
+        self.previous_dir.mkdir(parents=True)
+        if not self.temp_dir.is_dir():
+            return
+        for entry in os.scandir(self.temp_dir):
+            if not entry.name.startswith("."):
+                os.replace(entry.path, str(self.previous_dir / entry.name))
+
+    def restore(self) -> ImportChanges:
+        """Moves the files that didn't change back from the previous import, returning what
+        changed, and records the hashes of the new import"""
+        hashes: Dict[str, str] = {}
+        added, changed = [], []
+        for src_path, path in iter_imported_files(self.temp_dir):
+            hashes[src_path] = file_hash(path)
+            previous_hash = self.hashes.get(src_path)
+            previous_path = self.previous_dir / src_path
+            if previous_hash is None or not previous_path.is_file():
+                added.append(src_path)
+            elif previous_hash != hashes[src_path]:
+                changed.append(src_path)
+            else:
+                os.replace(str(previous_path), path)
+        removed = sorted(set(self.hashes) - set(hashes))
+        self.hashes = hashes
+        self.save()
+        shutil.rmtree(str(self.previous_dir), ignore_errors=True)
+        return ImportChanges(sorted(added), sorted(changed), removed)
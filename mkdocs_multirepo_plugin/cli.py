@@ -0,0 +1,252 @@
+"""Manages the multirepo lock file, prefetched imports, import bundles and clone filters
+of a site.
+
+    $ mkdocs-multirepo update
+    $ mkdocs-multirepo update -f docs-site/mkdocs.yml
+    $ mkdocs-multirepo prefetch
+    $ mkdocs-multirepo bundle --shard 2/4 -o bundles
+    $ mkdocs-multirepo benchmark-strategies --record
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from mkdocs.config import load_config
+from mkdocs.utils import yaml_load
+
+from .backends import DEFAULT_BACKEND
+from .bundle import bundle_file, parse_shard, write_bundle
+from .lock import LOCK_FILE, LockFile, resolve_refs
+from .plugin import CLONE_FILTERS_FILE, PREFETCH_DIR, MultirepoConfig, MultirepoPlugin
+from .structure import time_clone_filters
+from .util import asyncio_run
+
+
+def load_site(config_file: str) -> Tuple[MultirepoPlugin, MultirepoConfig, dict]:
+    """loads a site's config, returning its multirepo plugin and the plugin's config"""
+    config = load_config(config_file)
+    plugin = config["plugins"].get("multirepo")
+    if plugin is None:
+        raise SystemExit(f"{config_file} doesn't use the multirepo plugin")
+    multi_config = plugin.parse_config()
+    if multi_config.imported_repo:
+        raise SystemExit(
+            f"{config_file} is an imported repo, which doesn't import docs"
+        )
+    plugin.temp_dir = Path(config["docs_dir"]).parent / multi_config.temp_dir
+    return plugin, multi_config, config
+
+
+def read_site(config_file: str) -> Tuple[MultirepoPlugin, MultirepoConfig, dict]:
+    """Reads the parts of a site's config that docs are imported with, returning a new
+    multirepo plugin, its config and those parts. The rest of the config isn't validated,
+    so the docs can be imported before the site's theme and other plugins are installed."""
+    with open(config_file, "rb") as f:
+        site_config = yaml_load(f)
+    plugins = site_config.get("plugins") or []
+    if isinstance(plugins, dict):
+        plugins = [{name: options} for name, options in plugins.items()]
+    options = None
+    for plugin_entry in plugins:
+        if plugin_entry == "multirepo":
+            options = {}
+        elif isinstance(plugin_entry, dict) and "multirepo" in plugin_entry:
+            options = plugin_entry["multirepo"] or {}
+    if options is None:
+        raise SystemExit(f"{config_file} doesn't use the multirepo plugin")
+    plugin = MultirepoPlugin()
+    errors, _ = plugin.load_config(options, config_file)
+    if errors:
+        raise SystemExit(
+            "\n".join(f"plugins.multirepo.{key}: {error}" for key, error in errors)
+        )
+    multi_config = plugin.parse_config()
+    if multi_config.imported_repo:
+        raise SystemExit(
+            f"{config_file} is an imported repo, which doesn't import docs"
+        )
+    site_dir = Path(config_file).resolve().parent
+    plugin.temp_dir = site_dir / multi_config.temp_dir
+    config = {
+        "config_file_path": str(Path(config_file).resolve()),
+        "docs_dir": str(site_dir / site_config.get("docs_dir", "docs")),
+        "nav": site_config.get("nav"),
+        "edit_uri": site_config.get("edit_uri"),
+        "repo_url": site_config.get("repo_url"),
+    }
+    return plugin, multi_config, config
+
+
+def update(args: argparse.Namespace) -> int:
+    """resolves the branch of every import and records the commits in the lock file"""
+    plugin, multi_config, config = load_site(args.config_file)
+    lock_file = plugin.lock_file_path(config, multi_config) or (
+        Path(config["docs_dir"]).parent / LOCK_FILE
+    )
+    repos: List = [
+        repo
+        for repo in plugin.configured_repos(config, multi_config)
+        if repo.backend != "local"
+    ]
+    lock = LockFile.load(lock_file)
+    # nested imports are refreshed by the url and branch their entries were recorded for
+    repos += lock.locked_imports({repo.name for repo in repos})
+    shas = asyncio_run(resolve_refs(repos, multi_config.max_concurrency))
+    changed, unresolved = lock.update(repos, shas)
+    for name in changed:
+        entry = lock.entries[name]
+        print(f"{name}: {entry['branch']} -> {entry['sha']}")
+    for name in unresolved:
+        print(f"{name}: couldn't resolve the branch", file=sys.stderr)
+    if not lock.save():
+        print(f"{lock_file} is up to date")
+    return 1 if unresolved else 0
+
+
+def bundle(args: argparse.Namespace) -> int:
+    """imports one shard of the site's imports and writes their docs to a bundle"""
+    try:
+        shard, shards = parse_shard(args.shard)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    plugin, multi_config, config = read_site(args.config_file)
+    if multi_config.bundles:
+        raise SystemExit(f"{args.config_file} imports its docs from bundles")
+    plugin.shard = (shard, shards)
+    # lazily imported docs aren't on disk to be bundled
+    plugin.eager = True
+    try:
+        plugin.on_config(config)
+        plugin.join_docs_import()
+        repos = list(plugin.repos.values())
+        path = bundle_file(Path(args.output), shard, shards)
+        files = write_bundle(path, plugin.temp_dir, repos, multi_config.keep_docs_dir)
+    finally:
+        if multi_config.cleanup and plugin.temp_dir.is_dir():
+            plugin.cleanup()
+    print(f"{path}: {len(repos)} imports, {files} files")
+    return 0
+
+
+def prefetch(args: argparse.Namespace) -> int:
+    """imports the site's docs into the import cache, where builds restore them from"""
+    plugin, multi_config, config = read_site(args.config_file)
+    if multi_config.bundles:
+        raise SystemExit(f"{args.config_file} imports its docs from bundles")
+    site_dir = Path(config["docs_dir"]).parent
+    if not multi_config.cache_dir:
+        # builds use this directory as their cache once it exists
+        (site_dir / PREFETCH_DIR).mkdir(exist_ok=True)
+    # lazily imported docs aren't cached
+    plugin.eager = True
+    try:
+        plugin.on_config(config)
+        plugin.join_docs_import()
+    finally:
+        if plugin.temp_dir is not None and plugin.temp_dir.is_dir():
+            plugin.cleanup()
+    print(f"{plugin.cache.location}: {len(plugin.repos)} imports")
+    return 0
+
+
+def benchmark_strategies(args: argparse.Namespace) -> int:
+    """times fetching the site's imports, or a given repo, with each clone filter"""
+    if args.runs < 1:
+        raise SystemExit("--runs has to be at least 1")
+    site_dir = Path(args.config_file).resolve().parent
+    targets: Dict[str, Tuple[Optional[str], List[str]]] = {}
+    if args.url:
+        targets[args.url] = (args.branch, args.paths or ["docs/*", "mkdocs.yml"])
+    else:
+        plugin, multi_config, config = read_site(args.config_file)
+        for repo in plugin.configured_repos(config, multi_config):
+            # the other backends don't fetch with a clone filter
+            if (repo.backend or DEFAULT_BACKEND) in ("git", "script"):
+                paths = repo.paths or [repo.docs_dir, repo.config] + repo.extra_imports
+                targets.setdefault(repo.url, (repo.branch, paths))
+    fastest: Dict[str, str] = {}
+    for url, (branch, paths) in targets.items():
+        medians = asyncio_run(time_clone_filters(url, branch, paths, args.runs))
+        timed = {f: seconds for f, seconds in medians.items() if seconds is not None}
+        if timed:
+            fastest[url] = min(timed, key=timed.get)
+        results = ", ".join(
+            f"{f} {'failed' if seconds is None else f'{seconds:.2f}s'}"
+            for f, seconds in medians.items()
+        )
+        print(f"{url}: {results} -> {fastest.get(url, 'no filter worked')}")
+    if args.record and fastest:
+        filters_file = site_dir / CLONE_FILTERS_FILE
+        recorded = MultirepoPlugin.load_clone_filters(filters_file)
+        recorded.update(fastest)
+        with open(filters_file, "w") as f:
+            json.dump(recorded, f, indent=2, sort_keys=True)
+        print(f"recorded the fastest clone filters in {filters_file}")
+    return 0 if len(fastest) == len(targets) else 1
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="mkdocs-multirepo", description=__doc__.splitlines()[0]
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    update_parser = subparsers.add_parser(
+        "update", help="lock every import to the commit its branch points to"
+    )
+    update_parser.add_argument(
+        "-f", "--config-file", default="mkdocs.yml", help="the site's mkdocs.yml"
+    )
+    update_parser.set_defaults(func=update)
+    prefetch_parser = subparsers.add_parser(
+        "prefetch",
+        help="import the docs into the import cache, so builds don't fetch them",
+    )
+    prefetch_parser.add_argument(
+        "-f", "--config-file", default="mkdocs.yml", help="the site's mkdocs.yml"
+    )
+    prefetch_parser.set_defaults(func=prefetch)
+    bundle_parser = subparsers.add_parser(
+        "bundle",
+        help="import one shard of the imports into a bundle that builds can use",
+    )
+    bundle_parser.add_argument(
+        "-f", "--config-file", default="mkdocs.yml", help="the site's mkdocs.yml"
+    )
+    bundle_parser.add_argument(
+        "--shard", default="1/1", help="the shard to import, e.g., 2/4 (default: 1/1)"
+    )
+    bundle_parser.add_argument(
+        "-o", "--output", default="bundles", help="the directory to write the bundle to"
+    )
+    bundle_parser.set_defaults(func=bundle)
+    benchmark_parser = subparsers.add_parser(
+        "benchmark-strategies",
+        help="time fetching each import with each clone filter",
+    )
+    benchmark_parser.add_argument(
+        "-f", "--config-file", default="mkdocs.yml", help="the site's mkdocs.yml"
+    )
+    benchmark_parser.add_argument(
+        "--url", help="a repo to benchmark instead of the site's imports"
+    )
+    benchmark_parser.add_argument("--branch", help="the branch of --url to fetch")
+    benchmark_parser.add_argument(
+        "--paths", nargs="+", help="the paths of --url to fetch (default: docs)"
+    )
+    benchmark_parser.add_argument(
+        "--runs", type=int, default=3, help="how many times each filter is timed"
+    )
+    benchmark_parser.add_argument(
+        "--record",
+        action="store_true",
+        help=f"record the fastest filters in {CLONE_FILTERS_FILE}, which builds use",
+    )
+    benchmark_parser.set_defaults(func=benchmark_strategies)
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
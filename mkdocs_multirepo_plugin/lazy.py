@@ -0,0 +1,215 @@
+import os
+import subprocess
+from pathlib import Path, PurePosixPath
+from typing import Dict, List, Optional, Set, Tuple
+
+from mkdocs.structure.files import File
+
+from .util import GitException, git_capabilities, git_config_args
+
+# how many blobs are read from git at once
+BATCH_SIZE = 200
+
+
+def run_git(
+    arguments: List[str],
+    cwd: Path,
+    config: Optional[Dict[str, str]] = None,
+    input: Optional[bytes] = None,
+) -> bytes:
+    """executes git synchronously, for the hooks MkDocs reads files in"""
+    config_args, config_env = git_config_args(config or {})
+    process = subprocess.run(
+        ["git", *config_args, *arguments],
+        cwd=cwd,
+        env={**os.environ, **config_env} if config_env else None,
+        input=input,
+        capture_output=True,
+    )
+    if process.returncode != 0:
+        raise GitException(f"\ngit {arguments[0]} failed:\n{process.stderr.decode()}\n")
+    return process.stdout
+
+
+def parse_ls_tree(output: str) -> List[Tuple[str, str]]:
+    """returns the (path, blob oid) of every file in `git ls-tree -r -z` output"""
+    files = []
+    for entry in output.split("\0"):
+        if not entry:
+            continue
+        info, _, path = entry.partition("\t")
+        _, object_type, oid = info.split()
+        if object_type == "blob":
+            files.append((path, oid))
+    return files
+
+
+def parse_cat_file(output: bytes) -> Dict[str, bytes]:
+    """returns the content of every blob in `git cat-file --batch` output, by its oid"""
+    contents = {}
+    position = 0
+    while position < len(output):
+        header_end = output.index(b"\n", position)
+        oid, object_type, size = output[position:header_end].decode().split()
+        start = header_end + 1
+        contents[oid] = output[start : start + int(size)]
+        # the content is followed by a newline
+        position = start + int(size) + 1
+    return contents
+
+
+class LazyTree:
+    """The files of a commit that was fetched without its blobs (when the server allows it)
+    and isn't checked out. Files are read from git when MkDocs needs them, a batch at a time:
+    the blobs of the file and of the next files of the same kind (pages or other files) are
+    fetched together, so a tree of thousands of pages doesn't cost thousands of fetches.
+
+    Attributes:
+        location (Path): The repository the commit was fetched into.
+        files (dict): The blob oid of each file, by its path in the imported docs.
+        config (dict): The git config the repository's remote is fetched with.
+        promisor (bool): If True, blobs are missing until they're fetched from the remote.
+        batch_size (int): How many files are read at once.
+    """
+
+    def __init__(
+        self,
+        location: Path,
+        files: Dict[str, str],
+        config: Optional[Dict[str, str]] = None,
+        promisor: bool = False,
+        batch_size: int = BATCH_SIZE,
+    ):
+        self.location = location
+        self.files = files
+        self.config = config or {}
+        self.promisor = promisor
+        self.batch_size = batch_size
+        self.contents: Dict[str, bytes] = {}
+        self._read: Set[str] = set()
+        self._order: Optional[List[str]] = None
+        self._dirs: Optional[Dict[str, Tuple[List[str], Set[str]]]] = None
+
+    def __str__(self):
+        return f"LazyTree({self.location}, {len(self.files)} files)"
+
+    def __repr__(self):
+        return self.__str__()
+
+    def move_up(self, docs_dir: str) -> None:
+        """Moves the files in docs_dir up, like move_docs_up does with a checkout. Files in
+        docs_dir win over files with the same path outside it."""
+        prefix = f"{docs_dir}/"
+        moved = {
+            path[len(prefix) :]: oid
+            for path, oid in self.files.items()
+            if path.startswith(prefix)
+        }
+        self.files = {
+            path: oid
+            for path, oid in self.files.items()
+            if not path.startswith(prefix) and path not in moved
+        }
+        self.files.update(moved)
+        self._order = self._dirs = None
+
+    def list_dir(self, directory: str) -> Tuple[List[str], List[str]]:
+        """returns the names of the files and directories in a directory of the tree, like
+        os.scandir would"""
+        if self._dirs is None:
+            self._dirs = {}
+            for path in self.files:
+                parts = PurePosixPath(path).parts
+                for depth in range(len(parts)):
+                    parent = "/".join(parts[:depth])
+                    filenames, dirnames = self._dirs.setdefault(parent, ([], set()))
+                    if depth == len(parts) - 1:
+                        filenames.append(parts[depth])
+                    else:
+                        dirnames.add(parts[depth])
+        filenames, dirnames = self._dirs.get(directory.replace(os.sep, "/"), ([], []))
+        return list(filenames), list(dirnames)
+
+    def read(self, path: str) -> bytes:
+        """returns the content of the file at path, reading its batch if it isn't read yet"""
+        if path not in self.contents:
+            self.read_batch(path)
+        # a file is only read once per build, so its content isn't kept around
+        self._read.add(path)
+        return self.contents.pop(path)
+
+    def read_batch(self, path: str) -> None:
+        if self._order is None:
+            self._order = sorted(self.files)
+        is_page = path.endswith(".md")
+        batch = [path]
+        # MkDocs doesn't read files in sorted order (e.g., index.md comes first), so the
+        # batch wraps around to the unread files before path
+        index = self._order.index(path)
+        for other in self._order[index + 1 :] + self._order[:index]:
+            if len(batch) >= self.batch_size:
+                break
+            if other.endswith(".md") != is_page or other in self._read:
+                continue
+            if other not in self.contents:
+                batch.append(other)
+        oids = sorted({self.files[p] for p in batch})
+        if self.promisor and git_capabilities().fetch_stdin:
+            # the same request git makes for a missing blob, for the whole batch at once
+            run_git(
+                [
+                    "fetch",
+                    "-q",
+                    "--no-tags",
+                    "--no-write-fetch-head",
+                    "--recurse-submodules=no",
+                    "--filter=blob:none",
+                    "--stdin",
+                    "origin",
+                ],
+                self.location,
+                {**self.config, "fetch.negotiationAlgorithm": "noop"},
+                "".join(f"{oid}\n" for oid in oids).encode(),
+            )
+        contents = parse_cat_file(
+            run_git(
+                ["cat-file", "--batch"],
+                self.location,
+                self.config,
+                "".join(f"{oid}\n" for oid in oids).encode(),
+            )
+        )
+        for p in batch:
+            self.contents[p] = contents[self.files[p]]
+
+
+class LazyFile(File):
+    """A File of an imported repo whose content is read from a LazyTree, since it isn't
+    checked out. Pages are read by MkDocs through the plugin's on_page_read_source and other
+    files are written to the site when they're copied."""
+
+    def __init__(
+        self,
+        path: str,
+        src_dir: str,
+        dest_dir: str,
+        use_directory_urls: bool,
+        tree: LazyTree,
+        tree_path: str,
+    ):
+        super().__init__(path, src_dir, dest_dir, use_directory_urls)
+        self.tree = tree
+        self.tree_path = tree_path
+
+    def read(self) -> bytes:
+        return self.tree.read(self.tree_path)
+
+    def is_modified(self) -> bool:
+        # there's no source file whose mtime could be compared
+        return True
+
+    def copy_file(self, dirty: bool = False) -> None:
+        output_path = self.abs_dest_path
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, "wb") as f:
+            f.write(self.read())
@@ -0,0 +1,174 @@
+import asyncio
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from .util import ImportDocsException, git_ls_remote_refs, log
+
+LOCK_FILE = "multirepo.lock"
+LOCK_VERSION = 1
+
+
+def tree_hash(location: Path, exclude: Iterable[Path] = ()) -> str:
+    """returns a hash of the paths and contents of the files below location, apart from
+    those in the exclude directories"""
+    digest = hashlib.sha256()
+    files: List[Tuple[str, str]] = []
+    exclude = {os.path.normpath(path) for path in exclude}
+    for root, dirnames, filenames in os.walk(location):
+        dirnames[:] = [
+            dirname
+            for dirname in dirnames
+            if os.path.normpath(os.path.join(root, dirname)) not in exclude
+        ]
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            files.append((Path(os.path.relpath(path, location)).as_posix(), path))
+    for relative_path, path in sorted(files):
+        with open(path, "rb") as f:
+            content = hashlib.sha256(f.read()).hexdigest()
+        digest.update(f"{relative_path}\0{content}\n".encode())
+    return digest.hexdigest()
+
+
+async def resolve_refs(
+    repos: List, max_concurrency: Optional[int] = None
+) -> Dict[Tuple[str, str], Optional[str]]:
+    """Resolves the branch of every repo to a commit SHA, keyed by (url, branch). Each url
+    is queried once, for all of its branches, and the urls are queried concurrently."""
+    refs: Dict[str, set] = {}
+    for repo in repos:
+        refs.setdefault(repo.url, set()).add(repo.branch or "HEAD")
+    semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+
+    async def ls_remote(url: str) -> Dict[str, Optional[str]]:
+        if semaphore is None:
+            return await git_ls_remote_refs(url, sorted(refs[url]))
+        async with semaphore:
+            return await git_ls_remote_refs(url, sorted(refs[url]))
+
+    urls = list(refs)
+    results = await asyncio.gather(*[ls_remote(url) for url in urls])
+    return {
+        (url, ref): sha for url, shas in zip(urls, results) for ref, sha in shas.items()
+    }
+
+
+class LockedImport(NamedTuple):
+    """An import only known by its lock file entry, like a nested import, which is only
+    found by importing the repo that contains it"""
+
+    name: str
+    url: str
+    branch: Optional[str]
+
+
+class LockFile:
+    """Records the commit every import was built from, along with a hash of its imported
+    tree, so builds can be reproduced without asking the remotes where their branches are.
+
+    Entries are keyed by the repo's name (its section path) and are only used while the
+    import's url and branch are the ones they were recorded for.
+
+    Attributes:
+        path (Path): The lock file.
+        entries (dict): The url, branch, sha and tree hash recorded for each import.
+    """
+
+    def __init__(self, path: Path, entries: Optional[Dict[str, Dict]] = None):
+        self.path = Path(path)
+        self.entries: Dict[str, Dict] = entries or {}
+
+    def __str__(self):
+        return f"LockFile({self.path})"
+
+    def __repr__(self):
+        return self.__str__()
+
+    @classmethod
+    def load(cls, path: Path) -> "LockFile":
+        """reads the lock file at path, which doesn't have to exist yet"""
+        path = Path(path)
+        if not path.is_file():
+            return cls(path)
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except ValueError:
+            raise ImportDocsException(f"{path} isn't a valid lock file")
+        if data.get("version") != LOCK_VERSION:
+            raise ImportDocsException(
+                f"{path} has lock file version {data.get('version')}, "
+                f"but version {LOCK_VERSION} is supported"
+            )
+        return cls(path, data.get("imports", {}))
+
+    @staticmethod
+    def matches(entry: Optional[Dict], repo) -> bool:
+        return entry is not None and (entry["url"], entry["branch"]) == (
+            repo.url,
+            repo.branch,
+        )
+
+    def entry(self, repo) -> Optional[Dict]:
+        """returns the repo's entry if it was recorded for the repo's url and branch"""
+        entry = self.entries.get(repo.name)
+        return entry if self.matches(entry, repo) else None
+
+    def set(self, repo, sha: str, tree: Optional[str] = None) -> None:
+        self.entries[repo.name] = {
+            "url": repo.url,
+            "branch": repo.branch,
+            "sha": sha,
+            "tree": tree,
+        }
+
+    def update(
+        self, repos: List, shas: Dict[Tuple[str, str], Optional[str]]
+    ) -> Tuple[List[str], List[str]]:
+        """Updates the entries of the repos to their resolved SHAs, returning the names of
+        the imports that changed and of those that couldn't be resolved (whose entries are
+        kept if they're still for the import's url and branch)"""
+        changed, unresolved = [], []
+        for repo in repos:
+            sha = shas.get((repo.url, repo.branch or "HEAD"))
+            old = self.entry(repo)
+            if old is None:
+                self.entries.pop(repo.name, None)
+            if sha is None:
+                unresolved.append(repo.name)
+                continue
+            unchanged = old is not None and old["sha"] == sha
+            # the tree hash of a new sha is filled in by the next build that imports it
+            self.set(repo, sha, old["tree"] if unchanged else None)
+            if not unchanged:
+                changed.append(repo.name)
+        return changed, unresolved
+
+    def locked_imports(self, exclude: Set[str]) -> List[LockedImport]:
+        """returns the imports of the entries that aren't for one of the exclude names"""
+        return [
+            LockedImport(name, entry["url"], entry["branch"])
+            for name, entry in sorted(self.entries.items())
+            if name not in exclude
+        ]
+
+    def prune(self, names: Set[str]) -> None:
+        """removes the entries of imports that aren't in names anymore"""
+        for name in set(self.entries) - names:
+            del self.entries[name]
+
+    def save(self) -> bool:
+        """writes the lock file if its contents changed, returning True if it was written"""
+        data = {"version": LOCK_VERSION, "imports": self.entries}
+        content = json.dumps(data, indent=2, sort_keys=True) + "\n"
+        if self.path.is_file() and self.path.read_text() == content:
+            return False
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        tmp_path.write_text(content)
+        os.replace(tmp_path, self.path)
+        log.info(f"Multirepo plugin updated {self.path}")
+        return True
@@ -1,38 +1,66 @@
+import hashlib
+import json
+import os
 import shutil
 import tempfile
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from copy import deepcopy
 from dataclasses import _MISSING_TYPE, dataclass, field, fields
+from functools import partial
+from itertools import chain
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Set, Tuple
 
 import dacite as dc
 from mkdocs.config import Config, config_options
 from mkdocs.plugins import BasePlugin
-from mkdocs.structure.files import File, Files
+from mkdocs.structure.files import Files
 from mkdocs.theme import Theme
 from slugify import slugify
-from typing_inspect import get_origin
+from typing_inspect import get_args, get_origin, is_optional_type
 
+from .backends import (
+    DEFAULT_BACKEND,
+    DEFAULT_CLONE_FILTER,
+    SharedObjectStores,
+    select_backend,
+)
+from .bundle import BundleSet
+from .cache import ConfigCache, GitStore, ImportCache
+from .changes import ContentIndex, ImportChanges
+from .lazy import LazyFile
+from .lock import LOCK_FILE, LockFile, resolve_refs, tree_hash
+from .scheduler import ImportScheduler
 from .structure import (
     DocsRepo,
+    ImportGraph,
+    ImportMethod,
+    NavImport,
     Repo,
-    batch_execute,
-    batch_import,
-    get_files,
+    alias_files,
+    dedupe_repos,
+    execute_plan,
     get_import_stmts,
+    get_repos_files,
     is_yaml_file,
+    link_aliases,
     parse_repo_url,
     resolve_nav_paths,
 )
+from .timing import format_timing_table, timing_report, write_timing_report
 from .util import ImportDocsException, ImportSyntaxError, asyncio_run, is_windows, log
 
 if is_windows():
     # allow for ASCII escape codes to be used in terminal
-    import os
-
     os.system("")
 
 IMPORT_STATEMENT = "!import"
+# where `mkdocs-multirepo prefetch` caches imports when there's no cache_dir
+PREFETCH_DIR = ".multirepo-prefetch"
+# where `mkdocs-multirepo benchmark-strategies` records the fastest clone filter of urls
+CLONE_FILTERS_FILE = "multirepo-clone-filters.json"
 DEFAULT_BRANCH = "master"
 
 
@@ -45,6 +73,8 @@ class RepoConfig:
     section: str
     import_url: str
     section_path: Optional[str] = None
+    backend: Optional[str] = None
+    clone_filter: Optional[str] = None
 
 
 @dataclass
@@ -52,6 +82,8 @@ class NavRepoConfig:
     name: str
     import_url: str
     imports: List[str] = field(default_factory=list)
+    backend: Optional[str] = None
+    clone_filter: Optional[str] = None
 
 
 @dataclass
@@ -68,6 +100,39 @@ class MultirepoConfig:
     custom_dir: Optional[str] = None
     yml_file: Optional[str] = None
     branch: Optional[str] = None
+    cache_dir: Optional[str] = None
+    incremental: bool = False
+    serve_refresh_interval: Optional[int] = None
+    max_concurrency: Optional[int] = None
+    fetch_backend: str = DEFAULT_BACKEND
+    host_concurrency: Dict[str, int] = field(default_factory=dict)
+    timing_report: Optional[str] = None
+    repo_timeout: Optional[int] = None
+    import_timeout: Optional[int] = None
+    lock_file: Optional[str] = None
+    locked: bool = False
+    two_stage_import: bool = False
+    lazy_import: bool = False
+    track_changes: bool = False
+    bundles: Optional[str] = None
+    clone_filter: str = DEFAULT_CLONE_FILTER
+
+
+@dataclass
+class ImportState:
+    """The result of importing docs, kept across `mkdocs serve` rebuilds"""
+
+    fingerprint: str
+    imported_at: float
+    refresh_mtime: Optional[float]
+    nav: Optional[List]
+
+
+def config_option_type(field_type) -> type:
+    """returns the type MkDocs should validate a MultirepoConfig field's value against"""
+    if is_optional_type(field_type):
+        (field_type,) = [t for t in get_args(field_type) if t is not type(None)]
+    return get_origin(field_type) or field_type
 
 
 class MultirepoPlugin(BasePlugin):
@@ -76,7 +141,7 @@ class MultirepoPlugin(BasePlugin):
         (
             f.name,
             config_options.Type(
-                get_origin(f.type) or f.type,
+                config_option_type(f.type),
                 default=f.default
                 if not isinstance(f.default, _MISSING_TYPE)
                 else f.default_factory(),
@@ -89,6 +154,34 @@ class MultirepoPlugin(BasePlugin):
         self.temp_dir: Path = None
         self.repos: Dict[str, DocsRepo] = {}
         self.nav_repos: Dict[str, DocsRepo] = {}
+        self.cache: Optional[ImportCache] = None
+        self.git_store: Optional[GitStore] = None
+        self.config_cache: Optional[ConfigCache] = None
+        self.scheduler: Optional[ImportScheduler] = None
+        self.object_stores: Optional[SharedObjectStores] = None
+        self.shared_urls: Set[str] = set()
+        # when import_timeout is up, as time.monotonic() returns it
+        self.import_deadline: Optional[float] = None
+        self.lock: Optional[LockFile] = None
+        self.locked: bool = False
+        # the second stage of a two stage import, running in the background
+        self.docs_import: Optional[Future] = None
+        self.content_index: Optional[ContentIndex] = None
+        # what the last import added, changed and removed, when track_changes is on, or
+        # what syncing the local imports did
+        self.import_changes: Optional[ImportChanges] = None
+        # when set, only this shard (i of n) of the imports is imported (see cli.bundle)
+        self.shard: Optional[Tuple[int, int]] = None
+        # if True, docs are checked out even with lazy_import, so they can be bundled or
+        # cached (see cli)
+        self.eager: bool = False
+        self.bundles: Optional[BundleSet] = None
+        # the clone filter recorded for each url (see CLONE_FILTERS_FILE)
+        self.clone_filters: Dict[str, str] = {}
+        # the files on_files added for each imported repo
+        self.imported_files: List[Tuple[DocsRepo, Files]] = []
+        self.serve_mode: bool = False
+        self.import_state: Optional[ImportState] = None
 
     def derive_config_edit_uri(
         self, repo_name: str, repo_url: str, config: Config
@@ -123,7 +216,17 @@ class MultirepoPlugin(BasePlugin):
             "importee", self.config.get("url"), self.config.get("branch"), temp_dir
         )
         parent_repo.temp_dir.mkdir(exist_ok=True)
-        asyncio_run(parent_repo.sparse_clone(self.config.get("paths")))
+        asyncio_run(
+            execute_plan(
+                [
+                    (
+                        parent_repo,
+                        partial(Repo.sparse_clone, paths=self.config.get("paths")),
+                    )
+                ],
+                timeout=self.config.get("import_timeout"),
+            )
+        )
         shutil.copytree(
             str(parent_repo.location / "docs"),
             str(temp_dir / "docs"),
@@ -171,39 +274,20 @@ class MultirepoPlugin(BasePlugin):
         config["dev_addr"] = (addr.host, addr.port)
         return config, temp_dir
 
-    def handle_nav_import(self, config: Config) -> Config:
-        """Imports documentation in other repos based on nav configuration"""
-        keep_docs_dir: bool = self.config.get("keep_docs_dir")
-        nav: List[Dict] = config.get("nav")
+    def nav_imports(self, nav: List[Dict]) -> List[NavImport]:
+        """returns the import statements in nav, whose repos use the configured backend"""
         nav_imports = get_import_stmts(nav, self.temp_dir, DEFAULT_BRANCH)
-        repos: List[DocsRepo] = [nav_import.repo for nav_import in nav_imports]
-        asyncio_run(batch_import(repos, keep_docs_dir=keep_docs_dir))
-        need_to_derive_edit_uris = config.get("edit_uri") is None
-
-        for nav_import, repo in zip(nav_imports, repos):
-            repo_config = repo.load_config()
-            if not repo_config.get("nav"):
-                raise ImportDocsException(
-                    f"{repo.name}'s {repo.config} file doesn't have a nav section"
-                )
-            # mkdocs config values edit_uri and repo_url aren't set
-            if need_to_derive_edit_uris:
-                derived_edit_uri = self.derive_config_edit_uri(
-                    repo.name, repo.url, config
-                )
-            repo.set_edit_uri(
-                repo_config.get("edit_uri")
-                or config.get("edit_uri")
-                or derived_edit_uri
+        for nav_import in nav_imports:
+            repo = nav_import.repo
+            repo.backend = select_backend(
+                repo.url, repo.backend, self.config.get("fetch_backend")
             )
-            # Change the section title value from '!import {url}' to the imported repo's nav
-            # Note: this changes config.nav in place
-            nav_import.set_section_value(repo_config.get("nav"))
-            self.repos[repo.name] = repo
-        return config
+        return nav_imports
 
-    def handle_repos_import(self, config: Config, repos: List[RepoConfig]) -> Config:
-        """Imports documentation in other repos based on repos configuration"""
+    def repos_from_config(
+        self, config: Config, repos: List[RepoConfig]
+    ) -> List[DocsRepo]:
+        """returns a DocsRepo for each entry of the repos configuration"""
         need_to_derive_edit_uris: bool = config.get("edit_uri") is None
         docs_repo_objs: List[DocsRepo] = []
         for repo in repos:
@@ -233,16 +317,20 @@ class MultirepoPlugin(BasePlugin):
                     multi_docs=bool(import_stmt.get("multi_docs", False)),
                     extra_imports=import_stmt.get("extra_imports", []),
                     keep_docs_dir=import_stmt.get("keep_docs_dir"),
+                    clone_filter=import_stmt.get("clone_filter") or repo.clone_filter,
+                    backend=select_backend(
+                        import_stmt.get("url"),
+                        import_stmt.get("backend") or repo.backend,
+                        self.config.get("fetch_backend"),
+                    ),
                 )
             )
-        asyncio_run(batch_import(docs_repo_objs))
-        for dr in docs_repo_objs:
-            self.repos[dr.name] = dr
-        return config
+        return docs_repo_objs
 
-    def handle_nav_repos_import(
+    def nav_repos_from_config(
         self, config: Config, nav_repos: List[NavRepoConfig]
-    ) -> Config:
+    ) -> List[DocsRepo]:
+        """returns a DocsRepo for each entry of the nav_repos configuration"""
         need_to_derive_edit_uris = config.get("edit_uri") is None
         docs_repo_objs: List[DocsRepo] = []
         for nr in nav_repos:
@@ -259,20 +347,516 @@ class MultirepoPlugin(BasePlugin):
                 temp_dir=self.temp_dir,
                 branch=import_stmt.get("branch", DEFAULT_BRANCH),
                 paths=nr.imports,
+                clone_filter=import_stmt.get("clone_filter") or nr.clone_filter,
+                backend=select_backend(
+                    import_stmt.get("url"),
+                    import_stmt.get("backend") or nr.backend,
+                    self.config.get("fetch_backend"),
+                ),
                 edit_uri=import_stmt.get("edit_uri")
                 or config.get("edit_uri")
                 or derived_edit_uri,
             )
+            docs_repo_objs.append(repo)
+        return docs_repo_objs
+
+    def configured_repos(
+        self, config: Config, multi_config: MultirepoConfig
+    ) -> List[DocsRepo]:
+        """returns the repos import_docs imports, without importing them"""
+        # nav takes precedence over repos
+        if config.get("nav"):
+            nav_imports = self.nav_imports(deepcopy(config.get("nav")))
+            return [
+                nav_import.repo for nav_import in nav_imports
+            ] + self.nav_repos_from_config(config, multi_config.nav_repos)
+        return self.repos_from_config(config, multi_config.repos)
+
+    @property
+    def lazy_import(self) -> bool:
+        return bool(self.config.get("lazy_import")) and not self.eager
+
+    def repos_plan(
+        self, nav_repos: List[DocsRepo], repos: List[DocsRepo]
+    ) -> List[Tuple[Repo, ImportMethod]]:
+        """returns the plan to import the nav_repos and the repos"""
+        if self.bundles is not None:
+            return [
+                (repo, self.bundles.restore)
+                for repo in dedupe_repos(nav_repos) + dedupe_repos(repos)
+            ]
+        import_paths = partial(
+            Repo.import_paths, cache=self.cache, git_store=self.git_store
+        )
+        import_repo = partial(
+            DocsRepo.import_docs,
+            cache=self.cache,
+            git_store=self.git_store,
+            lazy=self.lazy_import,
+        )
+        # identical imports are only imported once
+        return [(repo, import_paths) for repo in dedupe_repos(nav_repos)] + [
+            (repo, import_repo) for repo in dedupe_repos(repos)
+        ]
+
+    def resolve_clone_filters(self, repos: List[DocsRepo]) -> None:
+        """gives every repo without a clone filter of its own the one recorded for its url,
+        or else the clone_filter setting"""
+        for repo in repos:
+            repo.clone_filter = (
+                repo.clone_filter
+                or self.clone_filters.get(repo.url)
+                or self.config.get("clone_filter")
+            )
+
+    @staticmethod
+    def load_clone_filters(path: Path) -> Dict[str, str]:
+        if not path.is_file():
+            return {}
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except ValueError:
+            log.warning(f"Multirepo plugin ignoring corrupt {path}")
+            return {}
+
+    async def run_imports(
+        self,
+        graph: ImportGraph,
+        nav_imports: List[NavImport],
+        nav_repos: List[DocsRepo],
+        repos: List[DocsRepo],
+    ) -> None:
+        """Imports the nav's imports (and, as their navs are parsed, the imports in those),
+        the nav_repos and the repos as one plan in one event loop. Every import starts as
+        soon as the scheduler allows it, so the import takes as long as the slowest chain of
+        imports rather than the sum of one batch per kind of import.
+
+        If the graph is configs_only (the first stage of a two stage import), only the
+        config files of the nav's imports are fetched, which is all the nav needs, and the
+        rest is left to import_staged_docs. With bundles, every repo is restored from them
+        instead of being fetched."""
+        keep_docs_dir: bool = self.config.get("keep_docs_dir")
+        self.resolve_clone_filters([ni.repo for ni in nav_imports] + nav_repos + repos)
+        # bundled repos were pinned by the shards that imported them
+        pin = self.lock is not None and self.bundles is None
+        if pin:
+            await self.pin([ni.repo for ni in nav_imports] + nav_repos + repos)
+        if self.bundles is not None:
+            plan = [
+                (repo, self.bundles.restore) for repo in graph.add(nav_imports)
+            ] + self.repos_plan(nav_repos, repos)
+        elif graph.configs_only:
+            fetch_config = partial(
+                DocsRepo.fetch_config,
+                keep_docs_dir=keep_docs_dir,
+                config_cache=self.config_cache,
+            )
+            plan = [(repo, fetch_config) for repo in graph.add(nav_imports)]
+        else:
+            import_nav = partial(
+                DocsRepo.import_docs,
+                keep_docs_dir=keep_docs_dir,
+                cache=self.cache,
+                git_store=self.git_store,
+                config_cache=self.config_cache,
+                lazy=self.lazy_import,
+            )
+            plan = [
+                (repo, import_nav) for repo in graph.add(nav_imports)
+            ] + self.repos_plan(nav_repos, repos)
+            self.object_stores.assign([repo for repo, _ in plan], self.shared_urls)
+
+        async def expand(repo: DocsRepo) -> List[DocsRepo]:
+            # the imports in a repo's nav start as soon as its config is parsed
+            new_repos, aliases = graph.expand(repo, self.config_cache)
+            self.resolve_clone_filters(new_repos)
+            if pin:
+                await self.pin(aliases + new_repos)
+            if not graph.configs_only and self.bundles is None:
+                self.object_stores.assign(new_repos, self.shared_urls)
+            return new_repos
+
+        await execute_plan(
+            plan,
+            scheduler=self.scheduler,
+            timeout=self.remaining_import_time(),
+            expand=expand,
+        )
+        if not graph.configs_only:
+            link_aliases(nav_repos + repos)
+
+    async def import_staged_docs(
+        self, graph: ImportGraph, nav_repos: List[DocsRepo], repos: List[DocsRepo]
+    ) -> None:
+        """The second stage of a two stage import, which runs in the background while MkDocs
+        carries on with the build. The nav's imports are nested in each other's locations,
+        so their docs are fetched into staging directories of their own, all at once, and
+        then moved into place, parents first, and the aliases are linked."""
+        primaries = [ni.repo for ni in graph.nav_imports if ni.repo.alias_of is None]
+        staging_dir = self.temp_dir / ".multirepo" / "staging"
+        if staging_dir.is_dir():
+            shutil.rmtree(str(staging_dir))
+        locations = {repo.name: repo.location for repo in primaries}
+        for index, repo in enumerate(primaries):
+            repo.location = staging_dir / str(index)
+        import_nav = partial(
+            DocsRepo.import_docs,
+            keep_docs_dir=self.config.get("keep_docs_dir"),
+            cache=self.cache,
+            git_store=self.git_store,
+            lazy=self.lazy_import,
+        )
+        plan = [(repo, import_nav) for repo in primaries] + self.repos_plan(
+            nav_repos, repos
+        )
+        self.object_stores.assign([repo for repo, _ in plan], self.shared_urls)
+        try:
+            await execute_plan(
+                plan, scheduler=self.scheduler, timeout=self.remaining_import_time()
+            )
+        except BaseException:
+            for repo in primaries:
+                repo.location = locations[repo.name]
+            raise
+        for nav_import in graph.nav_imports:
+            repo = nav_import.repo
+            if repo.alias_of is not None:
+                repo.link_alias()
+                continue
+            staged, repo.location = repo.location, locations[repo.name]
             if repo.cloned:
                 repo.delete_repo()
-            docs_repo_objs.append(repo)
+            repo.location.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(str(staged), str(repo.location))
+        link_aliases(nav_repos + repos)
+        shutil.rmtree(str(staging_dir), ignore_errors=True)
+
+    def join_docs_import(self) -> None:
+        """Waits for the second stage of a two stage import, raising its error if it failed"""
+        if self.docs_import is None:
+            return
+        docs_import, self.docs_import = self.docs_import, None
+        docs_import.result()
+        self.finish_import()
+
+    def finish_import(self) -> None:
+        """Runs once the docs are imported: the files a re-import didn't change are put back
+        and the changes are reported, and the lock file is recorded"""
+        if self.content_index is not None:
+            self.import_changes = self.content_index.restore()
+            self.log_changes("import", self.import_changes)
+        # a shard only imports some of the locked repos, and bundles were imported by shards
+        if self.lock is not None and self.shard is None and self.bundles is None:
+            self.record_lock(list(self.repos.values()))
+
+    @staticmethod
+    def log_changes(action: str, changes: ImportChanges) -> None:
+        log.info(
+            f"Multirepo plugin {action} added {len(changes.added)}, changed "
+            f"{len(changes.changed)} and removed {len(changes.removed)} files"
+        )
+        for kind, paths in changes._asdict().items():
+            if paths:
+                log.debug(f"Multirepo plugin {kind}: " + ", ".join(paths))
+
+    def local_sources(self) -> List[Path]:
+        """returns the local directories imported repos are linked from"""
+        return sorted(
+            {
+                repo.local_import.source
+                for repo in self.repos.values()
+                if repo.local_import is not None
+            }
+        )
+
+    def sync_local_imports(self) -> Optional[ImportChanges]:
+        """Brings the repos linked from local directories up to date with them, relinking
+        only the files that changed, and returns what changed. Returns None when the docs
+        have to be imported again instead: a repo's config file changed, so its nav might
+        have, or its docs were laid out by transform_docs_dir."""
+        changes = ImportChanges([], [], [])
+        synced: Set[str] = set()
+        for repo in self.repos.values():
+            if repo.local_import is None:
+                continue
+            if repo.multi_docs:
+                return None
+            repo_changes = repo.local_import.sync(repo.location)
+            if repo.config in chain(*repo_changes):
+                return None
+            if repo_changes:
+                synced.add(repo.name)
+            for paths, repo_paths in zip(changes, repo_changes):
+                paths.extend(f"{repo.name}/{path}" for path in repo_paths)
+        for repo in self.repos.values():
+            if repo.alias_of is not None and repo.alias_of.name in synced:
+                repo.link_alias()
+        return changes
+
+    def handle_nav_import(self, config: Config, graph: ImportGraph) -> Config:
+        """Replaces the nav's imports with the navs of the imported repos"""
+        need_to_derive_edit_uris = config.get("edit_uri") is None
+        for nav_import in graph.nav_imports:
+            repo = nav_import.repo
+            repo_config = repo.nav_config
+            if not repo_config.get("nav"):
+                raise ImportDocsException(
+                    f"{repo.name}'s {repo.config} file doesn't have a nav section"
+                )
+            # mkdocs config values edit_uri and repo_url aren't set
+            if need_to_derive_edit_uris:
+                derived_edit_uri = self.derive_config_edit_uri(
+                    repo.name, repo.url, config
+                )
+            repo.set_edit_uri(
+                repo_config.get("edit_uri")
+                or config.get("edit_uri")
+                or derived_edit_uri
+            )
+            # Change the section title value from '!import {url}' to the imported repo's nav
+            # Note: this changes config.nav in place
+            nav_import.set_section_value(repo_config.get("nav"))
             self.repos[repo.name] = repo
-        asyncio_run(batch_execute(repos=docs_repo_objs, method=Repo.sparse_clone))
         return config
 
-    def on_config(self, config: Config) -> Config:
+    def handle_repos_import(self, config: Config, repos: List[DocsRepo]) -> Config:
+        """Adds the repos imported based on repos or nav_repos configuration"""
+        for dr in repos:
+            self.repos[dr.name] = dr
+        return config
+
+    async def pin(self, repos: List[DocsRepo]) -> None:
+        """Pins the repos to the commits in the lock file, so exactly those are imported.
+        Unless the build is locked, imports that aren't in the lock file yet are added at
+        the commits their branches point to now, with one concurrent batch of ls-remote
+        calls. Moving the other entries forward is left to `mkdocs-multirepo update`."""
+        # local imports don't have a commit to pin
+        repos = [repo for repo in repos if repo.backend != "local" and repo.sha is None]
+        for repo in repos:
+            entry = self.lock.entry(repo)
+            if entry is not None:
+                repo.sha = entry["sha"]
+        missing = [repo for repo in repos if repo.sha is None]
+        if not missing:
+            return
+        if self.locked:
+            repo = missing[0]
+            raise ImportDocsException(
+                f"{repo.name} ({repo.url} at {repo.branch}) isn't locked in "
+                f"{self.lock.path}. Run `mkdocs-multirepo update` to lock it."
+            )
+        # aliases are imported at the commit of the repo they alias
+        shas = {
+            (repo.url, repo.branch or "HEAD"): repo.alias_of.sha
+            for repo in missing
+            if repo.alias_of is not None and repo.alias_of.sha
+        }
+        shas.update(
+            await resolve_refs(
+                [r for r in missing if (r.url, r.branch or "HEAD") not in shas],
+                self.config.get("max_concurrency"),
+            )
+        )
+        _, unresolved = self.lock.update(missing, shas)
+        for repo in missing:
+            entry = self.lock.entry(repo)
+            if entry is not None and repo.name not in unresolved:
+                repo.sha = entry["sha"]
+
+    def record_lock(self, repos: List[DocsRepo]) -> None:
+        """Records the tree hash of every pinned import in the lock file and saves it. A
+        locked build leaves the lock file alone and warns about trees that differ instead."""
+        trees: Dict[str, str] = {}
+        for repo in repos:
+            entry = self.lock.entry(repo)
+            if repo.sha is None or entry is None or entry["sha"] != repo.sha:
+                continue
+            # an alias' tree is a copy of the tree it's an alias of
+            primary = repo.alias_of or repo
+            if primary.lazy_tree is not None:
+                # a lazy import's docs aren't checked out to be hashed
+                continue
+            if primary.name not in trees:
+                trees[primary.name] = tree_hash(
+                    primary.location,
+                    # nested imports are recorded on their own
+                    exclude=[child.location for child in primary.children],
+                )
+            tree = trees[primary.name]
+            if not self.locked:
+                entry["tree"] = tree
+            elif entry["tree"] and entry["tree"] != tree:
+                log.warning(
+                    f"Multirepo plugin imported {repo.name} at {repo.sha}, but its docs "
+                    f"differ from the ones recorded in {self.lock.path}"
+                )
+        if not self.locked:
+            self.lock.prune({repo.name for repo in repos})
+            self.lock.save()
+
+    @property
+    def state_dir(self) -> Path:
+        """Where state kept between builds lives. This is the cache when there is one,
+        otherwise the state only outlives the build when cleanup is off."""
+        if self.cache is not None:
+            return self.cache.location
+        return self.temp_dir / ".multirepo"
+
+    @property
+    def refresh_file(self) -> Path:
+        """touching this file while serving re-imports all docs"""
+        return self.temp_dir / ".refresh"
+
+    def import_fingerprint(self, config: Config) -> str:
+        """returns a hash of everything that decides what gets imported"""
+        data = json.dumps(
+            {
+                "plugin": dict(self.config),
+                "nav": config.get("nav"),
+                "edit_uri": config.get("edit_uri"),
+                "repo_url": config.get("repo_url"),
+            },
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def refresh_mtime(self) -> Optional[float]:
+        if self.refresh_file.is_file():
+            return self.refresh_file.stat().st_mtime
+        return None
+
+    def can_reuse_imports(self, fingerprint: str, refresh_interval: Optional[int]):
+        """returns True if docs imported by an earlier serve build are still valid"""
+        state = self.import_state
+        if not self.serve_mode or state is None or state.fingerprint != fingerprint:
+            return False
+        if refresh_interval is not None:
+            if time.time() - state.imported_at >= refresh_interval:
+                return False
+        return state.refresh_mtime == self.refresh_mtime()
+
+    @staticmethod
+    def count_import_urls(repos: List[DocsRepo], keep_docs_dir: bool) -> Counter:
+        """counts how many times each url is imported by repos"""
+        # identical imports are deduplicated, so each is only counted once
+        return Counter(repo.url for repo in dedupe_repos(repos, keep_docs_dir))
+
+    def remaining_import_time(self) -> Optional[float]:
+        """seconds left before import_timeout is up, or None if there's no timeout"""
+        if self.import_deadline is None:
+            return None
+        return max(self.import_deadline - time.monotonic(), 0)
+
+    def shard_imports(self, *imports: List) -> Tuple[List, ...]:
+        """Returns the imports of each list that are in this shard. The imports are dealt
+        to the shards in the order they're configured, and nested imports are imported by
+        the shard of the import whose nav they're in."""
+        shard, shards = self.shard
+        sharded, position = [], 0
+        for items in imports:
+            sharded.append(
+                [
+                    item
+                    for index, item in enumerate(items, position)
+                    if index % shards == shard - 1
+                ]
+            )
+            position += len(items)
+        return tuple(sharded)
+
+    def import_docs(self, config: Config, multi_config: MultirepoConfig) -> Config:
+        """Imports docs from the nav, repos and nav_repos configuration"""
+        self.repos = {}
+        self.import_deadline = (
+            time.monotonic() + multi_config.import_timeout
+            if multi_config.import_timeout
+            else None
+        )
+        repos: RepoConfig = multi_config.repos
+        nav_repos: NavRepoConfig = multi_config.nav_repos
+        nav: Optional[Dict[str, ...]] = config.get("nav")
+        if nav and repos:
+            log.warning(
+                "Multirepo plugin is ignoring plugins.multirepo.repos. Nav takes precedence."
+            )
+        if not nav and nav_repos:
+            log.warning(
+                "Multirepo plugin has nav_repos configuration without a nav section."
+            )
+        if self.shard is not None:
+            shard, shards = self.shard
+            log.info(
+                f"Multirepo plugin importing shard {shard} of {shards} of the docs..."
+            )
+        else:
+            log.info("Multirepo plugin importing docs...")
+        self.content_index = None
+        if multi_config.track_changes:
+            self.content_index = ContentIndex(
+                self.temp_dir, self.state_dir / "content_index.json"
+            )
+            self.content_index.set_aside()
+        # nav takes precedence over repos
+        if nav:
+            nav_imports = self.nav_imports(nav)
+            nav_repo_objs = self.nav_repos_from_config(config, nav_repos)
+            config_repo_objs = []
+        else:
+            nav_imports, nav_repo_objs = [], []
+            config_repo_objs = self.repos_from_config(config, repos)
+        if self.shard is not None:
+            nav_imports, nav_repo_objs, config_repo_objs = self.shard_imports(
+                nav_imports, nav_repo_objs, config_repo_objs
+            )
+        if self.bundles is not None:
+            self.bundles.load()
+        repo_objs = (
+            [nav_import.repo for nav_import in nav_imports]
+            + nav_repo_objs
+            + config_repo_objs
+        )
+        # urls imported more than once are fetched once into a shared object store
+        self.shared_urls = {
+            url
+            for url, count in self.count_import_urls(
+                repo_objs, multi_config.keep_docs_dir
+            ).items()
+            if count > 1
+        }
+        graph = ImportGraph(
+            multi_config.keep_docs_dir,
+            DEFAULT_BRANCH,
+            # restoring bundles doesn't fetch anything
+            configs_only=multi_config.two_stage_import and self.bundles is None,
+        )
+        asyncio_run(
+            self.run_imports(graph, nav_imports, nav_repo_objs, config_repo_objs)
+        )
+        config = self.handle_nav_import(config, graph)
+        config = self.handle_repos_import(config, nav_repo_objs + config_repo_objs)
+        if graph.configs_only:
+            # the docs are fetched while MkDocs validates the config and finds the site's
+            # own files, and on_files waits for them
+            executor = ThreadPoolExecutor(max_workers=1)
+            self.docs_import = executor.submit(
+                asyncio_run,
+                self.import_staged_docs(graph, nav_repo_objs, config_repo_objs),
+            )
+            executor.shutdown(wait=False)
+        else:
+            self.finish_import()
+        return config
+
+    def on_startup(self, *, command: str, dirty: bool) -> None:
+        # Only called by MkDocs >= 1.4, which also keeps this plugin instance alive across
+        # `mkdocs serve` rebuilds because this method is defined.
+        self.serve_mode = command == "serve"
+
+    def parse_config(self) -> MultirepoConfig:
         try:
-            multi_config: MultirepoConfig = dc.from_dict(
+            return dc.from_dict(
                 data_class=MultirepoConfig,
                 data=self.config,
                 config=dc.Config(strict=True),
@@ -282,6 +866,29 @@ class MultirepoPlugin(BasePlugin):
             raise ReposConfigException(
                 f"unknown config key(s), {formatted_keys}, for MultirepoConfig"
             )
+
+    @staticmethod
+    def lock_file_path(config: Config, multi_config: MultirepoConfig) -> Optional[Path]:
+        """returns the lock file's path, relative to mkdocs.yml, if a lock file is used"""
+        lock_file = multi_config.lock_file or (
+            LOCK_FILE if multi_config.locked else None
+        )
+        if lock_file is None:
+            return None
+        return Path(config.get("docs_dir")).parent / lock_file
+
+    @staticmethod
+    def cache_location(site_dir: Path, multi_config: MultirepoConfig) -> Optional[Path]:
+        """returns where imports are cached: cache_dir, or else the directory imports were
+        prefetched into, if they were"""
+        if multi_config.cache_dir:
+            return site_dir / multi_config.cache_dir
+        if (site_dir / PREFETCH_DIR).is_dir():
+            return site_dir / PREFETCH_DIR
+        return None
+
+    def on_config(self, config: Config) -> Config:
+        multi_config: MultirepoConfig = self.parse_config()
         if multi_config.imported_repo:
             config, temp_dir = self.handle_imported_repo(config)
             self.temp_dir = temp_dir
@@ -291,71 +898,181 @@ class MultirepoPlugin(BasePlugin):
             self.temp_dir = docs_dir.parent / multi_config.temp_dir
             if not self.temp_dir.is_dir():
                 self.temp_dir.mkdir()
-            repos: RepoConfig = multi_config.repos
-            nav_repos: NavRepoConfig = multi_config.nav_repos
-            nav: Optional[Dict[str, ...]] = config.get("nav")
-            if not nav and not repos and not nav_repos:
-                return config
-            if nav and repos:
-                log.warning(
-                    "Multirepo plugin is ignoring plugins.multirepo.repos. Nav takes precedence."
+            # the cache lives outside temp_dir so it survives cleanup
+            cache_location = self.cache_location(docs_dir.parent, multi_config)
+            self.clone_filters = self.load_clone_filters(
+                docs_dir.parent / CLONE_FILTERS_FILE
+            )
+            self.cache = (
+                ImportCache(cache_location) if cache_location is not None else None
+            )
+            self.git_store = (
+                GitStore(self.state_dir / "git") if multi_config.incremental else None
+            )
+            self.config_cache = ConfigCache(self.state_dir / "configs")
+            self.bundles = (
+                BundleSet(
+                    docs_dir.parent / multi_config.bundles,
+                    self.temp_dir / ".multirepo" / "bundle_objects",
+                    multi_config.keep_docs_dir,
                 )
-            if not nav and nav_repos:
-                log.warning(
-                    "Multirepo plugin has nav_repos configuration without a nav section."
+                if multi_config.bundles
+                else None
+            )
+            lock_file = self.lock_file_path(config, multi_config)
+            self.lock = LockFile.load(lock_file) if lock_file else None
+            self.locked = multi_config.locked
+            self.scheduler = ImportScheduler(
+                max_concurrency=multi_config.max_concurrency,
+                host_concurrency=multi_config.host_concurrency,
+                history_file=self.state_dir / "durations.json",
+                timeout=multi_config.repo_timeout,
+            )
+            # object stores are only worth keeping when fetches are incremental
+            self.object_stores = SharedObjectStores(
+                (
+                    self.state_dir
+                    if multi_config.incremental
+                    else self.temp_dir / ".multirepo"
                 )
-            log.info("Multirepo plugin importing docs...")
-            # nav takes precedence over repos
-            if nav:
-                config = self.handle_nav_import(config)
-                if nav_repos:
-                    return self.handle_nav_repos_import(config, nav_repos)
+                / "objects"
+            )
+            nav: Optional[Dict[str, ...]] = config.get("nav")
+            if not nav and not multi_config.repos and not multi_config.nav_repos:
                 return config
-            # navigation isn't defined but plugin section has repos
-            return self.handle_repos_import(config, repos)
+            fingerprint = self.import_fingerprint(config)
+            if self.can_reuse_imports(fingerprint, multi_config.serve_refresh_interval):
+                changes = self.sync_local_imports()
+                if changes is not None:
+                    log.info(
+                        "Multirepo plugin reusing docs imported by an earlier build"
+                    )
+                    self.import_changes = changes
+                    if changes:
+                        self.log_changes("sync of local imports", changes)
+                    config["nav"] = deepcopy(self.import_state.nav)
+                    return config
+            config = self.import_docs(config, multi_config)
+            if self.serve_mode:
+                self.import_state = ImportState(
+                    fingerprint=fingerprint,
+                    imported_at=time.time(),
+                    refresh_mtime=self.refresh_mtime(),
+                    nav=deepcopy(config.get("nav")),
+                )
+            return config
 
     def on_files(self, files: Files, config: Config) -> Files:
         if self.config.get("imported_repo"):
             return files
         else:
-            repo_files: List[File]
+            self.join_docs_import()
             for repo in self.repos.values():
-                repo_files = get_files(config, repo)
-                repo_config_path = repo.config_path
-                for f in repo_files:
-                    if f.src_path == repo_config_path:
-                        log.info(
-                            f"Multirepo plugin is not copying config file: {f.src_path}"
+                repo.timings.reset("get_files", "edit_urls")
+            # aliases reuse the walk of the repo they alias
+            walked = get_repos_files(
+                config,
+                [repo for repo in self.repos.values() if repo.alias_of is None],
+            )
+            self.imported_files = []
+            for repo in self.repos.values():
+                if repo.alias_of is None:
+                    repo_files = walked[repo.name]
+                else:
+                    with repo.timings.measure("get_files"):
+                        repo_files = alias_files(
+                            config, walked[repo.alias_of.name], repo
                         )
-                    else:
-                        # the file needs to know about the repo it belongs to
-                        f.repo = repo
-                        files.append(f)
+                for f in repo_files:
+                    # the file needs to know about the repo it belongs to
+                    f.repo = repo
+                    files.append(f)
+                self.imported_files.append((repo, repo_files))
             return files
 
+    def on_page_read_source(self, page, config: Config) -> Optional[str]:
+        if isinstance(page.file, LazyFile):
+            return page.file.read().decode("utf-8-sig")
+        return None
+
     def on_nav(self, nav, config: Config, files: Files):
         if self.config.get("imported_repo"):
             return nav
         else:
-            for f in files:
-                repo = f.repo if hasattr(f, "repo") else None
-                if repo and f.page:
-                    f.page.edit_url = repo.get_edit_url(
-                        f.src_path,
+            for repo, repo_files in self.imported_files:
+                with repo.timings.measure("edit_urls"):
+                    edit_url = repo.edit_url_builder(
                         self.config.get("keep_docs_dir"),
-                        self.config.get("nav_repos"),
+                        bool(self.config.get("nav_repos")),
                     )
+                    for f in repo_files:
+                        if f.page:
+                            f.page.edit_url = edit_url(f.src_path)
             return nav
 
+    def on_serve(self, server, config: Config, builder):
+        if self.temp_dir and not self.config.get("imported_repo"):
+            self.refresh_file.touch()
+            if self.import_state is not None:
+                self.import_state.refresh_mtime = self.refresh_mtime()
+            server.watch(str(self.refresh_file))
+            # edits to local imports are synced by the rebuild they trigger
+            for source in self.local_sources():
+                server.watch(str(source))
+        return server
+
+    def cleanup(self) -> None:
+        temp_dir = self.config.get("temp_dir")
+        log.info(f"Multirepo plugin is cleaning up {temp_dir}/")
+        shutil.rmtree(str(self.temp_dir))
+        self.import_state = None
+
+    def report_timings(self, config: Config) -> None:
+        """logs a table of how long each repo's import phases took and, if configured,
+        writes them to the timing_report json file"""
+        if not self.repos:
+            return
+        report = timing_report(list(self.repos.values()))
+        report_file = self.config.get("timing_report")
+        if report_file:
+            path = Path(config.get("docs_dir")).parent / report_file
+            write_timing_report(report, path)
+            log.info(
+                f"Multirepo plugin import timings (written to {report_file}):\n"
+                + format_timing_table(report)
+            )
+        else:
+            log.debug(
+                "Multirepo plugin import timings:\n" + format_timing_table(report)
+            )
+
     def on_post_build(self, config: Config) -> None:
         if self.config.get("imported_repo"):
             config["docs_dir"] = "docs"
             shutil.rmtree(str(self.temp_dir))
+            return
+        self.report_timings(config)
+        if self.serve_mode:
+            # imported docs are kept for the next rebuild and cleaned up on shutdown
+            return
         elif self.temp_dir and self.config.get("cleanup"):
-            temp_dir = self.config.get("temp_dir")
-            log.info(f"Multirepo plugin is cleaning up {temp_dir}/")
-            shutil.rmtree(str(self.temp_dir))
+            self.cleanup()
+
+    def on_shutdown(self) -> None:
+        if (
+            self.serve_mode
+            and not self.config.get("imported_repo")
+            and self.temp_dir
+            and self.temp_dir.is_dir()
+            and self.config.get("cleanup")
+        ):
+            self.cleanup()
 
     def on_build_error(self, error):
+        if self.docs_import is not None:
+            # the background import has to finish before its directories are removed
+            wait([self.docs_import])
+            self.docs_import = None
         if self.temp_dir:
             shutil.rmtree(str(self.temp_dir))
+        self.import_state = None
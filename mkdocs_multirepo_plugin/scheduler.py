@@ -0,0 +1,201 @@
+import asyncio
+import json
+import random
+import re
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import urlparse
+
+from .util import ImportTimeoutException, log
+
+RATE_LIMIT_PATTERN = re.compile(r"\b429\b|too many requests|rate limit", re.IGNORECASE)
+# a host that can't be resolved is almost always a typo or an offline run, which retrying
+# only slows down, so DNS failures (and refused connections) aren't transient
+TRANSIENT_ERROR_PATTERN = re.compile(
+    r"connection (timed out|reset)|operation timed out|timed out after"
+    r"|early eof|unexpected disconnect|the remote end hung up|rpc failed"
+    r"|\b50[234]\b|service unavailable|bad gateway",
+    re.IGNORECASE,
+)
+
+
+def is_rate_limited(error: Exception) -> bool:
+    """returns True if the error looks like the git host throttling us"""
+    return bool(RATE_LIMIT_PATTERN.search(str(error)))
+
+
+def is_transient(error: Exception) -> bool:
+    """returns True if the error looks like a network hiccup that a retry could get past"""
+    return isinstance(error, ImportTimeoutException) or bool(
+        TRANSIENT_ERROR_PATTERN.search(str(error))
+    )
+
+
+def get_host(url: str) -> str:
+    """returns the host of a remote url, including scp-like urls (git@host:path)"""
+    host = urlparse(url).hostname
+    if host:
+        return host
+    match = re.match(r"^(?:[^@/]+@)?([^:/]+):", url)
+    return match.group(1) if match else ""
+
+
+class HostLimiter:
+    """Limits how many imports run against one host at a time. The limit is halved whenever
+    the host rate limits us, down to a single import at a time."""
+
+    def __init__(self, limit: Optional[int] = None):
+        self.limit = limit
+        self.active = 0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: self.limit is None or self.active < self.limit
+            )
+            self.active += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    def throttle(self) -> None:
+        self.limit = max(1, (self.limit or self.active) // 2)
+
+
+class ImportScheduler:
+    """Schedules repo imports for batch_execute.
+
+    Imports are started slowest first, based on the durations recorded by earlier builds, so
+    the longest import doesn't start last and stretch the build. At most max_concurrency
+    imports run at once (and at most host_concurrency[host] against one host). Imports that
+    time out or fail with transient network errors are retried with jittered exponential
+    backoff, and so are imports that are rate limited, while their host's limit is lowered.
+
+    Attributes:
+        max_concurrency (int): The most imports that run at once. None means no limit.
+        host_concurrency (dict): The most imports that run at once per host.
+        history_file (Path): A JSON file durations are loaded from and saved to.
+        max_retries (int): How many times a failed import is retried.
+        backoff (float): The base delay, in seconds, before retrying a failed import.
+        timeout (float): Seconds an import attempt may take before it's cancelled.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: Optional[int] = None,
+        host_concurrency: Optional[Dict[str, int]] = None,
+        history_file: Optional[Path] = None,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+        timeout: Optional[float] = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.host_concurrency = host_concurrency or {}
+        self.history_file = history_file
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.durations: Dict[str, float] = self.load_history()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._host_limiters: Dict[str, HostLimiter] = {}
+
+    @staticmethod
+    def repo_key(repo) -> str:
+        return f"{repo.name} {repo.url}"
+
+    def load_history(self) -> Dict[str, float]:
+        if self.history_file is None or not self.history_file.is_file():
+            return {}
+        try:
+            with open(self.history_file) as f:
+                return json.load(f)
+        except ValueError:
+            log.warning(f"Multirepo plugin ignoring corrupt {self.history_file}")
+            return {}
+
+    def save_history(self) -> None:
+        if self.history_file is None:
+            return
+        self.history_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.history_file, "w") as f:
+            json.dump(self.durations, f, indent=2, sort_keys=True)
+
+    def order(self, repos: List) -> List:
+        """returns the repos slowest first. Repos without a recorded duration go first since
+        nothing is known about them."""
+        return sorted(
+            repos,
+            key=lambda repo: -self.durations.get(self.repo_key(repo), float("inf")),
+        )
+
+    def reset(self) -> None:
+        """creates the synchronization primitives for a new batch (and event loop)"""
+        self._semaphore = (
+            asyncio.Semaphore(self.max_concurrency) if self.max_concurrency else None
+        )
+        self._host_limiters = {}
+
+    def host_limiter(self, host: str) -> HostLimiter:
+        if host not in self._host_limiters:
+            self._host_limiters[host] = HostLimiter(self.host_concurrency.get(host))
+        return self._host_limiters[host]
+
+    def retry_delay(self, attempt: int) -> float:
+        # full jitter keeps retries from several imports from hitting the host together
+        return self.backoff * (2**attempt) * random.uniform(0.5, 1.0)
+
+    async def run(self, repo, method: Callable[..., Any], *args, **kwargs) -> Any:
+        """runs method(repo, *args, **kwargs) once there's capacity for it"""
+        host = get_host(repo.url)
+        limiter = self.host_limiter(host)
+        attempt = 0
+        while True:
+            async with limiter:
+                if self._semaphore is not None:
+                    await self._semaphore.acquire()
+                start = time.monotonic()
+                try:
+                    result = await self.run_attempt(repo, method, *args, **kwargs)
+                except Exception as e:
+                    rate_limited = is_rate_limited(e)
+                    if not (rate_limited or is_transient(e)) or (
+                        attempt >= self.max_retries
+                    ):
+                        raise
+                    if rate_limited:
+                        limiter.throttle()
+                    error = e
+                else:
+                    self.durations[self.repo_key(repo)] = round(
+                        time.monotonic() - start, 3
+                    )
+                    return result
+                finally:
+                    if self._semaphore is not None:
+                        self._semaphore.release()
+            delay = self.retry_delay(attempt)
+            attempt += 1
+            if rate_limited:
+                log.warning(
+                    f"Multirepo plugin was rate limited by {host}. Retrying {repo.name} in {delay:.1f} secs"
+                )
+            else:
+                log.warning(
+                    f"Multirepo plugin failed to import {repo.name} ({str(error).strip()}). Retrying in {delay:.1f} secs"
+                )
+            await asyncio.sleep(delay)
+
+    async def run_attempt(self, repo, method: Callable[..., Any], *args, **kwargs):
+        if self.timeout is None:
+            return await method(repo, *args, **kwargs)
+        try:
+            return await asyncio.wait_for(method(repo, *args, **kwargs), self.timeout)
+        except asyncio.TimeoutError:
+            raise ImportTimeoutException(
+                f"{repo.name} wasn't imported within {self.timeout} secs"
+            )
@@ -1,4 +0,0 @@
-#!/bin/bash
-
-mv "$1"/* .
-rm -rf "$1"
@@ -0,0 +1,39 @@
+#!/bin/bash
+set -f
+
+url="$1"
+repo_dir="$2"
+branch=$3
+filter=$4
+shift 4
+dirs=( "$@" )
+
+protocol="$(echo "$url" | sed 's/:\/\/.*//')"
+url_rest="$(echo "$url" | sed 's/.*:\/\///')"
+
+if [[ -n  "$AccessToken" ]]; then
+    url_to_use="${protocol}://$AccessToken@$url_rest"
+    auth=( -c "http.extraheader=AUTHORIZATION: bearer $AccessToken" )
+elif [[ -n  "$GithubAccessToken" ]]; then
+    url_to_use="${protocol}://x-access-token:$GithubAccessToken@$url_rest"
+elif [[ -n  "$GitlabCIJobToken" ]]; then
+    url_to_use="${protocol}://gitlab-ci-token:$GitlabCIJobToken@$url_rest"
+else
+  url_to_use="$url"
+fi
+# the remote url is only passed on the command line so tokens are never written to the kept .git
+remote=( "${auth[@]}" -c "remote.origin.url=$url_to_use" -c "remote.origin.fetch=+refs/heads/*:refs/remotes/origin/*" )
+
+mkdir -p "$repo_dir"
+cd "$repo_dir"
+# the .git directory is kept between runs so later runs only fetch new objects
+if [[ ! -d .git ]]; then
+    git init -q
+    git config core.sparseCheckout true
+fi
+# .git/info might not exist after git init, depending on git version
+mkdir -p .git/info
+# checkout reapplies the sparse patterns, so changed imports are updated in place
+printf "%s\n" "${dirs[@]}" > .git/info/sparse-checkout
+git "${remote[@]}" fetch -q --depth 1 $filter origin "$branch" || exit 1
+git "${remote[@]}" checkout -q --force --detach FETCH_HEAD || exit 1
@@ -1,26 +1,63 @@
 import ast
 import asyncio
 import os
+import posixpath
 import shutil
+import statistics
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Callable, Dict, List, Optional, Tuple, Union
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 from mkdocs.config import Config
 from mkdocs.structure.files import File, Files, _sort_files
-from mkdocs.utils import yaml_load
+from mkdocs.utils import get_yaml_loader, yaml_load
 from slugify import slugify
 
+from .backends import (
+    CLONE_FILTERS,
+    DEFAULT_BACKEND,
+    FetchBackend,
+    LocalImport,
+    SharedObjectStore,
+    get_backend,
+    select_backend,
+)
+from .cache import ConfigCache, GitStore, ImportCache, cache_key, link_or_copy
+from .lazy import LazyFile, LazyTree
+from .scheduler import ImportScheduler
+from .timing import PhaseTimings
 from .util import (
+    GitException,
     ImportDocsException,
     ImportSyntaxError,
+    ImportTimeoutException,
     ProgressList,
-    execute_bash_script,
-    git_supports_sparse_clone,
+    git_ls_remote,
     log,
+    move_docs_up,
     remove_parents,
 )
 
+try:
+    from yaml import CLoader as BaseYamlLoader
+except ImportError:
+    # PyYAML was built without libyaml
+    from yaml import Loader as BaseYamlLoader
+
+# MkDocs' yaml loader (e.g., with the !ENV tag), using libyaml's parser when it's available
+YamlLoader = get_yaml_loader(BaseYamlLoader)
+
 
 def is_yaml_file(file: File) -> bool:
     return os.path.splitext(file.src_path)[1] in (".yaml", ".yml")
@@ -35,6 +72,9 @@ def resolve_nav_paths(nav: List[Dict], section_name: str) -> None:
             ((key, value),) = entry.items()
             if type(value) is list:
                 resolve_nav_paths(value, section_name)
+            elif isinstance(value, str) and value.startswith("!import"):
+                # nested imports are resolved when they're imported (see ImportGraph)
+                continue
             else:
                 nav[index][key] = str(section_name / Path(value)).replace("\\", "/")
 
@@ -57,7 +97,8 @@ def parse_repo_url(repo_url: str) -> Dict[str, str]:
         query_parts = []
     import_parts = {"url": url}
     for part in query_parts:
-        k, v = part.split("=")
+        # values can contain = (e.g., clone_filter=blob:limit=1m)
+        k, v = part.split("=", 1)
         if v[0] == "[" and v[len(v) - 1] == "]":
             try:
                 import_parts[k] = [lst_v.strip() for lst_v in ast.literal_eval(v)]
@@ -150,6 +191,8 @@ def get_import_stmts(
                 config=import_stmt.get("config", "mkdocs.yml"),
                 extra_imports=import_stmt.get("extra_imports", []),
                 keep_docs_dir=import_stmt.get("keep_docs_dir"),
+                backend=import_stmt.get("backend"),
+                clone_filter=import_stmt.get("clone_filter"),
             )
             imports.append(NavImport(section, nav[index], repo))
         path_to_section.pop()
@@ -166,10 +209,31 @@ class Repo:
         temp_dir (Path): The directory where all repos are cloned to.
         location (Path): The location of the local repo on the filesystem.
         paths (List[str]): paths to import.
+        backend (str): The name of the FetchBackend used to fetch the repo. If `None`, the
+                       default backend is used.
+        clone_filter (str): The partial clone filter git fetches the repo with (e.g.,
+                            `tree:0`), or `none` for a plain shallow fetch. If `None`, the
+                            default filter is used.
+        object_store (SharedObjectStore): If set, the repo is materialised from this store,
+                                          which is shared with other imports of the url.
+        alias_of (Repo): If set, this repo imports exactly what alias_of does, so it isn't
+                         fetched and its location links to alias_of's (see dedupe_repos).
+        timings (PhaseTimings): How long each phase of the last import took.
+        sha (str): If set, the commit that's imported instead of the branch's tip (e.g., the
+                   one recorded in a LockFile).
+        local_import (LocalImport): If set, the repo was linked from a local directory and
+                                    can be synced with it (see LocalPathBackend).
     """
 
     def __init__(
-        self, name: str, url: str, branch: str, temp_dir: Path, paths: List[str] = None
+        self,
+        name: str,
+        url: str,
+        branch: str,
+        temp_dir: Path,
+        paths: List[str] = None,
+        backend: Optional[str] = None,
+        clone_filter: Optional[str] = None,
     ):
         self.name = name
         self.url = url
@@ -177,6 +241,22 @@ class Repo:
         self.temp_dir = temp_dir
         self.location = temp_dir / self.name
         self.paths = paths or []
+        self.backend = backend
+        self.clone_filter = clone_filter
+        self.object_store: Optional[SharedObjectStore] = None
+        self.alias_of: Optional[Repo] = None
+        self.timings = PhaseTimings()
+        self.sha: Optional[str] = None
+        self.local_import: Optional[LocalImport] = None
+
+    @property
+    def fetch_backend(self) -> FetchBackend:
+        return get_backend(self.backend or DEFAULT_BACKEND)
+
+    @property
+    def fetch_ref(self) -> str:
+        """the commit, or else the branch, that's fetched"""
+        return self.sha or self.branch or "HEAD"
 
     @property
     def cloned(self):
@@ -185,29 +265,103 @@ class Repo:
             return True
         return False
 
-    async def sparse_clone(self, paths: List[str] = None) -> Tuple[str, str]:
-        """sparse clones a Git repo asynchronously"""
+    def cache_key(self) -> str:
+        """returns the key of this repo's prepared tree in an ImportCache"""
+        return cache_key(
+            url=self.url, branch=self.branch, paths=self.paths, backend=self.backend
+        )
+
+    def uses_cache(self, cache: Optional[ImportCache]) -> bool:
+        return cache is not None and self.fetch_backend.supports_cache
+
+    async def resolve_ref(self) -> Optional[str]:
+        """returns the commit SHA the remote branch currently points to, or the repo's sha
+        when it's pinned to one"""
+        with self.timings.measure("resolve_ref"):
+            return await git_ls_remote(self.url, self.fetch_ref)
+
+    def restore_from_cache(
+        self, cache: ImportCache, key: str, sha: str
+    ) -> Optional[Dict]:
+        """Replaces the local repo with the cached tree if it was prepared from sha,
+        returning the cache entry's metadata"""
+        with self.timings.measure("restore"):
+            meta = cache.restore(key, sha, self.location)
+        if meta is not None:
+            log.debug(f"Multirepo plugin reusing cached {self.name} at {sha}")
+        return meta
+
+    async def import_paths(
+        self,
+        cache: Optional[ImportCache] = None,
+        git_store: Optional[GitStore] = None,
+    ) -> "Repo":
+        """sparse clones the repo's paths, reusing a cached tree when the remote is unchanged"""
+        self.timings.reset()
+        if self.cloned:
+            self.delete_repo()
+        sha = await self.resolve_ref() if self.uses_cache(cache) else None
+        if sha and self.restore_from_cache(cache, self.cache_key(), sha) is not None:
+            return self
+        await self.sparse_clone(git_store=git_store)
+        if sha:
+            cache.store(self.cache_key(), sha, self.location)
+        return self
+
+    async def sparse_clone(
+        self, paths: List[str] = None, git_store: Optional[GitStore] = None
+    ) -> Tuple[str, str]:
+        """Fetches the repo's paths into its location asynchronously. If a git store is given
+        and the backend supports it, the repo is updated incrementally in the store and its
+        working tree is copied to the location."""
         paths = paths or self.paths
-        args = [self.url, self.name, self.branch] + paths
-        if git_supports_sparse_clone():
-            await execute_bash_script("sparse_clone.sh", args, self.temp_dir)
-        else:
-            await execute_bash_script("sparse_clone_old.sh", args, self.temp_dir)
+        if self.object_store is not None:
+            await self.object_store.materialise(self, paths, self.location)
+            return self
+        backend = self.fetch_backend
+        if git_store is None or not backend.supports_incremental:
+            await backend.fetch(self, paths, self.location)
+            return self
+        repo_dir = git_store.repo_dir(self.url, self.name)
+        await backend.fetch(self, paths, repo_dir, keep_git=True)
+        with self.timings.measure("checkout"):
+            shutil.copytree(
+                str(repo_dir),
+                str(self.location),
+                ignore=shutil.ignore_patterns(".git"),
+                copy_function=link_or_copy,
+            )
         return self
 
+    def link_alias(self) -> None:
+        """Exposes the tree imported by alias_of at this repo's location using hard links"""
+        self.timings.reset()
+        if self.cloned:
+            self.delete_repo()
+        with self.timings.measure("checkout"):
+            shutil.copytree(
+                str(self.alias_of.location),
+                str(self.location),
+                copy_function=link_or_copy,
+            )
+
     def delete_repo(self) -> None:
         """Deletes the repo from the temp directory"""
         shutil.rmtree(str(self.location))
 
-    def load_config(self, yml_file: str = "mkdocs.yml") -> dict:
-        """Loads the config yaml file into a dictionary"""
-        if self.cloned:
+    def load_config(
+        self, yml_file: str = "mkdocs.yml", location: Optional[Path] = None
+    ) -> dict:
+        """Loads the config yaml file, in location (the repo's location by default), into a
+        dictionary"""
+        location = location or self.location
+        if location.is_dir():
             # If the config file is within the docs directory, it will be moved to the parent
-            # directory (see scripts/mv_docs_up.sh) which is the location.
-            config_file = self.location / Path(yml_file)
+            # directory (see move_docs_up) which is the location.
+            config_file = location / Path(yml_file)
             if config_file.is_file():
-                with open(config_file, "rb") as f:
-                    return yaml_load(f)
+                with self.timings.measure("load_config"), open(config_file, "rb") as f:
+                    return yaml_load(f, YamlLoader)
             else:
                 raise ImportDocsException(
                     f"{self.name} doesn't have {yml_file} at {str(config_file)}"
@@ -234,6 +388,12 @@ class DocsRepo(Repo):
         keep_docs_dir (bool): If `True` the docs directory will be kept when importing docs from this repo,
                               if `False` it will be removed, and if `None` (default) it will fall back to
                               the global setting.
+        nav_config (dict): The nav and edit_uri of the config file, once it's been parsed (see
+                           load_nav_config).
+        children (list): The repos imported by this repo's nav, which are imported below its
+                         location (see ImportGraph).
+        lazy_tree (LazyTree): If set, the repo's docs weren't checked out and are read from
+                              this tree when MkDocs needs them (see import_docs).
     """
 
     def _fix_edit_uri(self, edit_uri: str) -> str:
@@ -276,6 +436,9 @@ class DocsRepo(Repo):
         self.extra_imports = extra_imports
         self.edit_uri = self._fix_edit_uri(edit_uri)
         self._keep_docs_dir = keep_docs_dir
+        self.nav_config: Optional[Dict] = None
+        self.children: List[DocsRepo] = []
+        self.lazy_tree: Optional[LazyTree] = None
 
     def __str__(self):
         return f"DocsRepo({self.name}, {self.url}, {self.location})"
@@ -304,6 +467,38 @@ class DocsRepo(Repo):
     def config_path(self):
         return os.path.join(self.name, self.config)
 
+    @property
+    def config_location(self) -> Path:
+        """where fetch_config puts the repo's config file"""
+        return self.temp_dir / ".multirepo" / "config_files" / self.name
+
+    def cache_key(self, global_keep_docs_dir: bool = False) -> str:
+        """returns the key of this repo's prepared docs in an ImportCache"""
+        return cache_key(
+            url=self.url,
+            branch=self.branch,
+            docs_dir=self.docs_dir,
+            config=self.config,
+            extra_imports=self.extra_imports,
+            multi_docs=self.multi_docs,
+            keep_docs_dir=self.keep_docs_dir(global_keep_docs_dir),
+            paths=self.paths,
+            backend=self.backend,
+        )
+
+    def restore_from_cache(
+        self, cache: ImportCache, key: str, sha: str
+    ) -> Optional[Dict]:
+        meta = super().restore_from_cache(cache, key, sha)
+        if meta is not None:
+            self.src_path_map = meta.get("src_path_map", {})
+        return meta
+
+    def link_alias(self) -> None:
+        super().link_alias()
+        self.src_path_map = dict(self.alias_of.src_path_map)
+        self.lazy_tree = self.alias_of.lazy_tree
+
     def keep_docs_dir(self, global_keep_docs_dir: bool = False):
         if self._keep_docs_dir is None:
             return global_keep_docs_dir
@@ -312,42 +507,51 @@ class DocsRepo(Repo):
     def get_edit_url(
         self, src_path, keep_docs_dir: bool = False, nav_repos: bool = False
     ):
+        if not self.multi_docs:
+            return self.edit_url_builder(keep_docs_dir, nav_repos)(src_path)
         src_path = remove_parents(src_path, self.name_length)
-        is_extra_import = src_path.rsplit("/", 1) in self.extra_imports
-        if self.multi_docs:
-            parent_path = str(Path(src_path).parent).replace("\\", "/")
-            if parent_path in self.src_path_map:
-                src_path = Path(src_path)
-                url_parts = [
-                    self.url,
-                    self.edit_uri,
-                    self.src_path_map.get(parent_path),
-                    str(src_path.name),
-                ]
-            else:
-                url_parts = [
-                    self.url,
-                    self.edit_uri,
-                    self.src_path_map.get(str(src_path), str(src_path)),
-                ]
-        elif (
-            is_extra_import
-            or self.keep_docs_dir(global_keep_docs_dir=keep_docs_dir)
-            or nav_repos
-        ):
-            url_parts = [self.url, self.edit_uri, src_path]
+        parent_path = str(Path(src_path).parent).replace("\\", "/")
+        if parent_path in self.src_path_map:
+            src_path = Path(src_path)
+            url_parts = [
+                self.url,
+                self.edit_uri,
+                self.src_path_map.get(parent_path),
+                str(src_path.name),
+            ]
         else:
             url_parts = [
                 self.url,
                 self.edit_uri,
-                self.docs_dir.replace("/*", ""),
-                src_path,
+                self.src_path_map.get(str(src_path), str(src_path)),
             ]
         if self.edit_uri.startswith("http"):
             # If edit_uri starts with http we will use this instead of repo url
             url_parts.pop()
         return "/".join(part.strip("/") for part in url_parts)
 
+    def edit_url_builder(
+        self, keep_docs_dir: bool = False, nav_repos: bool = False
+    ) -> Callable[[str], str]:
+        """Returns a function giving the edit url of a page from its src_path. Apart from
+        multi_docs repos, where the url depends on the page's original directory, the
+        url's prefix (repo url, edit_uri and docs directory) is only built once."""
+        if self.multi_docs:
+            return lambda src_path: self.get_edit_url(
+                src_path, keep_docs_dir, nav_repos
+            )
+        url_parts = [self.url, self.edit_uri]
+        if not (self.keep_docs_dir(global_keep_docs_dir=keep_docs_dir) or nav_repos):
+            url_parts.append(self.docs_dir.replace("/*", ""))
+        prefix = "/".join(part.strip("/") for part in url_parts)
+        if self.edit_uri.startswith("http"):
+            # If edit_uri starts with http we will use this instead of repo url
+            return lambda src_path: prefix
+        prefix += "/"
+        # src_paths start with the repo's name (i.e., its location in temp_dir)
+        start = len(Path(self.name).as_posix()) + 1
+        return lambda src_path: prefix + src_path[start:].replace("\\", "/")
+
     def set_edit_uri(self, edit_uri) -> None:
         """Sets the edit uri for the repo. Used for mkdocs pages"""
         self.edit_uri = self._fix_edit_uri(edit_uri or self.docs_dir)
@@ -375,90 +579,557 @@ class DocsRepo(Repo):
                 shutil.rmtree(str(p))
 
     async def import_docs(
-        self, remove_existing: bool = True, keep_docs_dir: bool = False
+        self,
+        remove_existing: bool = True,
+        keep_docs_dir: bool = False,
+        cache: Optional[ImportCache] = None,
+        git_store: Optional[GitStore] = None,
+        config_cache: Optional[ConfigCache] = None,
+        lazy: bool = False,
     ) -> "DocsRepo":
-        """imports the markdown documentation to be included in the site asynchronously"""
+        """imports the markdown documentation to be included in the site asynchronously.
+        If a cache is given, the docs are only fetched when the remote branch has moved since
+        they were cached. If a config_cache is given, the config file is parsed in a thread as
+        soon as the docs are imported, while other imports are still being fetched. If lazy
+        and the backend supports it, only the config file is checked out and the docs are
+        read from a LazyTree when MkDocs needs them."""
+        self.timings.reset()
+        if config_cache is not None:
+            self.nav_config = None
+        self.lazy_tree = None
+        self.local_import = None
         if self.cloned and remove_existing:
             self.delete_repo()
+        if lazy and self.fetch_backend.supports_lazy and not self.multi_docs:
+            # there's no checked out tree to cache
+            await self.fetch_tree(keep_docs_dir)
+        else:
+            sha = await self.resolve_ref() if self.uses_cache(cache) else None
+            key = self.cache_key(keep_docs_dir)
+            if not (sha and self.restore_from_cache(cache, key, sha) is not None):
+                await self.fetch_docs(keep_docs_dir, git_store)
+                if sha:
+                    cache.store(key, sha, self.location, src_path_map=self.src_path_map)
+        if config_cache is not None:
+            self.nav_config = await asyncio.get_running_loop().run_in_executor(
+                None, self.load_nav_config, config_cache
+            )
+        return self
+
+    def config_paths(
+        self, keep_docs_dir: bool = False
+    ) -> Tuple[List[str], Optional[str]]:
+        """returns the paths that select the config file and the docs directory it's moved
+        up from, if any"""
+        if self.multi_docs or self.keep_docs_dir(keep_docs_dir):
+            return [self.config], None
+        # a config file in the docs directory is moved up, over the one in the root
+        move_up = self.docs_dir.replace("/*", "")
+        return [self.config, f"{move_up}/{self.config}"], move_up
+
+    async def fetch_tree(self, keep_docs_dir: bool = False) -> None:
+        """Fetches the repo into a git repository of its own, outside the temp_dir's imports,
+        checking out only the config file, and lists the docs into lazy_tree"""
+        paths = [self.docs_dir, self.config] + self.extra_imports
+        config_paths, move_up = self.config_paths(keep_docs_dir)
+        tree_location = (
+            self.temp_dir / ".multirepo" / "trees" / self.cache_key(keep_docs_dir)
+        )
+        self.lazy_tree = await self.fetch_backend.fetch_tree(
+            self, paths, config_paths, tree_location
+        )
+        shutil.copytree(
+            str(tree_location),
+            str(self.location),
+            ignore=shutil.ignore_patterns(".git"),
+            copy_function=link_or_copy,
+        )
+        if move_up:
+            move_docs_up(self.location, move_up)
+            self.lazy_tree.move_up(move_up)
+
+    async def fetch_docs(
+        self, keep_docs_dir: bool = False, git_store: Optional[GitStore] = None
+    ) -> None:
+        """fetches the docs and lays them out like they're imported"""
         if self.multi_docs:
             if self.docs_dir == "docs/*":
                 docs_dir = "docs"
             else:
                 docs_dir = self.docs_dir
-            await self.sparse_clone([docs_dir, self.config] + self.extra_imports)
-            self.transform_docs_dir()
+            await self.sparse_clone(
+                [docs_dir, self.config] + self.extra_imports, git_store
+            )
+            with self.timings.measure("move_docs"):
+                self.transform_docs_dir()
         else:
-            await self.sparse_clone([self.docs_dir, self.config] + self.extra_imports)
+            paths = [self.docs_dir, self.config] + self.extra_imports
+            move_up = None
             if not self.keep_docs_dir(global_keep_docs_dir=keep_docs_dir):
-                await execute_bash_script(
-                    "mv_docs_up.sh",
-                    [self.docs_dir.replace("/*", "")],
-                    cwd=self.location,
-                )
+                move_up = self.docs_dir.replace("/*", "")
+            backend = self.fetch_backend
+            if move_up and backend.moves_docs_up and self.object_store is None:
+                # the backend writes the docs directory's contents where they belong
+                await backend.fetch(self, paths, self.location, move_up=move_up)
+            else:
+                await self.sparse_clone(paths, git_store)
+                if move_up:
+                    with self.timings.measure("move_docs"):
+                        move_docs_up(self.location, move_up)
+
+    async def fetch_config(
+        self, keep_docs_dir: bool = False, config_cache: Optional[ConfigCache] = None
+    ) -> "DocsRepo":
+        """Fetches only the repo's config file, into config_location, and parses its nav. This
+        is the first stage of a two stage import, which is all the site's nav needs, and is
+        much smaller than the docs (which import_docs fetches later)."""
+        self.timings.reset()
+        self.nav_config = None
+        location = self.config_location
+        if location.is_dir():
+            shutil.rmtree(str(location))
+        paths, move_up = self.config_paths(keep_docs_dir)
+        backend = self.fetch_backend
+        if move_up and backend.moves_docs_up:
+            await backend.fetch(self, paths, location, move_up=move_up)
+        else:
+            await backend.fetch(self, paths, location)
+            if move_up:
+                move_docs_up(location, move_up)
+        self.nav_config = await asyncio.get_running_loop().run_in_executor(
+            None, self.load_nav_config, config_cache, location
+        )
         return self
 
-    def load_config(self) -> Dict:
+    def load_config(self, location: Optional[Path] = None) -> Dict:
         """Loads the repo's multirepo config file"""
-        config = super().load_config(self.config)
+        config = super().load_config(self.config, location)
         if "nav" in config:
             resolve_nav_paths(config.get("nav"), self.name)
         return config
 
+    def load_nav_config(
+        self,
+        config_cache: Optional[ConfigCache] = None,
+        location: Optional[Path] = None,
+    ) -> Dict:
+        """Returns the nav, with its paths resolved, and the edit_uri of the repo's config
+        file, in location (the repo's location by default), which is all the plugin uses.
+        With a config_cache, a config file whose content was parsed before isn't parsed
+        again."""
+        config_file = (location or self.location) / self.config
+        key = None
+        if config_cache is not None and config_file.is_file():
+            with self.timings.measure("load_config"):
+                content = config_file.read_bytes()
+                # an inherited config file can change without this one changing
+                if b"INHERIT" not in content:
+                    key = config_cache.key(content, self.name)
+                    nav_config = config_cache.get(key)
+                    if nav_config is not None:
+                        return nav_config
+        config = self.load_config(location)
+        nav_config = {k: config[k] for k in ("nav", "edit_uri") if k in config}
+        if key is not None:
+            config_cache.store(key, nav_config)
+        return nav_config
 
-async def batch_execute(
-    repos: List[Repo], method: Callable[..., Repo], *args, **kwargs
+
+def dedupe_repos(repos: List[Repo], *args) -> List[Repo]:
+    """Makes every repo an alias of the first repo with the same import spec (cache key),
+    returning the repos that actually need importing. args are passed to cache_key."""
+    primaries: Dict[str, Repo] = {}
+    for repo in repos:
+        key = repo.cache_key(*args)
+        repo.alias_of = primaries.get(key)
+        primaries.setdefault(key, repo)
+    return list(primaries.values())
+
+
+class ImportGraph:
+    """The imports of the site's nav and, recursively, the imports in the navs of the repos
+    they import. A nested import is named after its section below the repo importing it, so
+    it's imported into a directory in that repo's location.
+
+    Imports of the same thing (cache key) are only imported once and the others alias it.
+    An import of one of its own ancestors is a cycle, which is an error.
+
+    Attributes:
+        nav_imports (list): The imports found so far, with parents before their children.
+        parents (dict): The repo whose nav imports each repo, by the repo's name. Imports in
+                        the site's nav don't have a parent.
+        primaries (dict): The repo that's imported for each cache key.
+        waiting (dict): The aliases that are linked once the repo they alias is imported,
+                        by that repo's name.
+        configs_only (bool): If True, only the config files of the repos are fetched (see
+                             DocsRepo.fetch_config), so aliases parse the config file of
+                             the repo they alias instead of being linked.
+    """
+
+    def __init__(
+        self, keep_docs_dir: bool, default_branch: str, configs_only: bool = False
+    ):
+        self.keep_docs_dir = keep_docs_dir
+        self.default_branch = default_branch
+        self.configs_only = configs_only
+        self.nav_imports: List[NavImport] = []
+        self.parents: Dict[str, Optional[DocsRepo]] = {}
+        self.primaries: Dict[str, DocsRepo] = {}
+        self.waiting: Dict[str, List[DocsRepo]] = {}
+
+    def add(
+        self, nav_imports: List[NavImport], parent: Optional[DocsRepo] = None
+    ) -> List[DocsRepo]:
+        """Adds the imports found in parent's nav, or in the site's nav when parent is None,
+        returning the repos that need importing"""
+        new_repos = []
+        for nav_import in nav_imports:
+            repo = nav_import.repo
+            if repo.name in self.parents:
+                raise ImportDocsException(
+                    f"Multirepo plugin found two imports into {repo.name}"
+                )
+            key = repo.cache_key(self.keep_docs_dir)
+            self.check_cycle(repo, key, parent)
+            self.nav_imports.append(nav_import)
+            self.parents[repo.name] = parent
+            if parent is not None:
+                parent.children.append(repo)
+            repo.alias_of = self.primaries.get(key)
+            if repo.alias_of is None:
+                self.primaries[key] = repo
+                new_repos.append(repo)
+            else:
+                self.waiting.setdefault(repo.alias_of.name, []).append(repo)
+        return new_repos
+
+    def expand(
+        self, repo: DocsRepo, config_cache: Optional[ConfigCache] = None
+    ) -> Tuple[List[DocsRepo], List[DocsRepo]]:
+        """Adds the imports in the nav of repo, which was just imported, and links the
+        aliases waiting for it, adding the imports in their navs too. Returns the repos that
+        need importing and the aliases that were linked."""
+        new_repos: List[DocsRepo] = []
+        linked: List[DocsRepo] = []
+        ready = [repo]
+        while ready:
+            done = ready.pop()
+            new_repos += self.add(self.nested_imports(done), done)
+            # an alias found in done's nav may alias a repo that's already imported
+            for name in list(self.waiting):
+                aliases = self.waiting[name]
+                if aliases[0].alias_of.nav_config is None:
+                    continue
+                del self.waiting[name]
+                for alias in aliases:
+                    location = None
+                    if self.configs_only:
+                        location = alias.alias_of.config_location
+                    else:
+                        alias.link_alias()
+                    alias.nav_config = alias.load_nav_config(config_cache, location)
+                    linked.append(alias)
+                    ready.append(alias)
+        return new_repos, linked
+
+    def check_cycle(self, repo: DocsRepo, key: str, parent: Optional[DocsRepo]):
+        chain = [repo]
+        while parent is not None:
+            chain.append(parent)
+            if parent.cache_key(self.keep_docs_dir) == key:
+                cycle = " -> ".join(f"{r.name} ({r.url})" for r in reversed(chain))
+                raise ImportDocsException(
+                    f"Multirepo plugin found an import cycle: {cycle}"
+                )
+            parent = self.parents[parent.name]
+
+    def nested_imports(self, repo: DocsRepo) -> List[NavImport]:
+        """returns the import statements in the repo's parsed nav"""
+        nav = (repo.nav_config or {}).get("nav")
+        if not nav:
+            return []
+        nav_imports = get_import_stmts(
+            nav, repo.temp_dir, self.default_branch, list(Path(repo.name).parts)
+        )
+        for nav_import in nav_imports:
+            # the imports of a local directory's nav aren't necessarily local too
+            nav_import.repo.backend = select_backend(
+                nav_import.repo.url,
+                nav_import.repo.backend,
+                None if repo.backend == "local" else repo.backend,
+            )
+        return nav_imports
+
+
+def link_aliases(repos: List[Repo]) -> None:
+    """Links the imported trees of the primaries into their aliases' locations"""
+    for repo in repos:
+        if repo.alias_of is not None:
+            repo.link_alias()
+
+
+ImportMethod = Callable[[Repo], Awaitable[Repo]]
+
+
+async def execute_plan(
+    plan: List[Tuple[Repo, ImportMethod]],
+    scheduler: Optional[ImportScheduler] = None,
+    timeout: Optional[float] = None,
+    expand: Optional[Callable[[Repo], Awaitable[List[Repo]]]] = None,
 ) -> None:
-    """"""
-    if not repos:
+    """Awaits method(repo) for every (repo, method) of the plan concurrently, as allowed by
+    the scheduler, so repos imported in different ways still share one event loop and one
+    set of limits. If expand is given, it's awaited with every repo that completes and the
+    repos it returns are run too, right away, with the method of the repo that completed
+    (e.g., the imports in the repo's nav).
+
+    If a repo fails, or they aren't all done within timeout seconds, the other runs are
+    cancelled (killing their git processes) and the directories of the repos that didn't
+    complete are removed, so a failed build doesn't leave half imported docs behind.
+    """
+    if not plan:
         return None
+    scheduler = scheduler or ImportScheduler()
+    scheduler.reset()
+    methods: Dict[int, ImportMethod] = {id(repo): method for repo, method in plan}
+    repos = scheduler.order([repo for repo, _ in plan])
     progress_list = ProgressList([repo.name for repo in repos])
-    start = time.time()
-    for future in asyncio.as_completed(
-        [method(repo, *args, **kwargs) for repo in repos]
-    ):
-        repo = await future
-        progress_list.mark_completed(repo.name, round(time.time() - start, 3))
+    tasks = {
+        asyncio.ensure_future(scheduler.run(repo, methods[id(repo)])): repo
+        for repo in repos
+    }
+    pending = set(tasks)
+    deadline = None if timeout is None else asyncio.get_running_loop().time() + timeout
+    try:
+        while pending:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - asyncio.get_running_loop().time(), 0)
+            done, pending = await asyncio.wait(
+                pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                raise ImportTimeoutException(
+                    f"{len(pending)} repos weren't imported within {timeout} secs: "
+                    + ", ".join(sorted(tasks[task].name for task in pending))
+                )
+            for task in done:
+                repo = tasks[task]
+                task.result()
+                progress_list.mark_completed(
+                    repo.name, scheduler.durations.get(scheduler.repo_key(repo), "")
+                )
+                if expand is None:
+                    continue
+                for new_repo in scheduler.order(await expand(repo)):
+                    methods[id(new_repo)] = methods[id(repo)]
+                    progress_list.add(new_repo.name)
+                    task = asyncio.ensure_future(
+                        scheduler.run(new_repo, methods[id(new_repo)])
+                    )
+                    tasks[task] = new_repo
+                    pending.add(task)
+    except BaseException:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for task, repo in tasks.items():
+            if task.cancelled() or task.exception() is not None:
+                shutil.rmtree(str(repo.location), ignore_errors=True)
+        raise
+    scheduler.save_history()
+
+
+async def batch_execute(
+    repos: List[Repo],
+    method: Callable[..., Repo],
+    *args,
+    scheduler: Optional[ImportScheduler] = None,
+    timeout: Optional[float] = None,
+    expand: Optional[Callable[[Repo], Awaitable[List[Repo]]]] = None,
+    **kwargs,
+) -> None:
+    """Runs method(repo, *args, **kwargs) on every repo concurrently (see execute_plan)"""
+    await execute_plan(
+        [(repo, lambda repo: method(repo, *args, **kwargs)) for repo in repos],
+        scheduler=scheduler,
+        timeout=timeout,
+        expand=expand,
+    )
 
 
 async def batch_import(
-    repos: List[DocsRepo], remove_existing: bool = True, keep_docs_dir: bool = False
+    repos: List[DocsRepo],
+    remove_existing: bool = True,
+    keep_docs_dir: bool = False,
+    cache: Optional[ImportCache] = None,
+    git_store: Optional[GitStore] = None,
+    scheduler: Optional[ImportScheduler] = None,
+    timeout: Optional[float] = None,
+    config_cache: Optional[ConfigCache] = None,
+    expand: Optional[Callable[[DocsRepo], Awaitable[List[DocsRepo]]]] = None,
 ) -> None:
     """Given a list of DocsRepo instances, performs a batch import asynchronously"""
     await batch_execute(
         repos=repos,
         method=DocsRepo.import_docs,
+        scheduler=scheduler,
+        timeout=timeout,
+        expand=expand,
         remove_existing=remove_existing,
         keep_docs_dir=keep_docs_dir,
+        cache=cache,
+        git_store=git_store,
+        config_cache=config_cache,
     )
 
 
-# taken from Mkdocs and adjusted for the plugin
-def get_files(config: Config, repo: DocsRepo) -> Files:
-    """Walk the `docs_dir` and return a Files collection."""
-    files = []
+async def time_clone_filters(
+    url: str,
+    branch: Optional[str],
+    paths: List[str],
+    runs: int = 3,
+    filters: Tuple[str, ...] = CLONE_FILTERS,
+) -> Dict[str, Optional[float]]:
+    """Fetches and checks out the repo's paths with git and each clone filter, runs times,
+    returning the median number of seconds each filter took, or None if it failed. The
+    filters take turns, so they're all timed under the same conditions."""
+    durations: Dict[str, List[float]] = {clone_filter: [] for clone_filter in filters}
+    failed = set()
+    with tempfile.TemporaryDirectory(prefix="multirepo_benchmark_") as temp_dir:
+        for run in range(runs):
+            for index, clone_filter in enumerate(filters):
+                if clone_filter in failed:
+                    continue
+                repo = Repo(
+                    f"{index}-{run}",
+                    url,
+                    branch,
+                    Path(temp_dir),
+                    backend="git",
+                    clone_filter=clone_filter,
+                )
+                start = time.perf_counter()
+                try:
+                    await repo.sparse_clone(paths)
+                except (GitException, ImportDocsException) as e:
+                    log.debug(
+                        f"Multirepo plugin couldn't fetch with {clone_filter}: {e}"
+                    )
+                    failed.add(clone_filter)
+                    continue
+                durations[clone_filter].append(time.perf_counter() - start)
+                repo.delete_repo()
+    return {
+        clone_filter: None
+        if clone_filter in failed
+        else statistics.median(durations[clone_filter])
+        for clone_filter in filters
+    }
+
 
-    for source_dir, dirnames, filenames in os.walk(repo.location, followlinks=True):
-        relative_dir = os.path.relpath(source_dir, repo.temp_dir)
+def make_file(
+    config: Config, repo: DocsRepo, path: str, tree_path: Optional[str] = None
+) -> File:
+    """returns the File at path, relative to temp_dir, which is read from the repo's lazy
+    tree at tree_path if the repo was imported lazily"""
+    if repo.lazy_tree is not None:
+        return LazyFile(
+            path,
+            str(repo.temp_dir),
+            config["site_dir"],
+            config["use_directory_urls"],
+            repo.lazy_tree,
+            tree_path,
+        )
+    return File(
+        path, str(repo.temp_dir), config["site_dir"], config["use_directory_urls"]
+    )
 
-        for dirname in list(dirnames):
-            path = os.path.normpath(os.path.join(relative_dir, dirname))
-        dirnames.sort()
 
+def alias_files(config: Config, files: Files, repo: DocsRepo) -> Files:
+    """Returns the files of repo's alias_of, walked by get_files, under repo's name"""
+    return Files(
+        [
+            make_file(
+                config,
+                repo,
+                os.path.join(
+                    repo.name, os.path.relpath(f.src_path, repo.alias_of.name)
+                ),
+                getattr(f, "tree_path", None),
+            )
+            for f in files
+        ]
+    )
+
+
+def scan_dir(path: str) -> Tuple[List[str], List[str]]:
+    """returns the names of the files and directories in path"""
+    filenames, dirnames = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            # like os.walk(followlinks=True), symlinked directories are walked
+            (dirnames if entry.is_dir() else filenames).append(entry.name)
+    return filenames, dirnames
+
+
+def iter_files(config: Config, repo: DocsRepo) -> Iterator[File]:
+    """Walks the repo's location depth first with os.scandir (or its lazy tree's listing),
+    yielding a File for every file in the same order as mkdocs. The repo's config file is
+    skipped."""
+    config_path = os.path.normpath(repo.config_path)
+    # nested imports are walked as repos of their own
+    children = {os.path.normpath(child.name) for child in repo.children}
+    # directories still to walk, as (path relative to the location, to temp_dir)
+    stack = [("", os.path.normpath(repo.name))]
+    while stack:
+        directory, relative_dir = stack.pop()
+        source_dir = os.path.join(str(repo.location), directory)
+        if repo.lazy_tree is not None:
+            filenames, dirnames = repo.lazy_tree.list_dir(directory)
+        else:
+            filenames, dirnames = scan_dir(source_dir)
+        has_index = "index.md" in filenames
         for filename in _sort_files(filenames):
-            path = os.path.normpath(os.path.join(relative_dir, filename))
+            path = os.path.join(relative_dir, filename)
             # Skip README.md if an index file also exists in dir
-            if filename == "README.md" and "index.md" in filenames:
+            if filename == "README.md" and has_index:
                 log.warning(
                     f"Both index.md and README.md found. Skipping README.md from {source_dir}"
                 )
                 continue
-            files.append(
-                File(
-                    path,
-                    repo.temp_dir,
-                    config["site_dir"],
-                    config["use_directory_urls"],
+            if path == config_path:
+                log.info(f"Multirepo plugin is not copying config file: {path}")
+                continue
+            yield make_file(config, repo, path, posixpath.join(directory, filename))
+        # pushed in reverse so they're walked in sorted order
+        for dirname in sorted(dirnames, reverse=True):
+            if os.path.join(relative_dir, dirname) in children:
+                continue
+            stack.append(
+                (
+                    posixpath.join(directory, dirname),
+                    os.path.join(relative_dir, dirname),
                 )
             )
 
-    return Files(files)
+
+def get_files(config: Config, repo: DocsRepo) -> Files:
+    """Returns a Files collection of the repo's files, without its config file"""
+    return Files(list(iter_files(config, repo)))
+
+
+def get_repos_files(
+    config: Config, repos: List[DocsRepo], max_workers: Optional[int] = None
+) -> Dict[str, Files]:
+    """Walks the repos concurrently, returning each repo's files by its name"""
+
+    def walk(repo: DocsRepo) -> Files:
+        with repo.timings.measure("get_files"):
+            return get_files(config, repo)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return {
+            repo.name: files for repo, files in zip(repos, executor.map(walk, repos))
+        }
@@ -0,0 +1,113 @@
+import json
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+# the phases in the order they happen when a repo is imported
+PHASES = (
+    "resolve_ref",
+    "restore",
+    "fetch",
+    "checkout",
+    "list_tree",
+    "move_docs",
+    "load_config",
+    "get_files",
+    "edit_urls",
+)
+
+
+class PhaseTimings:
+    """Accumulates how long each import phase of a repo took.
+
+    Attributes:
+        durations (dict): Seconds spent in each phase that has run.
+    """
+
+    def __init__(self):
+        self.durations: Dict[str, float] = {}
+
+    @contextmanager
+    def measure(self, phase: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[phase] = self.durations.get(phase, 0.0) + (
+                time.perf_counter() - start
+            )
+
+    def reset(self, *phases: str) -> None:
+        """forgets the given phases, or all of them if none are given"""
+        if not phases:
+            self.durations.clear()
+        for phase in phases:
+            self.durations.pop(phase, None)
+
+    @property
+    def total(self) -> float:
+        return sum(self.durations.values())
+
+
+def timing_report(repos: List) -> Dict:
+    """Returns a json serializable report of the phase timings of repos, slowest first"""
+    entries = [
+        {
+            "name": repo.name,
+            "url": repo.url,
+            "branch": repo.branch,
+            "alias_of": repo.alias_of.name if repo.alias_of is not None else None,
+            "phases": {
+                phase: round(repo.timings.durations[phase], 4)
+                for phase in PHASES
+                if phase in repo.timings.durations
+            },
+            "total": round(repo.timings.total, 4),
+        }
+        for repo in repos
+    ]
+    entries.sort(key=lambda entry: entry["total"], reverse=True)
+    phase_totals = {
+        phase: round(sum(entry["phases"].get(phase, 0.0) for entry in entries), 4)
+        for phase in PHASES
+    }
+    return {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "phases": phase_totals,
+        "total": round(sum(phase_totals.values()), 4),
+        "repos": entries,
+    }
+
+
+def write_timing_report(report: Dict, path: Path) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def format_timing_table(report: Dict) -> str:
+    """Formats a timing report as a plain text table, which reads fine in CI logs"""
+    phases = [phase for phase in PHASES if report["phases"].get(phase)]
+    header = ["repo"] + phases + ["total"]
+    rows = [
+        [entry["name"]]
+        + [f"{entry['phases'].get(phase, 0.0):.3f}" for phase in phases]
+        + [f"{entry['total']:.3f}"]
+        for entry in report["repos"]
+    ]
+    rows.append(
+        ["(all)"]
+        + [f"{report['phases'][phase]:.3f}" for phase in phases]
+        + [f"{report['total']:.3f}"]
+    )
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    lines = [
+        "  ".join(
+            cell.ljust(width) if i == 0 else cell.rjust(width)
+            for i, (cell, width) in enumerate(zip(row, widths))
+        )
+        for row in [header] + rows
+    ]
+    lines.insert(1, "  ".join("-" * width for width in widths))
+    return "\n".join(lines)
@@ -1,10 +1,16 @@
 import asyncio
+import base64
+import functools
 import logging
+import os
 import re
+import shutil
+import signal
 import subprocess
+import sys
 from pathlib import Path
 from sys import platform, version_info
-from typing import Any, Dict, NamedTuple
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 
 try:
     from importlib import resources
@@ -45,6 +51,10 @@ class BashException(Exception):
     pass
 
 
+class ImportTimeoutException(ImportDocsException):
+    pass
+
+
 def is_windows():
     if platform not in LINUX_LIKE_PLATFORMS:
         return True
@@ -74,6 +84,24 @@ def remove_parents(path: str, num_to_remove: int) -> str:
     return "/" + str(Path(*parts_to_keep)).replace("\\", "/")
 
 
+def move_docs_up(location: Path, docs_dir: str) -> None:
+    """Moves everything in location/docs_dir up into location and removes docs_dir"""
+    docs_path = location / docs_dir
+    if not docs_path.is_dir():
+        return
+    # move the docs directory aside first, in case it contains an entry with its own name
+    staged = location / f".{docs_path.name}.moving"
+    docs_path.rename(staged)
+    for path in list(staged.iterdir()):
+        target = location / path.name
+        if target.is_dir() and path.is_dir():
+            shutil.copytree(str(path), str(target), dirs_exist_ok=True)
+            shutil.rmtree(str(path))
+        else:
+            os.replace(str(path), str(target))
+    shutil.rmtree(str(staged))
+
+
 def parse_version(val: str) -> Version:
     match = re.match(r"[^0-9]*(([0-9]+\.){2}[0-9]+).*", val)
     if not match:
@@ -106,15 +134,228 @@ def git_version() -> Version:
     return parse_version(version)
 
 
-def git_supports_sparse_clone() -> bool:
-    """The sparse-checkout was added in 2.25.0
-    See RelNotes here: https://github.com/git/git/blob/9005149a4a77e2d3409c6127bf4fd1a0893c3495/Documentation/RelNotes/2.25.0.txt#L67
+class GitCapabilities(NamedTuple):
+    """The git features the plugin can make use of, derived from the git version"""
+
+    version: Version
+    # clone/fetch --filter (partial clone)
+    partial_clone: bool
+    # the sparse-checkout command and clone --sparse were added in 2.25.0
+    # See RelNotes here:
+    # https://github.com/git/git/blob/9005149a4a77e2d3409c6127bf4fd1a0893c3495/Documentation/RelNotes/2.25.0.txt#L67
+    sparse_checkout: bool
+    # sparse-checkout set --no-cone, which our non-cone patterns need once cone is available
+    no_cone_flag: bool
+    protocol_v2: bool
+    protocol_v2_default: bool
+    # GIT_CONFIG_COUNT and friends
+    config_env: bool
+    # fetch --stdin, which fetches a batch of missing blobs in one request
+    fetch_stdin: bool
+
+    @classmethod
+    def from_version(cls, version: Version) -> "GitCapabilities":
+        return cls(
+            version=version,
+            partial_clone=version >= Version(2, 22, 0),
+            sparse_checkout=version >= Version(2, 25, 0),
+            no_cone_flag=version >= Version(2, 35, 0),
+            protocol_v2=version >= Version(2, 18, 0),
+            protocol_v2_default=version >= Version(2, 29, 0),
+            config_env=version >= Version(2, 31, 0),
+            fetch_stdin=version >= Version(2, 29, 0),
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def git_capabilities() -> GitCapabilities:
+    """Probes git once per process"""
+    return GitCapabilities.from_version(git_version())
+
+
+class FetchStrategy(NamedTuple):
+    """How repos are fetched.
+
+    Attributes:
+        name (str): The strategy's name, used in logs.
+        script (str): The script in scripts/ that fetches a repo.
+        filter (str): The partial clone filter argument, or an empty string.
+        env (dict): Extra environment variables for git.
     """
-    return git_version() >= Version(2, 25, 0)
+
+    name: str
+    script: str
+    filter: str
+    env: Dict[str, str]
+
+
+def get_fetch_strategy(capabilities: GitCapabilities) -> FetchStrategy:
+    """returns the fastest fetch strategy the git capabilities support"""
+    env = {}
+    if capabilities.protocol_v2 and not capabilities.protocol_v2_default:
+        # v2 only sends the refs we ask for, instead of every ref on the remote
+        env["GIT_CONFIG_PARAMETERS"] = " ".join(
+            p
+            for p in [os.environ.get("GIT_CONFIG_PARAMETERS"), "'protocol.version=2'"]
+            if p
+        )
+    filter_arg = "--filter=blob:none" if capabilities.partial_clone else ""
+    if capabilities.partial_clone and capabilities.no_cone_flag:
+        return FetchStrategy("sparse clone", "sparse_clone.sh", filter_arg, env)
+    # a shallow fetch of the branch into an empty repo works with any git version and
+    # is much cheaper than fetching all history
+    return FetchStrategy("shallow fetch", "sparse_fetch.sh", filter_arg, env)
+
+
+@functools.lru_cache(maxsize=None)
+def select_fetch_strategy() -> FetchStrategy:
+    """Picks the fetch strategy once per process, logging the choice"""
+    capabilities = git_capabilities()
+    strategy = get_fetch_strategy(capabilities)
+    version = ".".join(str(v) for v in capabilities.version)
+    log.info(
+        f"Multirepo plugin using {strategy.name} fetch strategy (git {version}"
+        f"{', partial clone' if strategy.filter else ''})"
+    )
+    return strategy
+
+
+def git_auth_config(url: str) -> Dict[str, str]:
+    """returns the git config that authenticates requests to an http(s) remote, based on the
+    same access token env vars scripts/sparse_clone.sh uses"""
+    if not url.startswith(("http://", "https://")):
+        return {}
+    if os.environ.get("AccessToken"):
+        header = f"AUTHORIZATION: bearer {os.environ['AccessToken']}"
+    elif os.environ.get("GithubAccessToken"):
+        credentials = f"x-access-token:{os.environ['GithubAccessToken']}"
+        header = (
+            f"AUTHORIZATION: basic {base64.b64encode(credentials.encode()).decode()}"
+        )
+    elif os.environ.get("GitlabCIJobToken"):
+        credentials = f"gitlab-ci-token:{os.environ['GitlabCIJobToken']}"
+        header = (
+            f"AUTHORIZATION: basic {base64.b64encode(credentials.encode()).decode()}"
+        )
+    else:
+        return {}
+    return {"http.extraheader": header}
+
+
+def git_config_args(config: Dict[str, str]) -> Tuple[List[str], Dict[str, str]]:
+    """returns the arguments and env vars that pass config to a git command. The config is
+    passed through the environment when git supports it (2.31.0) so credentials don't show
+    up in the process list."""
+    if not config:
+        return [], {}
+    if not git_capabilities().config_env:
+        args: List[str] = []
+        for key, value in config.items():
+            args += ["-c", f"{key}={value}"]
+        return args, {}
+    offset = int(os.environ.get("GIT_CONFIG_COUNT", 0))
+    env = {"GIT_CONFIG_COUNT": str(offset + len(config))}
+    for i, (key, value) in enumerate(config.items(), start=offset):
+        env[f"GIT_CONFIG_KEY_{i}"] = key
+        env[f"GIT_CONFIG_VALUE_{i}"] = value
+    return [], env
+
+
+def kill_process(process) -> None:
+    """kills a process started in its own session along with its children (e.g., the git
+    processes a bash script started)"""
+    if process.returncode is not None:
+        return
+    try:
+        if is_windows():
+            process.kill()
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+async def communicate(process) -> Tuple[bytes, bytes]:
+    """waits for a process' output, killing it if the wait is cancelled (e.g., by a timeout
+    or a failed sibling import) so no process outlives its import"""
+    try:
+        return await process.communicate()
+    except asyncio.CancelledError:
+        kill_process(process)
+        await process.wait()
+        raise
+
+
+async def execute_git(
+    arguments: List[str], cwd: Path, config: Optional[Dict[str, str]] = None
+) -> str:
+    """executes git directly (without a shell) asynchronously"""
+    config_args, config_env = git_config_args(config or {})
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "git",
+            *config_args,
+            *arguments,
+            cwd=cwd,
+            env={**os.environ, **config_env} if config_env else None,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True,
+        )
+    except FileNotFoundError:
+        raise GitException(
+            "git executable not found. Please ensure git is available in PATH."
+        )
+    stdout, stderr = await communicate(process)
+    if process.returncode != 0:
+        raise GitException(f"\ngit {arguments[0]} failed:\n{stderr.decode()}\n")
+    return stdout.decode()
+
+
+def parse_ls_remote(output: str, ref: str) -> Optional[str]:
+    """returns the SHA for ref from git ls-remote output, preferring branches over tags"""
+    shas: Dict[str, str] = {}
+    for line in output.splitlines():
+        sha, _, name = line.partition("\t")
+        shas[name.strip()] = sha.strip()
+    for name in (f"refs/heads/{ref}", f"refs/tags/{ref}^{{}}", f"refs/tags/{ref}", ref):
+        if name in shas:
+            return shas[name]
+    return None
+
+
+async def git_ls_remote_refs(url: str, refs: List[str]) -> Dict[str, Optional[str]]:
+    """returns the commit SHA each of the remote's refs points to, with one ls-remote call.
+    Refs that can't be resolved map to None."""
+    shas: Dict[str, Optional[str]] = {
+        ref: ref if re.fullmatch(r"[0-9a-f]{40}", ref) else None for ref in refs
+    }
+    unresolved = sorted(ref for ref, sha in shas.items() if sha is None)
+    if not unresolved:
+        return shas
+    try:
+        output = await execute_git(
+            ["ls-remote", url] + unresolved, Path.cwd(), git_auth_config(url)
+        )
+    except GitException as e:
+        log.debug(f"git ls-remote failed for {url}: {str(e).strip()}")
+        return shas
+    for ref in unresolved:
+        shas[ref] = parse_ls_remote(output, ref)
+    return shas
+
+
+async def git_ls_remote(url: str, ref: str) -> Optional[str]:
+    """returns the commit SHA the remote ref points to, or None if it can't be resolved"""
+    ref = ref or "HEAD"
+    return (await git_ls_remote_refs(url, [ref]))[ref]
 
 
 async def execute_bash_script(
-    script: str, arguments: list = [], cwd: Path = Path.cwd()
+    script: str,
+    arguments: list = [],
+    cwd: Path = Path.cwd(),
+    env: Optional[Dict[str, str]] = None,
 ) -> str:
     """executes a bash script in an asynchronously"""
     ref = resources.files("mkdocs_multirepo_plugin") / "scripts" / script
@@ -125,27 +366,29 @@ async def execute_bash_script(
                 script_path,
                 *arguments,
                 cwd=cwd,
+                env={**os.environ, **env} if env else None,
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE,
+                start_new_session=True,
             )
         except FileNotFoundError:
             raise GitException(
                 "bash executable not found. Please ensure bash is available in PATH."
             )
 
-        stdout, stderr = await process.communicate()
+        stdout, stderr = await communicate(process)
         stdout_str, stderr_str = stdout.decode(), stderr.decode()
         if process.returncode != 0:
             raise BashException(f"\n{stderr_str}\n")
         return stdout_str
 
 
-def asyncio_run(futures) -> None:
+def asyncio_run(futures) -> Any:
     if (version_info.major == 3 and version_info.minor > 6) or (version_info.major > 3):
-        asyncio.run(futures)
+        return asyncio.run(futures)
     else:
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(futures)
+        return loop.run_until_complete(futures)
 
 
 class ProgressList:
@@ -153,13 +396,27 @@ class ProgressList:
         self._labels = labels
         self._labels_map = {label: i for i, label in enumerate(self._labels)}
         self._num_items = len(self._labels)
-        for label in self._labels:
-            print(f"🔳 {label}")
+        # cursor movements garble output that isn't a terminal (e.g., CI logs)
+        self._interactive = sys.stdout.isatty()
+        if self._interactive:
+            for label in self._labels:
+                print(f"🔳 {label}")
 
     def index(self, label):
         return self._labels_map.get(label)
 
+    def add(self, label):
+        """adds an item below the others, e.g., an import found while importing"""
+        self._labels_map[label] = self._num_items
+        self._labels.append(label)
+        self._num_items += 1
+        if self._interactive:
+            print(f"🔳 {label}")
+
     def mark_completed(self, label, duration=""):
+        if not self._interactive:
+            print(f"✅ {label} ({duration} secs)")
+            return
         i = self.index(label)
         num_items = self._num_items
         update_line = f"\033[{num_items - i}A"
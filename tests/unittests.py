@@ -1,3 +1,5 @@
+import asyncio
+import json
 import os
 import pathlib
 import stat
@@ -5,17 +7,79 @@ import subprocess
 import sys
 import unittest
 from pathlib import Path
-from shutil import copy
+from shutil import copy, rmtree
+from tempfile import TemporaryDirectory
+from typing import Dict, List
+from unittest import mock
+from urllib.error import HTTPError
 
+import yaml
 from aiofiles import tempfile
+from mkdocs.config import load_config
+from mkdocs.structure.files import Files
 from parameterized import parameterized
 
-from mkdocs_multirepo_plugin import structure, util
+from mkdocs_multirepo_plugin import (
+    backends,
+    cache,
+    cli,
+    lock,
+    plugin,
+    scheduler,
+    structure,
+    timing,
+    util,
+)
 
 SCRIPTS_DIR = Path.cwd() / "mkdocs_multirepo_plugin" / "scripts"
 PYTHON_BIN = Path(sys.executable).parent
 scripts = list(SCRIPTS_DIR.iterdir())
 
+DEMO_REPO_FILES = {
+    "docs/index.md": "# Home",
+    "docs/page1.md": "# Page1",
+    "docs/page2.md": "# Page2",
+    "docs/mkdocs.yml": "nav:\n  - Home: index.md\n  - Page1: page1.md\n",
+    "src/script.py": "print('hi')",
+}
+
+
+def git(*args, cwd: Path) -> str:
+    return subprocess.run(
+        ["git", *args], cwd=cwd, check=True, capture_output=True, text=True
+    ).stdout.strip()
+
+
+def make_local_repo(
+    path: Path, files: Dict[str, str] = None, branch: str = "main"
+) -> str:
+    """creates a git repo at path with one commit containing files, returning its file:// url"""
+    path.mkdir(parents=True)
+    git("init", "-q", cwd=path)
+    git("checkout", "-q", "-b", branch, cwd=path)
+    commit_files(path, files or DEMO_REPO_FILES)
+    return path.as_uri()
+
+
+def commit_files(path: Path, files: Dict[str, str], message: str = "update") -> str:
+    """writes files to the repo at path and commits them, returning the new commit SHA"""
+    for file, content in files.items():
+        (path / file).parent.mkdir(parents=True, exist_ok=True)
+        (path / file).write_text(content)
+    git("add", "-A", cwd=path)
+    git(
+        "-c",
+        "user.name=test",
+        "-c",
+        "user.email=test@example.com",
+        "commit",
+        "-q",
+        "-m",
+        message,
+        cwd=path,
+    )
+    return git("rev-parse", "HEAD", cwd=path)
+
 
 class BaseCase(unittest.IsolatedAsyncioTestCase):
     @classmethod
@@ -86,18 +150,57 @@ class TestUtil(BaseCase):
             with self.assertRaises(ValueError):
                 util.remove_parents(case[1], case[0])
 
+    def test_parse_ls_remote(self):
+        output = (
+            "1111111111111111111111111111111111111111\trefs/heads/main\n"
+            "2222222222222222222222222222222222222222\trefs/remotes/origin/main\n"
+            "3333333333333333333333333333333333333333\trefs/tags/v1\n"
+            "4444444444444444444444444444444444444444\trefs/tags/v1^{}\n"
+        )
+        self.assertEqual(
+            util.parse_ls_remote(output, "main"),
+            "1111111111111111111111111111111111111111",
+        )
+        self.assertEqual(
+            util.parse_ls_remote(output, "v1"),
+            "4444444444444444444444444444444444444444",
+        )
+        self.assertIsNone(util.parse_ls_remote(output, "missing"))
+
+    def test_git_capabilities_probed_once(self):
+        util.git_capabilities.cache_clear()
+        with mock.patch.object(
+            util, "git_version", return_value=util.Version(2, 30, 1)
+        ) as git_version:
+            util.git_capabilities()
+            capabilities = util.git_capabilities()
+            git_version.assert_called_once()
+        self.assertTrue(capabilities.sparse_checkout)
+        self.assertFalse(capabilities.no_cone_flag)
+        util.git_capabilities.cache_clear()
+
+    def test_get_fetch_strategy(self):
+        def strategy(*version: int) -> util.FetchStrategy:
+            capabilities = util.GitCapabilities.from_version(util.Version(*version))
+            return util.get_fetch_strategy(capabilities)
+
+        self.assertEqual(strategy(2, 37, 1).script, "sparse_clone.sh")
+        self.assertEqual(strategy(2, 37, 1).env, {})
+        # sparse-checkout set --no-cone isn't available before 2.35.0
+        self.assertEqual(strategy(2, 30, 0).script, "sparse_fetch.sh")
+        self.assertEqual(strategy(2, 30, 0).filter, "--filter=blob:none")
+        self.assertEqual(strategy(2, 17, 0).script, "sparse_fetch.sh")
+        self.assertEqual(strategy(2, 17, 0).filter, "")
+        self.assertIn(
+            "protocol.version=2", strategy(2, 20, 0).env["GIT_CONFIG_PARAMETERS"]
+        )
+
     async def test_sparse_clone(self):
         await self.run_script_test("sparse_clone.sh", "test_docs")
 
-    async def test_sparse_clone_old(self):
-        await self.run_script_test("sparse_clone_old.sh", "test_docs")
-
     async def test_section_with_spaces(self):
         await self.run_script_test("sparse_clone.sh", "has spaces")
 
-    async def test_section_with_spaces_old(self):
-        await self.run_script_test("sparse_clone_old.sh", "has spaces")
-
 
 class TestStructure(BaseCase):
 
@@ -456,6 +559,1083 @@ class TestStructure(BaseCase):
             for file in expected_files:
                 self.assertFileExists(file)
 
+    def test_get_files(self):
+        with TemporaryDirectory() as temp_dir:
+            temp_dir_path = Path(temp_dir)
+            for path in [
+                "group/repo/README.md",
+                "group/repo/index.md",
+                "group/repo/mkdocs.yml",
+                "group/repo/b/page.md",
+                "group/repo/a/README.md",
+                "group/repo/a/nested/page.md",
+                "other/index.md",
+            ]:
+                (temp_dir_path / path).parent.mkdir(parents=True, exist_ok=True)
+                (temp_dir_path / path).write_text("")
+            repos = [
+                structure.DocsRepo("group/repo", "https://foo", temp_dir_path),
+                structure.DocsRepo("other", "https://bar", temp_dir_path),
+            ]
+            config = {"site_dir": "site", "use_directory_urls": True}
+            repos_files = structure.get_repos_files(config, repos)
+            # files are sorted like mkdocs does, directories are walked in order and
+            # README.md and the config file are skipped
+            self.assertEqual(
+                [f.src_path for f in repos_files["group/repo"]],
+                [
+                    "group/repo/index.md",
+                    "group/repo/a/README.md",
+                    "group/repo/a/nested/page.md",
+                    "group/repo/b/page.md",
+                ],
+            )
+            self.assertEqual(
+                [f.src_path for f in repos_files["other"]], ["other/index.md"]
+            )
+            self.assertIn("get_files", repos[0].timings.durations)
+
+    def test_get_edit_url(self):
+        test_cases = [
+            ("group/repo", "/blob/main/", "group/repo/a/page.md", False),
+            ("repo", "/blob/main/", "repo/index.md", True),
+            (
+                "repo",
+                "https://gitlab.com/org/repo/-/edit/main/",
+                "repo/index.md",
+                False,
+            ),
+        ]
+        expected = [
+            "https://github.com/org/repo/blob/main/docs/a/page.md",
+            "https://github.com/org/repo/blob/main/index.md",
+            "https://github.com/org/repo/https://gitlab.com/org/repo/-/edit/main/docs",
+        ]
+        for (name, edit_uri, src_path, keep_docs_dir), url in zip(test_cases, expected):
+            docs_repo = structure.DocsRepo(
+                name,
+                "https://github.com/org/repo",
+                Path(""),
+                branch="main",
+                edit_uri=edit_uri,
+            )
+            self.assertEqual(docs_repo.get_edit_url(src_path, keep_docs_dir), url)
+            edit_url = docs_repo.edit_url_builder(keep_docs_dir)
+            self.assertEqual(edit_url(src_path), url)
+
+    async def test_dedupe_repos(self):
+        async with tempfile.TemporaryDirectory() as temp_dir:
+            temp_dir_path = pathlib.Path(temp_dir)
+            url = make_local_repo(temp_dir_path / "remote")
+            build_dir = temp_dir_path / "build"
+            build_dir.mkdir()
+            repos = [
+                structure.DocsRepo(name, url, build_dir, branch="main")
+                for name in ["shared", "section/shared"]
+            ]
+            repos.append(
+                structure.DocsRepo("other", url, build_dir, "src/*", branch="main")
+            )
+            unique_repos = structure.dedupe_repos(repos)
+            self.assertEqual(unique_repos, [repos[0], repos[2]])
+            self.assertIs(repos[1].alias_of, repos[0])
+            await structure.batch_import(unique_repos)
+            structure.link_aliases(repos)
+            self.assertFileExists(build_dir / "section" / "shared" / "page1.md")
+            config = {"site_dir": "site", "use_directory_urls": True}
+            files = structure.get_files(config, repos[0])
+            alias_files = structure.alias_files(config, files, repos[1])
+            self.assertEqual(
+                sorted(f.src_path for f in alias_files),
+                sorted(f"section/{f.src_path}" for f in files),
+            )
+
+
+class TestBackends(BaseCase):
+    @parameterized.expand(
+        [
+            ("git", None),
+            ("script", "sparse_clone.sh"),
+            ("script", "sparse_fetch.sh"),
+            ("local", None),
+            ("archive", None),
+        ]
+    )
+    async def test_sparse_clone_backend(self, backend, script):
+        strategy = util.FetchStrategy(script, script, "--filter=blob:none", {})
+        async with tempfile.TemporaryDirectory() as temp_dir:
+            temp_dir_path = pathlib.Path(temp_dir)
+            url = make_local_repo(temp_dir_path / "remote")
+            repo = structure.Repo(
+                "has spaces", url, "main", temp_dir_path, backend=backend
+            )
+            with mock.patch.object(
+                backends, "select_fetch_strategy", return_value=strategy
+            ):
+                await repo.sparse_clone(["docs/*", "/mkdocs.yml"])
+            self.assertFileExists(repo.location / "docs" / "page1.md")
+            self.assertFalse((repo.location / "src").exists())
+            self.assertFalse((repo.location / ".git").exists())
+
+    async def test_fetch_backend_interface(self):
+        # backends have to implement fetch
+        with self.assertRaises(TypeError):
+            backends.FetchBackend()
+        repo = structure.Repo("repo", "../repo", "main", pathlib.Path("."))
+        backend = backends.LocalPathBackend()
+        self.assertFalse(backend.supports_lazy)
+        with self.assertRaisesRegex(util.ImportDocsException, "local backend"):
+            await backend.fetch_tree(repo, ["docs/*"], [], pathlib.Path("."))
+
+    @parameterized.expand(
+        [
+            ("default", None, True, ["--filter=blob:none"]),
+            ("tree", "tree:0", True, ["--filter=tree:0"]),
+            ("shallow", "none", True, []),
+            ("unsupported", "tree:0", False, []),
+        ]
+    )
+    def test_clone_filter_args(self, _, clone_filter, partial_clone, expected):
+        capabilities = mock.Mock(partial_clone=partial_clone)
+        with mock.patch.object(backends, "git_capabilities", return_value=capabilities):
+            self.assertEqual(backends.clone_filter_args(clone_filter), expected)
+
+    async def test_time_clone_filters(self):
+        async with tempfile.TemporaryDirectory() as temp_dir:
+            url = make_local_repo(pathlib.Path(temp_dir) / "remote")
+            medians = await structure.time_clone_filters(
+                url, "main", ["docs/*"], runs=2
+            )
+            self.assertEqual(list(medians), list(backends.CLONE_FILTERS))
+            self.assertTrue(all(seconds > 0 for seconds in medians.values()))
+            medians = await structure.time_clone_filters(
+                url, "missing", ["docs/*"], runs=1
+            )
+            self.assertEqual(set(medians.values()), {None})
+
+    async def test_archive_backend(self):
+        async with tempfile.TemporaryDirectory() as temp_dir:
+            temp_dir_path = pathlib.Path(temp_dir)
+            files = {**DEMO_REPO_FILES, "docs/src/script.py": "docs", "src/a.py": ""}
+            url = make_local_repo(temp_dir_path / "remote", files)
+            docs_repo = structure.DocsRepo(
+                "test-repo",
+                url,
+                temp_dir_path,
+                branch="main",
+                extra_imports=["src/*", "missing/*"],
+                backend="archive",
+            )
+            with mock.patch.object(structure, "move_docs_up") as move_docs_up:
+                await docs_repo.import_docs()
+                # the docs were extracted where they belong
+                move_docs_up.assert_not_called()
+            self.assertFileExists(docs_repo.location / "page1.md")
+            self.assertFileExists(docs_repo.location / "mkdocs.yml")
+            self.assertFileExists(docs_repo.location / "src" / "a.py")
+            self.assertFalse((docs_repo.location / "docs").exists())
+            # like move_docs_up, the docs win over files with the same path
+            script = docs_repo.location / "src" / "script.py"
+            self.assertEqual(script.read_text(), "docs")
+
+    async def test_archive_backend_tarball_fallback(self):
+        async with tempfile.TemporaryDirectory() as temp_dir:
+            temp_dir_path = pathlib.Path(temp_dir)
+            url = make_local_repo(temp_dir_path / "remote")
+            docs_repo = structure.DocsRepo(
+                "test-repo", url, temp_dir_path, branch="main", backend="archive"
+            )
+            tarball_url = "https://codeload.github.com/owner/repo/tar.gz/main"
+            error = HTTPError(tarball_url, 404, "Not Found", {}, None)
+            with mock.patch.object(
+                backends.ArchiveBackend, "github_tarball_url", return_value=tarball_url
+            ), mock.patch.object(backends, "urlopen", side_effect=error) as urlopen:
+                await docs_repo.import_docs()
+            urlopen.assert_called_once()
+            # the repo was fetched with git, into the same layout
+            self.assertFileExists(docs_repo.location / "page1.md")
+            self.assertFileExists(docs_repo.location / "mkdocs.yml")
+            self.assertFalse((docs_repo.location / "docs").exists())
+            self.assertFalse((docs_repo.location / ".git").exists())
+
+    async def test_lazy_import(self):
+        async with tempfile.TemporaryDirectory() as temp_dir:
+            temp_dir_path = pathlib.Path(temp_dir)
+            files = {**DEMO_REPO_FILES, "docs/img/logo.png": "png"}
+            url = make_local_repo(temp_dir_path / "remote", files)
+            # lets the blobless fetch leave the blobs on the remote
+            git(
+                "config", "uploadpack.allowFilter", "true", cwd=temp_dir_path / "remote"
+            )
+            docs_repo = structure.DocsRepo(
+                "test-repo", url, temp_dir_path, branch="main", backend="git"
+            )
+            await docs_repo.import_docs(lazy=True)
+            tree = docs_repo.lazy_tree
+            self.assertTrue(tree.promisor)
+            # only the config file is checked out
+            self.assertEqual(os.listdir(docs_repo.location), ["mkdocs.yml"])
+            self.assertEqual(
+                sorted(tree.files),
+                ["img/logo.png", "index.md", "mkdocs.yml", "page1.md", "page2.md"],
+            )
+            config = {
+                "site_dir": str(temp_dir_path / "site"),
+                "use_directory_urls": True,
+            }
+            repo_files = structure.get_files(config, docs_repo)
+            self.assertEqual(
+                [f.src_path for f in repo_files],
+                [
+                    "test-repo/index.md",
+                    "test-repo/page1.md",
+                    "test-repo/page2.md",
+                    "test-repo/img/logo.png",
+                ],
+            )
+            page = repo_files.get_file_from_path("test-repo/page1.md")
+            self.assertEqual(page.read(), b"# Page1")
+            # the other pages were read in the same batch, but not the image
+            self.assertEqual(set(tree.contents), {"index.md", "page2.md"})
+            image = repo_files.get_file_from_path("test-repo/img/logo.png")
+            image.copy_file()
+            self.assertEqual(Path(image.abs_dest_path).read_text(), "png")
+
+    def test_matches_sparse_patterns(self):
+        patterns = ["docs/*", "mkdocs.yml", "/README.md"]
+        self.assertTrue(backends.matches_sparse_patterns("docs/a/b.md", patterns))
+        self.assertTrue(backends.matches_sparse_patterns("mkdocs.yml", patterns))
+        self.assertTrue(backends.matches_sparse_patterns("sub/mkdocs.yml", patterns))
+        self.assertTrue(backends.matches_sparse_patterns("README.md", patterns))
+        self.assertFalse(backends.matches_sparse_patterns("sub/README.md", patterns))
+        self.assertFalse(backends.matches_sparse_patterns("src/docs.py", patterns))
+
+    def test_get_backend(self):
+        self.assertIsInstance(backends.get_backend("git"), backends.GitBackend)
+        with self.assertRaises(util.ImportDocsException):
+            backends.get_backend("unknown")
+
+    async def test_shared_object_store(self):
+        async with tempfile.TemporaryDirectory() as temp_dir:
+            temp_dir_path = pathlib.Path(temp_dir)
+            url = make_local_repo(temp_dir_path / "remote")
+            stores = backends.SharedObjectStores(temp_dir_path / "objects")
+            build_dir = temp_dir_path / "build"
+            build_dir.mkdir()
+            repos = [
+                structure.Repo("docs-repo", url, "main", build_dir, ["docs/*"]),
+                structure.Repo("src-repo", url, "main", build_dir, ["src/*"]),
+            ]
+            stores.assign(repos, {url})
+            self.assertIs(repos[0].object_store, repos[1].object_store)
+            with mock.patch.object(
+                backends, "execute_git", wraps=util.execute_git
+            ) as execute_git:
+                await asyncio.gather(*(repo.import_paths() for repo in repos))
+            fetches = [c for c in execute_git.call_args_list if "fetch" in c.args[0]]
+            self.assertEqual(len(fetches), 1)
+            self.assertFileExists(repos[0].location / "docs" / "page1.md")
+            self.assertFalse((repos[0].location / "src").exists())
+            self.assertFileExists(repos[1].location / "src" / "script.py")
+            self.assertFalse((repos[1].location / "docs").exists())
+            for repo in repos:
+                self.assertFalse((repo.location / ".git").exists())
+            store = repos[0].object_store.location
+            self.assertFalse((store / "worktrees").exists())
+
+            # a failed checkout doesn't leave its worktree behind in the store either
+            async def failing_checkout(arguments, cwd, config=None):
+                if arguments[0] == "checkout":
+                    raise util.GitException("checkout failed")
+                return await util.execute_git(arguments, cwd, config)
+
+            repo = structure.Repo("failed-repo", url, "main", build_dir, ["docs/*"])
+            stores.assign([repo], {url})
+            with mock.patch.object(backends, "execute_git", new=failing_checkout):
+                with self.assertRaises(util.GitException):
+                    await repo.import_paths()
+            self.assertFalse((store / "worktrees").exists())
+
+    def test_move_docs_up(self):
+        with TemporaryDirectory() as temp_dir:
+            location = Path(temp_dir)
+            for path in ["docs/index.md", "docs/docs/nested.md", "docs/src/a.md"]:
+                (location / path).parent.mkdir(parents=True, exist_ok=True)
+                (location / path).write_text(path)
+            (location / "src").mkdir()
+            (location / "src" / "b.py").write_text("")
+            util.move_docs_up(location, "docs")
+            self.assertFileExists(location / "index.md")
+            self.assertFileExists(location / "docs" / "nested.md")
+            self.assertFileExists(location / "src" / "a.md")
+            self.assertFileExists(location / "src" / "b.py")
+            self.assertEqual(
+                sorted(p.name for p in location.iterdir()), ["docs", "index.md", "src"]
+            )
+
+
+class TestCache(BaseCase):
+    async def test_import_docs_reuses_cache(self):
+        async with tempfile.TemporaryDirectory() as temp_dir:
+            temp_dir_path = pathlib.Path(temp_dir)
+            remote = temp_dir_path / "remote"
+            url = make_local_repo(remote)
+            import_cache = cache.ImportCache(temp_dir_path / "cache")
+
+            def make_repo(build: str) -> structure.DocsRepo:
+                (temp_dir_path / build).mkdir()
+                return structure.DocsRepo(
+                    name="test-repo",
+                    url=url,
+                    temp_dir=temp_dir_path / build,
+                    branch="main",
+                )
+
+            docs_repo = await make_repo("build1").import_docs(cache=import_cache)
+            self.assertFileExists(docs_repo.location / "page1.md")
+            # the remote hasn't changed so the second build shouldn't clone
+            with mock.patch.object(structure.Repo, "sparse_clone") as sparse_clone:
+                docs_repo = await make_repo("build2").import_docs(cache=import_cache)
+                sparse_clone.assert_not_called()
+            self.assertFileExists(docs_repo.location / "page1.md")
+            # a new commit invalidates the cached tree
+            commit_files(remote, {"docs/page3.md": "# Page3"})
+            docs_repo = await make_repo("build3").import_docs(cache=import_cache)
+            self.assertFileExists(docs_repo.location / "page3.md")
+
+    async def test_import_docs_parses_config(self):
+        async with tempfile.TemporaryDirectory() as temp_dir:
+            temp_dir_path = pathlib.Path(temp_dir)
+            url = make_local_repo(temp_dir_path / "remote")
+            config_cache = cache.ConfigCache(temp_dir_path / "configs")
+            build_dir = temp_dir_path / "build"
+            build_dir.mkdir()
+            repo = structure.DocsRepo("section/repo", url, build_dir, branch="main")
+            await repo.import_docs(config_cache=config_cache)
+            nav = [
+                {"Home": "section/repo/index.md"},
+                {"Page1": "section/repo/page1.md"},
+            ]
+            self.assertEqual(repo.nav_config, {"nav": nav})
+            self.assertIn("load_config", repo.timings.durations)
+            # an unchanged config file isn't parsed again
+            with mock.patch.object(structure, "yaml_load") as yaml_load:
+                await repo.import_docs(config_cache=config_cache)
+                yaml_load.assert_not_called()
+            self.assertEqual(repo.nav_config, {"nav": nav})
+            (repo.location / "mkdocs.yml").write_text("nav:\n  - Page2: page2.md\n")
+            self.assertEqual(
+                repo.load_nav_config(config_cache),
+                {"nav": [{"Page2": "section/repo/page2.md"}]},
+            )
+
+    async def test_incremental_fetch(self):
+        async with tempfile.TemporaryDirectory() as temp_dir:
+            temp_dir_path = pathlib.Path(temp_dir)
+            remote = temp_dir_path / "remote"
+            url = make_local_repo(remote)
+            git_store = cache.GitStore(temp_dir_path / "store")
+            build_dir = temp_dir_path / "build"
+            build_dir.mkdir()
+            repo = structure.Repo("test-repo", url, "main", build_dir, ["docs/*"])
+            await repo.import_paths(git_store=git_store)
+            self.assertFileExists(repo.location / "docs" / "page1.md")
+            repo_dir = git_store.repo_dir(url, "test-repo")
+            self.assertDirExists(repo_dir / ".git")
+            # .git is kept in the store and not copied into the build
+            self.assertFalse((repo.location / ".git").exists())
+            # new commits and changed imports update the kept repo in place
+            commit_files(remote, {"docs/page3.md": "# Page3"})
+            repo.paths = ["src/*"]
+            await repo.import_paths(git_store=git_store)
+            self.assertFileExists(repo.location / "src" / "script.py")
+            self.assertFalse((repo.location / "docs").exists())
+            repo.paths = ["docs/*"]
+            await repo.import_paths(git_store=git_store)
+            self.assertFileExists(repo.location / "docs" / "page3.md")
+            self.assertEqual(
+                git("rev-parse", "HEAD", cwd=repo_dir),
+                git("rev-parse", "HEAD", cwd=remote),
+            )
+
+    def test_cache_key(self):
+        repo = structure.DocsRepo(
+            "name", "https://foo", pathlib.Path(""), branch="main"
+        )
+        other = structure.DocsRepo(
+            "name", "https://foo", pathlib.Path(""), branch="main", extra_imports=["a"]
+        )
+        self.assertEqual(repo.cache_key(), repo.cache_key())
+        self.assertNotEqual(repo.cache_key(), other.cache_key())
+        self.assertNotEqual(repo.cache_key(), repo.cache_key(True))
+
+
+class TestTiming(BaseCase):
+    async def test_import_phases_are_timed(self):
+        async with tempfile.TemporaryDirectory() as temp_dir:
+            temp_dir_path = pathlib.Path(temp_dir)
+            url = make_local_repo(temp_dir_path / "remote")
+            build_dir = temp_dir_path / "build"
+            build_dir.mkdir()
+            repo = structure.DocsRepo("test-repo", url, build_dir, branch="main")
+            await repo.import_docs(cache=cache.ImportCache(temp_dir_path / "cache"))
+            repo.load_config()
+            phases = ["resolve_ref", "restore", "fetch", "checkout", "move_docs"]
+            self.assertEqual(set(repo.timings.durations), {*phases, "load_config"})
+            # a new import starts from scratch
+            await repo.import_docs()
+            self.assertNotIn("resolve_ref", repo.timings.durations)
+
+    def test_timing_report(self):
+        repos = [
+            structure.Repo("fast", "https://foo", "main", Path("")),
+            structure.Repo("slow", "https://bar", "main", Path("")),
+        ]
+        repos[0].timings.durations = {"fetch": 1.0, "checkout": 0.5}
+        repos[1].timings.durations = {"fetch": 3.0, "get_files": 0.25}
+        report = timing.timing_report(repos)
+        self.assertEqual([entry["name"] for entry in report["repos"]], ["slow", "fast"])
+        self.assertEqual(report["phases"]["fetch"], 4.0)
+        self.assertEqual(report["total"], 4.75)
+        table = timing.format_timing_table(report).splitlines()
+        self.assertEqual(
+            table[0].split(), ["repo", "fetch", "checkout", "get_files"] + ["total"]
+        )
+        self.assertEqual(table[2].split(), ["slow", "3.000", "0.000", "0.250", "3.250"])
+        self.assertEqual(table[-1].split()[-1], "4.750")
+
+
+class TestScheduler(BaseCase):
+    def make_repos(self, n: int) -> List[structure.Repo]:
+        return [
+            structure.Repo(f"repo{i}", f"https://host{i % 2}/repo{i}", "main", Path(""))
+            for i in range(n)
+        ]
+
+    def test_get_host(self):
+        self.assertEqual(scheduler.get_host("https://github.com/a/b"), "github.com")
+        self.assertEqual(scheduler.get_host("git@gitlab.com:a/b.git"), "gitlab.com")
+        self.assertEqual(scheduler.get_host("/some/path"), "")
+
+    def test_order_slowest_first(self):
+        repos = self.make_repos(3)
+        import_scheduler = scheduler.ImportScheduler()
+        import_scheduler.durations = {
+            import_scheduler.repo_key(repos[0]): 1.0,
+            import_scheduler.repo_key(repos[1]): 5.0,
+        }
+        # repo2 has no recorded duration so it goes first
+        self.assertEqual(
+            [r.name for r in import_scheduler.order(repos)], ["repo2", "repo1", "repo0"]
+        )
+
+    async def test_concurrency_limits(self):
+        running: Dict[str, int] = {"all": 0, "host0": 0, "max_all": 0, "max_host0": 0}
+
+        async def method(repo):
+            host = scheduler.get_host(repo.url)
+            running["all"] += 1
+            running[host] = running.get(host, 0) + 1
+            running["max_all"] = max(running["max_all"], running["all"])
+            running["max_host0"] = max(running["max_host0"], running.get("host0", 0))
+            await asyncio.sleep(0.01)
+            running["all"] -= 1
+            running[host] -= 1
+            return repo
+
+        import_scheduler = scheduler.ImportScheduler(
+            max_concurrency=3, host_concurrency={"host0": 1}
+        )
+        await structure.batch_execute(
+            self.make_repos(8), method, scheduler=import_scheduler
+        )
+        self.assertEqual(running["max_all"], 3)
+        self.assertEqual(running["max_host0"], 1)
+        self.assertEqual(len(import_scheduler.durations), 8)
+
+    async def test_rate_limit_retry(self):
+        calls = []
+
+        async def method(repo):
+            calls.append(repo.name)
+            if len(calls) < 3:
+                raise util.BashException("error: RPC failed; HTTP 429 curl 22")
+            return repo
+
+        import_scheduler = scheduler.ImportScheduler(backoff=0.001)
+        import_scheduler.reset()
+        repo = self.make_repos(1)[0]
+        self.assertEqual(await import_scheduler.run(repo, method), repo)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(import_scheduler.host_limiter("host0").limit, 1)
+
+        async def failing(repo):
+            raise util.BashException("fatal: repository not found")
+
+        with self.assertRaises(util.BashException):
+            await import_scheduler.run(repo, failing)
+
+    async def test_transient_error_and_timeout_retry(self):
+        calls = []
+
+        async def method(repo):
+            calls.append(repo.name)
+            if len(calls) == 1:
+                raise util.GitException(
+                    "fatal: unable to access: Connection reset by peer"
+                )
+            if len(calls) == 2:
+                await asyncio.sleep(1)
+            return repo
+
+        import_scheduler = scheduler.ImportScheduler(backoff=0.001, timeout=0.05)
+        import_scheduler.reset()
+        repo = self.make_repos(1)[0]
+        self.assertEqual(await import_scheduler.run(repo, method), repo)
+        self.assertEqual(len(calls), 3)
+        # transient errors don't lower the host's limit like rate limiting does
+        self.assertIsNone(import_scheduler.host_limiter("host0").limit)
+        import_scheduler.max_retries = 1
+        with self.assertRaises(util.ImportTimeoutException):
+            await import_scheduler.run(repo, lambda repo: asyncio.sleep(1))
+
+        async def unresolved(repo):
+            calls.append(repo.name)
+            raise util.GitException("fatal: unable to access: Could not resolve host")
+
+        calls.clear()
+        with self.assertRaises(util.GitException):
+            await import_scheduler.run(repo, unresolved)
+        self.assertEqual(len(calls), 1)
+
+    async def test_failed_import_cancels_the_others(self):
+        with TemporaryDirectory() as temp_dir:
+            repos = [
+                structure.Repo(f"repo{i}", "https://host/repo", "main", Path(temp_dir))
+                for i in range(3)
+            ]
+            cancelled = []
+
+            async def method(repo):
+                repo.location.mkdir(parents=True)
+                if repo.name == "repo0":
+                    return repo
+                if repo.name == "repo1":
+                    raise util.GitException("fatal: repository not found")
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    cancelled.append(repo.name)
+                    raise
+
+            with self.assertRaises(util.GitException):
+                await structure.batch_execute(repos, method)
+            self.assertEqual(cancelled, ["repo2"])
+            # only the imports that didn't complete are removed
+            self.assertEqual(os.listdir(temp_dir), ["repo0"])
+            with self.assertRaises(util.ImportTimeoutException):
+                await structure.batch_execute(
+                    repos[1:], lambda repo: asyncio.sleep(10), timeout=0.05
+                )
+
+    async def test_execute_plan(self):
+        with TemporaryDirectory() as temp_dir:
+            repos = [
+                structure.Repo(f"repo{i}", "https://host/repo", "main", Path(temp_dir))
+                for i in range(3)
+            ]
+            started = {repo.name: asyncio.Event() for repo in repos[:2]}
+            calls = []
+
+            def make_method(kind: str, other: str):
+                async def method(repo):
+                    calls.append((kind, repo.name))
+                    if repo.name in started:
+                        # only completes if the other kind of import runs alongside it
+                        started[repo.name].set()
+                        await started[other].wait()
+                    return repo
+
+                return method
+
+            async def expand(repo):
+                return [repos[2]] if repo is repos[0] else []
+
+            await structure.execute_plan(
+                [
+                    (repos[0], make_method("docs", "repo1")),
+                    (repos[1], make_method("paths", "repo0")),
+                ],
+                timeout=5,
+                expand=expand,
+            )
+            # a repo added by expand is imported like the repo that added it
+            self.assertEqual(
+                sorted(calls),
+                [("docs", "repo0"), ("docs", "repo2"), ("paths", "repo1")],
+            )
+
+    async def test_cancelled_process_is_killed(self):
+        process = await asyncio.create_subprocess_exec(
+            "sleep", "10", stdout=subprocess.PIPE, start_new_session=True
+        )
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(util.communicate(process), 0.05)
+        self.assertIsNotNone(process.returncode)
+
+
+class TestPlugin(unittest.TestCase):
+    def load_site_config(self, site_dir: Path, nav: List, **plugin_config):
+        """writes a mkdocs.yml for a site importing docs and returns the loaded config"""
+        (site_dir / "docs").mkdir(parents=True, exist_ok=True)
+        (site_dir / "docs" / "index.md").write_text("# Home")
+        with open(site_dir / "mkdocs.yml", "w") as f:
+            yaml.safe_dump(
+                {
+                    "site_name": "test",
+                    "nav": nav,
+                    "plugins": [{"multirepo": plugin_config}],
+                },
+                f,
+            )
+        return load_config(str(site_dir / "mkdocs.yml"))
+
+    def test_serve_reuses_imports(self):
+        with TemporaryDirectory() as temp_dir:
+            temp_dir_path = Path(temp_dir)
+            url = make_local_repo(temp_dir_path / "remote")
+            nav = [{"Home": "index.md"}, {"Repo": f"!import {url}?branch=main"}]
+            site_dir = temp_dir_path / "site"
+            config = self.load_site_config(site_dir, nav)
+            multirepo = config.plugins["multirepo"]
+            multirepo.on_startup(command="serve", dirty=False)
+            config = multirepo.on_config(config)
+            imported_nav = config["nav"]
+            self.assertEqual(imported_nav[1]["Repo"][0], {"Home": "repo/index.md"})
+            multirepo.on_post_build(config)
+            self.assertTrue(multirepo.temp_dir.is_dir())
+            # a rebuild with the same configuration doesn't import again
+            with mock.patch.object(
+                plugin.MultirepoPlugin, "import_docs"
+            ) as import_docs:
+                config = multirepo.on_config(self.load_site_config(site_dir, nav))
+                import_docs.assert_not_called()
+            self.assertEqual(config["nav"], imported_nav)
+            # touching the refresh file forces a re-import
+            multirepo.refresh_file.touch()
+            os.utime(multirepo.refresh_file, (0, 0))
+            with mock.patch.object(
+                plugin.MultirepoPlugin, "import_docs", side_effect=lambda c, _: c
+            ) as import_docs:
+                multirepo.on_config(self.load_site_config(site_dir, nav))
+                import_docs.assert_called_once()
+            multirepo.on_shutdown()
+            self.assertFalse(multirepo.temp_dir.exists())
+
+    @parameterized.expand([("one_stage", False), ("two_stage", True)])
+    def test_nested_imports(self, _, two_stage_import: bool):
+        with TemporaryDirectory() as temp_dir:
+            temp_dir_path = Path(temp_dir)
+
+            def make_repo(name: str, nav: List) -> str:
+                return make_local_repo(
+                    temp_dir_path / name,
+                    {
+                        "docs/index.md": f"# {name}",
+                        "docs/mkdocs.yml": yaml.safe_dump({"nav": nav}),
+                    },
+                )
+
+            leaf_url = make_repo("leaf", [{"Leaf": "index.md"}])
+            middle_url = make_repo(
+                "middle",
+                [{"Middle": "index.md"}, {"Leaf": f"!import {leaf_url}?branch=main"}],
+            )
+            top_url = make_repo(
+                "top",
+                [
+                    {"Top": "index.md"},
+                    {"Nested": [{"Middle": f"!import {middle_url}?branch=main"}]},
+                ],
+            )
+            nav = [
+                {"Home": "index.md"},
+                {"Top": f"!import {top_url}?branch=main"},
+                {"Middle": f"!import {middle_url}?branch=main"},
+            ]
+            site_dir = temp_dir_path / "site"
+            config = self.load_site_config(
+                site_dir, nav, cleanup=False, two_stage_import=two_stage_import
+            )
+            multirepo = config.plugins["multirepo"]
+            config = multirepo.on_config(config)
+            # the second stage imports the docs in the background until on_files
+            self.assertEqual(multirepo.docs_import is not None, two_stage_import)
+            leaf_nav = [{"Leaf": "top/nested/middle/leaf/index.md"}]
+            self.assertEqual(
+                config["nav"][1]["Top"],
+                [
+                    {"Top": "top/index.md"},
+                    {
+                        "Nested": [
+                            {
+                                "Middle": [
+                                    {"Middle": "top/nested/middle/index.md"},
+                                    {"Leaf": leaf_nav},
+                                ]
+                            }
+                        ]
+                    },
+                ],
+            )
+            self.assertEqual(
+                config["nav"][2]["Middle"][1]["Leaf"],
+                [{"Leaf": "middle/leaf/index.md"}],
+            )
+            # the middle repo is imported once, and so is the leaf repo it imports
+            repos = multirepo.repos
+            self.assertIs(repos["top/nested/middle"].alias_of, repos["middle"])
+            self.assertIs(
+                repos["top/nested/middle/leaf"].alias_of, repos["middle/leaf"]
+            )
+            # a nested import's files belong to it rather than to the repo importing it
+            files = multirepo.on_files(Files([]), config)
+            self.assertEqual(
+                [f.src_path for f in files if f.repo.name == "top/nested/middle"],
+                ["top/nested/middle/index.md"],
+            )
+            self.assertIn("top/nested/middle/leaf/index.md", files.src_paths)
+            # an import of one of its ancestors is a cycle
+            commit_files(
+                temp_dir_path / "leaf",
+                {
+                    "docs/mkdocs.yml": yaml.safe_dump(
+                        {"nav": [{"Top": f"!import {top_url}?branch=main"}]}
+                    )
+                },
+            )
+            config = self.load_site_config(
+                site_dir, nav[:2], two_stage_import=two_stage_import
+            )
+            with self.assertRaisesRegex(util.ImportDocsException, "cycle"):
+                config.plugins["multirepo"].on_config(config)
+
+    def test_track_changes(self):
+        with TemporaryDirectory() as temp_dir:
+            temp_dir_path = Path(temp_dir)
+            remote = temp_dir_path / "remote"
+            url = make_local_repo(remote)
+            nav = [{"Home": "index.md"}, {"Repo": f"!import {url}?branch=main"}]
+            site_dir = temp_dir_path / "site"
+            config = self.load_site_config(site_dir, nav, track_changes=True)
+            multirepo = config.plugins["multirepo"]
+            multirepo.on_startup(command="serve", dirty=True)
+            multirepo.on_config(config)
+            self.assertEqual(
+                multirepo.import_changes.added,
+                ["repo/index.md", "repo/mkdocs.yml", "repo/page1.md", "repo/page2.md"],
+            )
+            unchanged = multirepo.temp_dir / "repo" / "index.md"
+            os.utime(unchanged, (0, 0))
+            commit_files(remote, {"docs/page1.md": "# Changed", "docs/new.md": "# New"})
+            git("rm", "-q", "docs/page2.md", cwd=remote)
+            commit_files(remote, {})
+            # a refresh re-imports the docs
+            multirepo.refresh_file.touch()
+            os.utime(multirepo.refresh_file, (1, 1))
+            multirepo.on_config(
+                self.load_site_config(site_dir, nav, track_changes=True)
+            )
+            changes = multirepo.import_changes
+            self.assertEqual(changes.added, ["repo/new.md"])
+            self.assertEqual(changes.changed, ["repo/page1.md"])
+            self.assertEqual(changes.removed, ["repo/page2.md"])
+            # the unchanged files weren't touched
+            self.assertEqual(unchanged.stat().st_mtime, 0)
+            self.assertFalse((multirepo.temp_dir / "repo" / "page2.md").exists())
+            multirepo.on_shutdown()
+
+    def test_local_imports(self):
+        with TemporaryDirectory() as temp_dir:
+            temp_dir_path = Path(temp_dir)
+            # a sibling checkout, with uncommitted docs
+            source = temp_dir_path / "sibling"
+            for file, content in DEMO_REPO_FILES.items():
+                (source / file).parent.mkdir(parents=True, exist_ok=True)
+                (source / file).write_text(content)
+            nav = [{"Home": "index.md"}, {"Repo": f"!import {source}"}]
+            site_dir = temp_dir_path / "site"
+            config = self.load_site_config(site_dir, nav)
+            multirepo = config.plugins["multirepo"]
+            multirepo.on_startup(command="serve", dirty=True)
+            multirepo.on_config(config)
+            repo = multirepo.repos["repo"]
+            self.assertEqual(repo.backend, "local")
+            page1 = multirepo.temp_dir / "repo" / "page1.md"
+            self.assertTrue(page1.samefile(source / "docs" / "page1.md"))
+            server = mock.Mock()
+            multirepo.on_serve(server, config, None)
+            server.watch.assert_any_call(str(source))
+            # an editor replacing a file breaks its hard link
+            (source / "docs" / "page1.md.tmp").write_text("# Changed")
+            os.replace(source / "docs" / "page1.md.tmp", source / "docs" / "page1.md")
+            (source / "docs" / "new.md").write_text("# New")
+            (source / "docs" / "page2.md").unlink()
+            with mock.patch.object(multirepo, "import_docs") as import_docs:
+                multirepo.on_config(self.load_site_config(site_dir, nav))
+            import_docs.assert_not_called()
+            changes = multirepo.import_changes
+            self.assertEqual(changes.added, ["repo/new.md"])
+            self.assertEqual(changes.changed, ["repo/page1.md"])
+            self.assertEqual(changes.removed, ["repo/page2.md"])
+            self.assertEqual(page1.read_text(), "# Changed")
+            self.assertFalse((multirepo.temp_dir / "repo" / "page2.md").exists())
+            # a changed nav is imported again
+            (source / "docs" / "mkdocs.yml").write_text("nav:\n  - New: new.md\n")
+            config = multirepo.on_config(self.load_site_config(site_dir, nav))
+            self.assertEqual(config["nav"][1]["Repo"], [{"New": "repo/new.md"}])
+            multirepo.on_shutdown()
+
+    def test_bundles(self):
+        with TemporaryDirectory() as temp_dir:
+            temp_dir_path = Path(temp_dir)
+            remote = temp_dir_path / "remote"
+            url = make_local_repo(remote)
+            git("branch", "other", cwd=remote)
+            nav = [
+                {"Home": "index.md"},
+                {"Repo": f"!import {url}?branch=main"},
+                {"Other": f"!import {url}?branch=other"},
+            ]
+            site_dir = temp_dir_path / "site"
+            self.load_site_config(site_dir, nav)
+            bundles = site_dir / "bundles"
+            for shard in ("1/2", "2/2"):
+                self.assertEqual(
+                    cli.main(
+                        [
+                            "bundle",
+                            "-f",
+                            str(site_dir / "mkdocs.yml"),
+                            "--shard",
+                            shard,
+                            "-o",
+                            str(bundles),
+                        ]
+                    ),
+                    0,
+                )
+            self.assertEqual(
+                sorted(path.name for path in bundles.iterdir()),
+                ["multirepo-1-of-2.tar", "multirepo-2-of-2.tar"],
+            )
+            # the build doesn't need the remote
+            rmtree(remote)
+            config = self.load_site_config(site_dir, nav, bundles="bundles")
+            config = config.plugins["multirepo"].on_config(config)
+            self.assertEqual(config["nav"][1]["Repo"][0], {"Home": "repo/index.md"})
+            self.assertEqual(config["nav"][2]["Other"][0], {"Home": "other/index.md"})
+            temp_dir = site_dir / "temp_dir"
+            self.assertEqual((temp_dir / "other" / "page1.md").read_text(), "# Page1")
+            # imports that aren't bundled fail the build
+            nav.append({"Missing": f"!import {url}?branch=missing"})
+            config = self.load_site_config(site_dir, nav, bundles="bundles")
+            with self.assertRaises(util.ImportDocsException):
+                config.plugins["multirepo"].on_config(config)
+
+    def test_prefetch(self):
+        with TemporaryDirectory() as temp_dir:
+            temp_dir_path = Path(temp_dir)
+            url = make_local_repo(temp_dir_path / "remote")
+            nav = [{"Home": "index.md"}, {"Repo": f"!import {url}?branch=main"}]
+            site_dir = temp_dir_path / "site"
+            site_dir.mkdir()
+            # the theme and the other plugins aren't installed yet
+            with open(site_dir / "mkdocs.yml", "w") as f:
+                yaml.safe_dump(
+                    {
+                        "site_name": "test",
+                        "nav": nav,
+                        "theme": {"name": "not-installed"},
+                        "plugins": ["not-installed", {"multirepo": {}}],
+                    },
+                    f,
+                )
+            self.assertEqual(
+                cli.main(["prefetch", "-f", str(site_dir / "mkdocs.yml")]), 0
+            )
+            self.assertTrue((site_dir / plugin.PREFETCH_DIR).is_dir())
+            self.assertFalse((site_dir / "temp_dir").exists())
+            # builds restore the prefetched docs
+            config = self.load_site_config(site_dir, nav)
+            with mock.patch.object(structure.DocsRepo, "fetch_docs") as fetch_docs:
+                config = config.plugins["multirepo"].on_config(config)
+            fetch_docs.assert_not_called()
+            self.assertEqual(config["nav"][1]["Repo"][0], {"Home": "repo/index.md"})
+            self.assertEqual(
+                (site_dir / "temp_dir" / "repo" / "page1.md").read_text(), "# Page1"
+            )
+
+    def test_clone_filters(self):
+        with TemporaryDirectory() as temp_dir:
+            temp_dir_path = Path(temp_dir)
+            url = make_local_repo(temp_dir_path / "remote")
+            other_url = make_local_repo(temp_dir_path / "other")
+            nav = [
+                {"Home": "index.md"},
+                {"Repo": f"!import {url}?branch=main"},
+                {"Own": f"!import {url}?branch=main&clone_filter=blob:limit=1m"},
+                {"Other": f"!import {other_url}?branch=main"},
+            ]
+            site_dir = temp_dir_path / "site"
+            self.load_site_config(site_dir, nav)
+            self.assertEqual(
+                cli.main(
+                    [
+                        "benchmark-strategies",
+                        "-f",
+                        str(site_dir / "mkdocs.yml"),
+                        "--url",
+                        url,
+                        "--branch",
+                        "main",
+                        "--runs",
+                        "1",
+                        "--record",
+                    ]
+                ),
+                0,
+            )
+            with open(site_dir / plugin.CLONE_FILTERS_FILE) as f:
+                recorded = json.load(f)
+            self.assertIn(recorded[url], backends.CLONE_FILTERS)
+            # an import's own filter wins over the recorded one, which wins over the setting
+            config = self.load_site_config(site_dir, nav, clone_filter="none")
+            multirepo = config.plugins["multirepo"]
+            multirepo.on_config(config)
+            self.assertEqual(multirepo.repos["repo"].clone_filter, recorded[url])
+            self.assertEqual(multirepo.repos["own"].clone_filter, "blob:limit=1m")
+            self.assertEqual(multirepo.repos["other"].clone_filter, "none")
+
+    def test_lock_file(self):
+        with TemporaryDirectory() as temp_dir:
+            temp_dir_path = Path(temp_dir)
+            remote = temp_dir_path / "remote"
+            url = make_local_repo(remote)
+            locked_sha = git("rev-parse", "HEAD", cwd=remote)
+            nav = [{"Home": "index.md"}, {"Repo": f"!import {url}?branch=main"}]
+            site_dir = temp_dir_path / "site"
+            lock_file = site_dir / lock.LOCK_FILE
+            self.load_site_config(site_dir, nav, locked=True)
+            self.assertEqual(
+                cli.main(["update", "-f", str(site_dir / "mkdocs.yml")]), 0
+            )
+            self.assertEqual(
+                lock.LockFile.load(lock_file).entries["repo"]["sha"], locked_sha
+            )
+            new_sha = commit_files(remote, {"docs/page1.md": "# Moved"})
+            # a locked build imports the locked commit
+            config = self.load_site_config(site_dir, nav, locked=True)
+            multirepo = config.plugins["multirepo"]
+            multirepo.on_config(config)
+            page = multirepo.temp_dir / "repo" / "page1.md"
+            self.assertEqual(page.read_text(), "# Page1")
+            # and doesn't touch the lock file
+            self.assertIsNone(lock.LockFile.load(lock_file).entries["repo"]["tree"])
+            multirepo.on_post_build(config)
+            # other builds also import the locked commit, recording the imported tree
+            config = self.load_site_config(site_dir, nav, lock_file=lock.LOCK_FILE)
+            multirepo = config.plugins["multirepo"]
+            with mock.patch.object(
+                plugin, "resolve_refs", wraps=lock.resolve_refs
+            ) as resolve:
+                multirepo.on_config(config)
+            # without asking the remote where the branch is
+            resolve.assert_not_called()
+            self.assertEqual(page.read_text(), "# Page1")
+            entry = lock.LockFile.load(lock_file).entries["repo"]
+            self.assertEqual(entry["sha"], locked_sha)
+            self.assertEqual(entry["tree"], lock.tree_hash(page.parent))
+            multirepo.on_post_build(config)
+            # until the lock file is updated
+            self.assertEqual(
+                cli.main(["update", "-f", str(site_dir / "mkdocs.yml")]), 0
+            )
+            config = self.load_site_config(site_dir, nav, lock_file=lock.LOCK_FILE)
+            multirepo = config.plugins["multirepo"]
+            # a build, so the unchanged config doesn't reuse the imports like serve does
+            multirepo.on_startup(command="build", dirty=False)
+            multirepo.on_config(config)
+            self.assertEqual(page.read_text(), "# Moved")
+            entry = lock.LockFile.load(lock_file).entries["repo"]
+            self.assertEqual(entry["sha"], new_sha)
+            self.assertEqual(entry["tree"], lock.tree_hash(page.parent))
+            multirepo.on_post_build(config)
+            # imports that aren't in the lock file are added by other builds
+            git("branch", "other", cwd=remote)
+            nav.append({"Other": f"!import {url}?branch=other"})
+            config = self.load_site_config(site_dir, nav, lock_file=lock.LOCK_FILE)
+            multirepo = config.plugins["multirepo"]
+            multirepo.on_config(config)
+            self.assertIn("other", lock.LockFile.load(lock_file).entries)
+            multirepo.on_post_build(config)
+            # but fail locked builds
+            nav.append({"Another": f"!import {url}?branch=another"})
+            config = self.load_site_config(site_dir, nav, locked=True)
+            with self.assertRaises(util.ImportDocsException):
+                config.plugins["multirepo"].on_config(config)
+
+    def test_update_refreshes_nested_imports(self):
+        with TemporaryDirectory() as temp_dir:
+            temp_dir_path = Path(temp_dir)
+            remote = temp_dir_path / "remote"
+            url = make_local_repo(remote)
+            old_sha = git("rev-parse", "HEAD", cwd=remote)
+            nested_remote = temp_dir_path / "nested"
+            nested_url = make_local_repo(nested_remote, {"docs/index.md": "# Nested"})
+            nested_sha = git("rev-parse", "HEAD", cwd=nested_remote)
+            nav = [{"Home": "index.md"}, {"Repo": f"!import {url}?branch=main"}]
+            site_dir = temp_dir_path / "site"
+            self.load_site_config(site_dir, nav, locked=True)
+            lock_file = site_dir / lock.LOCK_FILE
+            # as a build importing repo would have locked the import nested in it
+            nested = structure.Repo("repo/nested", nested_url, "main", temp_dir_path)
+            lock_data = lock.LockFile(lock_file)
+            lock_data.set(nested, old_sha, "tree")
+            lock_data.save()
+            self.assertEqual(
+                cli.main(["update", "-f", str(site_dir / "mkdocs.yml")]), 0
+            )
+            entries = lock.LockFile.load(lock_file).entries
+            self.assertEqual(entries["repo"]["sha"], old_sha)
+            self.assertEqual(entries["repo/nested"]["sha"], nested_sha)
+            self.assertIsNone(entries["repo/nested"]["tree"])
+
+    def test_locked_archive_import(self):
+        with TemporaryDirectory() as temp_dir:
+            temp_dir_path = Path(temp_dir)
+            remote = temp_dir_path / "remote"
+            url = make_local_repo(remote)
+            nav = [
+                {"Home": "index.md"},
+                {"Repo": f"!import {url}?branch=main&backend=archive"},
+            ]
+            site_dir = temp_dir_path / "site"
+            self.load_site_config(site_dir, nav, locked=True)
+            self.assertEqual(
+                cli.main(["update", "-f", str(site_dir / "mkdocs.yml")]), 0
+            )
+            commit_files(remote, {"docs/page1.md": "# Moved"})
+            # upload-archive won't serve the locked commit, which is fetched instead
+            config = self.load_site_config(site_dir, nav, locked=True)
+            multirepo = config.plugins["multirepo"]
+            multirepo.on_startup(command="build", dirty=False)
+            multirepo.on_config(config)
+            page = multirepo.temp_dir / "repo" / "page1.md"
+            self.assertEqual(page.read_text(), "# Page1")
+            self.assertFalse((page.parent / "docs").exists())
+            multirepo.on_post_build(config)
+
 
 if __name__ == "__main__":
     unittest.main()